@@ -0,0 +1,663 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`MCEq.backends` --- registry of backends for the forward-euler integrator
+==============================================================================
+
+A backend performs the single integration step
+
+.. math::
+
+  \Phi_{i + 1} = \\left[\\boldsymbol{M}_{int} + \\frac{1}{\\rho(X_i)}\\boldsymbol{M}_{dec}\\right]
+  \\cdot \\Phi_i \\cdot \\Delta X_i
+
+on a specific library or device. The loop over the integration steps,
+the muon energy loss and the output on a depth grid are implemented once
+in :func:`integrate`. Each backend implements the protocol
+
+- :func:`KernelBackend.setup` prepares the matrices of a
+  :class:`MCEq.kernels.SolverSession` and the initial state,
+- :func:`KernelBackend.step` performs one integration step,
+- :func:`KernelBackend.get_phi` and :func:`KernelBackend.set_phi` give
+  access to the current state vector,
+- :func:`KernelBackend.finish` returns the final state vector,
+
+and declares its capabilities in class attributes. :func:`select_backend`
+picks the backend requested by ``kernel_config`` if it is available and
+supports the settings of the calculation, otherwise the fastest
+available one. Additional backends can be added with
+:func:`register_backend`::
+
+    from MCEq.backends import KernelBackend, register_backend
+
+    @register_backend
+    class MyBackend(KernelBackend):
+        name = 'my_kernel'
+        priority = 10
+
+        def setup(self, session, phi, fa_vars=None):
+            ...
+
+"""
+import numpy as np
+from mceq_config import config, dbg
+
+#: (list) registered backend classes
+_backends = []
+#: (dict) results of :func:`KernelBackend.available` by backend class
+_available = {}
+
+
+def register_backend(backend):
+    """Adds a backend class to the registry. Can be used as class
+    decorator.
+
+    Args:
+      backend (class): subclass of :class:`KernelBackend`
+    Returns:
+      (class): ``backend``
+    """
+    _backends.append(backend)
+    return backend
+
+
+def select_backend(requirements, preferred=None, **options):
+    """Returns an instance of the backend for the calculation.
+
+    The ``preferred`` backend is used, if it is available and supports
+    all ``requirements``. Otherwise, the available backend with the highest
+    :attr:`KernelBackend.priority` is used. The availability of each
+    backend is probed only once per process.
+
+    Args:
+      requirements (dict): see :func:`KernelBackend.unsupported`
+      preferred (str): name of the requested backend
+      options (dict): passed to the constructor of the backend
+    Returns:
+      (object): instance of :class:`KernelBackend`
+    """
+    candidates = []
+    for backend in _backends:
+        missing = backend.unsupported(requirements)
+        # Probing the libraries is done once per process
+        if not missing and backend not in _available:
+            _available[backend] = backend.available()
+        if not missing and _available[backend]:
+            candidates.append(backend)
+        elif backend.name == preferred and dbg > 0:
+            print("select_backend(): backend {0} ({1}) {2}.").format(
+                backend.name, backend.__name__,
+                'does not support ' + ', '.join(missing)
+                if missing else 'is not available')
+
+    if not candidates:
+        raise Exception("select_backend(): no backend supports the " +
+                        "requirements {0}.".format(requirements))
+
+    selected = [b for b in candidates if b.name == preferred]
+    if not selected:
+        selected = sorted(candidates, key=lambda b: -b.priority)
+        if preferred is not None and dbg > 0:
+            print("select_backend(): falling back from '{0}' to '{1}'."
+                  ).format(preferred, selected[0].name)
+
+    return selected[0](**options)
+
+
+class KernelBackend(object):
+    """Base class of the integration backends.
+
+    Args:
+      options (dict): backend specific options, e.g. ``device_id``
+    """
+
+    #: (str) name, as used by ``kernel_config`` in :mod:`mceq_config`
+    name = None
+    #: (int) preference among available backends, higher is faster
+    priority = 0
+    #: (bool) supports sparse matrices
+    sparse = True
+    #: (bool) supports dense matrices
+    dense = False
+    #: (tuple) supported floating point precisions
+    precisions = (32, 64)
+    #: (tuple) supported matrix formats, ``None`` for all objects with ``dot``
+    matrix_formats = ('csr', )
+    #: (bool) supports the first interaction mode
+    first_interaction = False
+    #: (bool) supports the muon energy loss
+    energy_loss = True
+    #: (bool) supports the output on a depth grid
+    grid_output = True
+    #: (bool) supports the active set of the state vector
+    active_set = False
+    #: (bool) integrates several state vectors at once
+    batching = False
+    #: (bool) runs the complete loop in :func:`run`, without :func:`step`
+    fused_loop = False
+    #: (bool) calls :attr:`source_hook` with the change of the state vector
+    source_terms = False
+
+    def __init__(self, **options):
+        self.options = options
+        #: (callable) ``source_hook(step, phi, delta, idcs, rho_inv, dX)``,
+        #: e.g. :class:`MCEq.reducers.ProductionDepth`
+        self.source_hook = None
+
+    @classmethod
+    def available(cls):
+        """Returns ``True`` if the libraries of the backend can be used."""
+        return True
+
+    @classmethod
+    def unsupported(cls, requirements):
+        """Returns the requirements, which the backend does not support.
+
+        Args:
+          requirements (dict): with keys ``sparse`` (bool), ``precision``
+            (int), ``matrix_format`` (str), ``first_interaction`` (bool),
+            ``energy_loss`` (bool), ``grid_output`` (bool), ``active_set``
+            (bool), ``batching`` (bool), ``source_terms`` (bool)
+        Returns:
+          (list of str): names of unsupported requirements
+        """
+        missing = []
+        if requirements.get('sparse', True) and not cls.sparse:
+            missing.append('sparse')
+        if not requirements.get('sparse', True) and not cls.dense:
+            missing.append('dense')
+        if requirements.get('precision', 64) not in cls.precisions:
+            missing.append('precision')
+        if (requirements.get('sparse', True) and
+                cls.matrix_formats is not None and
+                requirements.get('matrix_format', 'csr')
+                not in cls.matrix_formats):
+            missing.append('matrix_format')
+        for cap in ['first_interaction', 'energy_loss', 'grid_output',
+                    'active_set', 'batching', 'source_terms']:
+            if requirements.get(cap, False) and not getattr(cls, cap):
+                missing.append(cap)
+        return missing
+
+    def setup(self, session, phi, fa_vars=None):
+        """Prepares the integration.
+
+        Args:
+          session (object): :class:`MCEq.kernels.SolverSession`
+          phi (numpy.array): initial state vector in the session layout
+          fa_vars (dict,optional): variables for first interaction mode
+        """
+        raise NotImplementedError()
+
+    def step(self, step, rho_inv, dX):
+        """Performs integration step number ``step``.
+
+        Args:
+          step (int): index of the step
+          rho_inv (float): :math:`\\frac{1}{\\rho(X_i)}`
+          dX (float): step size :math:`\\Delta X_i` in g/cm**2
+        """
+        raise NotImplementedError()
+
+    def run(self, nsteps, dX, rho_inv):
+        """Performs all integration steps (only for :attr:`fused_loop`)."""
+        raise NotImplementedError()
+
+    def get_phi(self):
+        """Returns the current state vector. Host backends return their
+        buffer without copy."""
+        raise NotImplementedError()
+
+    def set_phi(self, phi):
+        """Replaces the current state vector."""
+        raise NotImplementedError()
+
+    def finish(self):
+        """Returns the final state vector."""
+        return self.get_phi()
+
+    def _context(self, session, create):
+        """Returns the context of the backend, which is kept across
+        sessions, and sets the matrices of the ``session`` if the context
+        holds the matrices of another session."""
+        import weakref
+
+        entry = session.contexts.get(self.__class__.__name__)
+        if entry is None:
+            ctx = create()
+        else:
+            ctx, owner = entry
+            if owner() is not session:
+                ctx.set_matrices(session.int_m, session.dec_m)
+        session.contexts[self.__class__.__name__] = (ctx,
+                                                     weakref.ref(session))
+        return ctx
+
+
+def integrate(backend, nsteps, dX, rho_inv, grid_idcs,
+              mu_egrid=None, mu_dEdX=None, mu_idcs=None, prog_bar=None,
+              start_step=0, stop_step=None, dXaccum=0., checkpoint=None,
+              checkpoint_interval=0, observers=None, store_grid=True):
+    """Forward-euler integration with a prepared backend.
+
+    The integration can start and stop at any step of the integration path.
+    To resume, the backend has to be set up with the state vector before
+    step ``start_step`` and ``dXaccum`` from the checkpoint.
+
+    Args:
+      backend (object): instance of :class:`KernelBackend` after
+        :func:`KernelBackend.setup`
+      nsteps (int): number of integration steps
+      dX (numpy.array[nsteps]): vector of step-sizes :math:`\\Delta X_i` in g/cm**2
+      rho_inv (numpy.array[nsteps]): vector of density values :math:`\\frac{1}{\\rho(X_i)}`
+      grid_idcs (list): indices at which longitudinal solutions have to be saved.
+      mu_egrid (numpy.array): energy grid of the muon species
+      mu_dEdX (numpy.array): muon energy loss on ``mu_egrid`` in GeV cm**2/g
+      mu_idcs (list): slices or index arrays of the muon species in ``phi``
+      prog_bar (object,optional): handle to :class:`ProgressBar` object
+      start_step (int,optional): index of the first step
+      stop_step (int,optional): index after the last step, default ``nsteps``
+      dXaccum (float,optional): depth accumulated since the last energy
+        loss step in g/cm**2
+      checkpoint (callable,optional): called as
+        ``checkpoint(step, phi, dXaccum, grid_sol)`` before step ``step``
+        every ``checkpoint_interval`` steps and at ``stop_step``. ``phi``
+        is the internal buffer of the backend and has to be copied.
+      checkpoint_interval (int,optional): steps between checkpoints,
+        0 for a checkpoint only at ``stop_step``
+      observers (list,optional): tuples ``(every, func)``, where
+        ``func(step, phi)`` is called after step ``step`` at the
+        ``grid_idcs`` (``every = 0``) or every ``every`` steps. ``phi``
+        must not be modified or stored without copy.
+      store_grid (bool or object,optional): keep copies of the state
+        vector at the ``grid_idcs`` in the returned list, or store them
+        in a :class:`MCEq.kernels.GridSolution`
+    Returns:
+      tuple(numpy.array, list): state vector :math:`\\Phi(X_{stop\\_step})`
+      after integration, list of state vectors at the ``grid_idcs``
+      between ``start_step`` and ``stop_step``
+    """
+    from time import time
+
+    if stop_step is None:
+        stop_step = nsteps
+
+    grid_sol = []
+    # Skip grid points, which have been passed before start_step
+    grid_step = 0
+    while (grid_idcs and grid_step < len(grid_idcs)
+           and grid_idcs[grid_step] < start_step):
+        grid_step += 1
+
+    start = time()
+
+    if backend.fused_loop:
+        backend.run(stop_step - start_step, dX[start_step:stop_step],
+                    rho_inv[start_step:stop_step])
+        print "Performance: {0:6.2f}ms/iteration".format(
+            1e3 * (time() - start) / float(max(1, stop_step - start_step)))
+        phi = backend.finish()
+        if checkpoint is not None:
+            checkpoint(stop_step, phi, dXaccum, grid_sol)
+        return phi, grid_sol
+
+    enmuloss = config['enable_muon_energy_loss']
+    muloss_min_step = config['muon_energy_loss_min_step']
+
+    for step in xrange(start_step, stop_step):
+        if prog_bar and (step % 200 == 0):
+            prog_bar.update(step)
+
+        if (checkpoint is not None and checkpoint_interval > 0 and
+                step > start_step and step % checkpoint_interval == 0):
+            checkpoint(step, backend.get_phi(), dXaccum, grid_sol)
+
+        backend.step(step, rho_inv[step], dX[step])
+
+        # Accumulate at least a few g/cm2 for energy loss steps
+        # to avoid numerical errors
+        dXaccum += dX[step]
+
+        if (enmuloss and
+                (dXaccum > muloss_min_step or step == nsteps - 1)):
+            phc = backend.get_phi()
+            for mu_idx in mu_idcs:
+                phc[mu_idx] = np.interp(
+                    mu_egrid, mu_egrid + mu_dEdX * dXaccum, phc[mu_idx])
+            backend.set_phi(phc)
+
+            dXaccum = 0.
+
+        at_grid = False
+        if (grid_idcs and grid_step < len(grid_idcs)
+                and grid_idcs[grid_step] == step):
+            if store_grid is True:
+                grid_sol.append(np.copy(backend.get_phi()))
+            elif store_grid:
+                store_grid.store(grid_step, backend.get_phi())
+            grid_step += 1
+            at_grid = True
+
+        if observers:
+            for every, func in observers:
+                if (at_grid and every == 0) or (every > 0 and
+                                                (step + 1) % every == 0):
+                    func(step, backend.get_phi())
+
+    print "Performance: {0:6.2f}ms/iteration".format(
+        1e3 * (time() - start) / float(max(1, stop_step - start_step)))
+
+    phi = backend.finish()
+    if checkpoint is not None:
+        checkpoint(stop_step, phi, dXaccum, grid_sol)
+
+    return phi, grid_sol
+
+
+@register_backend
+class NumpyBackend(KernelBackend):
+    """:mod:`numpy` implementation, works with all matrix formats of
+    :func:`MCEq.kernels.convert_matrix`."""
+
+    name = 'numpy'
+    priority = 0
+    dense = True
+    matrix_formats = None
+    first_interaction = True
+    active_set = True
+    source_terms = True
+
+    def setup(self, session, phi, fa_vars=None):
+        from MCEq.kernels import _block_coupling
+
+        self.imc, self.dmc = session.int_m, session.dec_m
+        self.phc = phi.astype(session.fl_pr, copy=False)
+        self.fa_vars = fa_vars
+
+        # Active set of the state vector. By default all elements are active.
+        self.act_set = config['active_set']
+        self.idcs = slice(None)
+        self.ima, self.dma = self.imc, self.dmc
+        if self.act_set['enabled']:
+            self.bounds = session.block_bounds
+            self.int_coupl = _block_coupling(self.imc, self.bounds)
+            self.dec_coupl = _block_coupling(self.dmc, self.bounds)
+
+    def _update_active_set(self, step):
+        from MCEq.kernels import _active_set, _submatrix
+
+        fa_vars = self.fa_vars
+        # Interactions stop to couple species after max_step
+        # in the first interaction mode
+        coupl = self.dec_coupl
+        if not (config['first_interaction_mode'] and
+                step > fa_vars['max_step']):
+            coupl = self.dec_coupl | self.int_coupl
+        idcs = _active_set(self.phc, self.bounds, coupl,
+                           self.act_set['threshold'])
+        if idcs.size == self.phc.size:
+            self.idcs = slice(None)
+            self.ima, self.dma = self.imc, self.dmc
+        else:
+            self.idcs = idcs
+            self.ima = _submatrix(self.imc, idcs)
+            self.dma = _submatrix(self.dmc, idcs)
+        if dbg > 2:
+            print("NumpyBackend::step(): step {0}, active set size {1}/{2}"
+                  ).format(step, self.phc[self.idcs].size, self.phc.size)
+
+    def step(self, step, rho_inv, dX):
+        fa_vars = self.fa_vars
+
+        if self.act_set['enabled'] and (
+                step % self.act_set['recheck_steps'] == 0 or
+            (config['first_interaction_mode'] and
+             step == fa_vars['max_step'] + 1)):
+            self._update_active_set(step)
+
+        idcs, ima, dma = self.idcs, self.ima, self.dma
+        phc = self.phc[idcs]
+
+        # Implmentation of first interaction mode
+        if not config['first_interaction_mode']:
+            delta = ima.dot(phc) + dma.dot(rho_inv * phc)
+        elif step <= fa_vars['max_step']:
+            delta = (- fa_vars['Lambda_int'][idcs] * phc
+                     + ima.dot(fa_vars['fi_switch'][step][idcs] * phc)
+                     + dma.dot(rho_inv * phc))
+        else:
+            # Equivalent of setting interaction matrix to 0
+            delta = (- fa_vars['Lambda_int'][idcs] * phc
+                     + dma.dot(rho_inv * phc))
+
+        if self.source_hook is not None:
+            self.source_hook(step, self.phc, delta, idcs, rho_inv, dX)
+
+        self.phc[idcs] += delta * dX
+
+    def get_phi(self):
+        return self.phc
+
+    def set_phi(self, phi):
+        if phi is not self.phc:
+            self.phc[:] = phi
+
+
+@register_backend
+class MKLBackend(KernelBackend):
+    """Intel MKL inspector-executor sparse BLAS, see
+    :class:`MCEq.kernels.MKLSparseContext`."""
+
+    name = 'MKL'
+    priority = 20
+
+    @classmethod
+    def available(cls):
+        from ctypes import cdll
+        try:
+            cdll.LoadLibrary(config['MKL_path'])
+            return True
+        except OSError:
+            return False
+
+    def setup(self, session, phi, fa_vars=None):
+        from MCEq.kernels import MKLSparseContext
+
+        self.ctx = self._context(
+            session, lambda: MKLSparseContext(session.int_m, session.dec_m))
+        self.ctx.set_phi(phi)
+
+    def step(self, step, rho_inv, dX):
+        self.ctx.do_step(rho_inv, dX)
+
+    def get_phi(self):
+        return self.ctx.phi
+
+    def set_phi(self, phi):
+        if phi is not self.ctx.phi:
+            self.ctx.set_phi(phi)
+
+    def finish(self):
+        return self.ctx.get_phi()
+
+
+def _find_module(name):
+    """Returns ``True`` if the (dotted) module ``name`` can be imported,
+    without importing it."""
+    import imp
+    path = None
+    try:
+        for part in name.split('.'):
+            f, fname, _ = imp.find_module(part, path)
+            if f is not None:
+                f.close()
+            path = [fname]
+    except ImportError:
+        return False
+    return True
+
+
+def _cuda_available():
+    return _find_module('accelerate.cuda')
+
+
+@register_backend
+class CUDASparseBackend(KernelBackend):
+    """NVIDIA cuSPARSE, see :class:`MCEq.kernels.CUDASparseContext`.
+
+    Options:
+      device_id (int): id of the GPU
+    """
+
+    name = 'CUDA'
+    priority = 30
+
+    @classmethod
+    def available(cls):
+        return _cuda_available()
+
+    def setup(self, session, phi, fa_vars=None):
+        from MCEq.kernels import CUDASparseContext
+
+        self.ctx = self._context(
+            session, lambda: CUDASparseContext(
+                session.int_m, session.dec_m,
+                device_id=self.options.get('device_id', 0)))
+        self.ctx.set_phi(phi)
+
+    def step(self, step, rho_inv, dX):
+        self.ctx.do_step(rho_inv, dX)
+
+    def get_phi(self):
+        # Download current solution vector to host
+        return self.ctx.get_phi()
+
+    def set_phi(self, phi):
+        # Upload changed vector back..
+        self.ctx.set_phi(phi)
+
+
+@register_backend
+class CUDADenseBackend(KernelBackend):
+    """NVIDIA cuBLAS with dense matrices. Typically slower than the
+    sparse backends, but it depends on your hardware."""
+
+    name = 'CUDA'
+    priority = 5
+    sparse = False
+    dense = True
+    energy_loss = False
+
+    @classmethod
+    def available(cls):
+        return _cuda_available()
+
+    def setup(self, session, phi, fa_vars=None):
+        #=======================================================================
+        # Setup GPU stuff and upload data to it
+        #=======================================================================
+        try:
+            from accelerate.cuda.blas import Blas
+            from accelerate.cuda import cuda
+        except ImportError:
+            raise Exception("CUDADenseBackend(): Numbapro CUDA libaries " +
+                            "not installed.\nCan not use GPU.")
+        fl_pr = self.fl_pr = session.fl_pr
+        self.cuda = cuda
+        self.cubl = Blas()
+        self.m, self.n = session.int_m.shape
+        stream = cuda.stream()
+        self.cu_int_m = cuda.to_device(session.int_m, stream)
+        self.cu_dec_m = cuda.to_device(session.dec_m, stream)
+        self.cu_curr_phi = cuda.to_device(phi.astype(fl_pr), stream)
+        self.cu_delta_phi = cuda.device_array(phi.shape, dtype=fl_pr)
+
+    def step(self, step, rho_inv, dX):
+        fl_pr, m, n = self.fl_pr, self.m, self.n
+        self.cubl.gemv(trans='N', m=m, n=n, alpha=fl_pr(1.0),
+                       A=self.cu_int_m, x=self.cu_curr_phi, beta=fl_pr(0.0),
+                       y=self.cu_delta_phi)
+        self.cubl.gemv(trans='N', m=m, n=n, alpha=fl_pr(rho_inv),
+                       A=self.cu_dec_m, x=self.cu_curr_phi, beta=fl_pr(1.0),
+                       y=self.cu_delta_phi)
+        self.cubl.axpy(alpha=fl_pr(dX), x=self.cu_delta_phi,
+                       y=self.cu_curr_phi)
+
+    def get_phi(self):
+        return self.cu_curr_phi.copy_to_host()
+
+    def set_phi(self, phi):
+        self.cu_curr_phi = self.cuda.to_device(phi.astype(self.fl_pr))
+
+
+@register_backend
+class XeonPhiBackend(KernelBackend):
+    """Experimental Xeon Phi support using pyMIC library. The complete
+    integration loop runs on the device."""
+
+    name = 'MIC'
+    priority = -10
+    energy_loss = False
+    grid_output = False
+    fused_loop = True
+
+    @classmethod
+    def available(cls):
+        import sys
+        import os
+        pymic_path = os.path.join(os.path.expanduser("~"), 'work/git/pymic')
+        if pymic_path not in sys.path:
+            sys.path.append(pymic_path)
+        return _find_module('pymic')
+
+    def setup(self, session, phi, fa_vars=None):
+        import os
+        import pymic as mic
+
+        # load the library with the kernel function (on the target)
+        device = mic.devices[1]
+        base = os.path.dirname(os.path.abspath(__file__))
+        self.library = device.load_library(
+            os.path.join(base, "../Xeon_Phi/libmceq.so"))
+        # use the default stream
+        self.stream = device.get_default_stream()
+        self.int_m, self.dec_m = session.int_m, session.dec_m
+        self.npphi = np.copy(phi)
+
+    def run(self, nsteps, dX, rho_inv):
+        stream = self.stream
+        int_m, dec_m = self.int_m, self.dec_m
+
+        # Prepare CTYPES pointers for MKL sparse CSR BLAS
+        mic_int_m_data = stream.bind(int_m.data)
+        mic_int_m_ci = stream.bind(int_m.indices)
+        mic_int_m_pb = stream.bind(int_m.indptr[:-1])
+        mic_int_m_pe = stream.bind(int_m.indptr[1:])
+
+        mic_dec_m_data = stream.bind(dec_m.data)
+        mic_dec_m_ci = stream.bind(dec_m.indices)
+        mic_dec_m_pb = stream.bind(dec_m.indptr[:-1])
+        mic_dec_m_pe = stream.bind(dec_m.indptr[1:])
+
+        self.mic_phi = stream.bind(self.npphi)
+        npdelta_phi = np.zeros_like(self.npphi)
+        mic_delta_phi = stream.bind(npdelta_phi)
+        mic_dX = stream.bind(dX)
+        mic_rho_inv = stream.bind(rho_inv)
+
+        stream.invoke(self.library.mceq_kernel,
+                      int_m.shape[0], nsteps,
+                      self.mic_phi, mic_delta_phi,
+                      mic_rho_inv, mic_dX,
+                      mic_int_m_data, mic_int_m_ci,
+                      mic_int_m_pb, mic_int_m_pe,
+                      mic_dec_m_data, mic_dec_m_ci,
+                      mic_dec_m_pb, mic_dec_m_pe)
+        stream.sync()
+
+    def get_phi(self):
+        return self.npphi
+
+    def finish(self):
+        self.mic_phi.update_host()
+        self.stream.sync()
+        return self.mic_phi.array
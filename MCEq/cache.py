@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`MCEq.cache` --- caches on disk and in memory
+==================================================
+
+Building the matrices of :class:`MCEq.core.MCEqRun` takes seconds to
+tens of seconds, although the inputs rarely change. This module stores
+such results on disk, keyed by a fingerprint of all inputs.
+
+- :func:`fingerprint` hashes (nested) configuration values
+- :func:`file_checksum` returns the checksum of a data file, which is
+  computed once per file version
+- :func:`save_arrays` and :func:`load_arrays` store arrays uncompressed
+  in ``.npy`` files, which are memory-mapped when loading
+- :class:`LRUCache` keeps recently used objects, e.g. interaction
+  models, in memory up to a size limit
+- :class:`FileLock` serializes the creation of files between processes
+"""
+
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+from hashlib import sha1
+from mceq_config import dbg
+
+
+def _canonical(obj):
+    """Returns a representation of ``obj`` independent of the order
+    of dictionaries and sets."""
+    if isinstance(obj, dict):
+        return '{' + ','.join(
+            sorted(_canonical(k) + ':' + _canonical(v)
+                   for k, v in obj.items())) + '}'
+    elif isinstance(obj, (set, frozenset)):
+        return '{' + ','.join(sorted(_canonical(v) for v in obj)) + '}'
+    elif isinstance(obj, (list, tuple)):
+        return '[' + ','.join(_canonical(v) for v in obj) + ']'
+    elif isinstance(obj, np.ndarray):
+        return sha1(np.ascontiguousarray(obj).tostring()).hexdigest()
+    return repr(obj)
+
+
+def fingerprint(*items):
+    """Returns a sha1 hex digest of configuration values.
+
+    Args:
+      items: values, lists, tuples, dictionaries or arrays
+    Returns:
+      (str): hex digest
+    """
+    return sha1(_canonical(items)).hexdigest()
+
+
+def sha1_file(fname):
+    """Returns the sha1 hex digest of the content of a file."""
+    h = sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_checksum(fname, cache_dir):
+    """Returns the sha1 checksum of a file.
+
+    The checksums are stored in ``checksums.json`` in ``cache_dir``
+    together with the size and modification time of the files, such
+    that each version of a file is read only once.
+
+    Args:
+      fname (str): file name
+      cache_dir (str): directory of the checksum table
+    Returns:
+      (str): hex digest, or ``None`` if the file does not exist
+    """
+    if not os.path.isfile(fname):
+        return None
+
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    table_fname = os.path.join(cache_dir, 'checksums.json')
+    table = {}
+    if os.path.isfile(table_fname):
+        try:
+            table = json.load(open(table_fname))
+        except ValueError:
+            table = {}
+
+    entry = table.get(fname)
+    if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+        return str(entry[2])
+
+    checksum = sha1_file(fname)
+
+    # The table is only an optimization, failures to store it are ignored
+    try:
+        with FileLock(table_fname):
+            if os.path.isfile(table_fname):
+                try:
+                    table = json.load(open(table_fname))
+                except ValueError:
+                    pass
+            table[fname] = [stat.st_size, stat.st_mtime, checksum]
+            tmp_fname = table_fname + '.tmp{0}'.format(os.getpid())
+            with open(tmp_fname, 'w') as f:
+                json.dump(table, f, indent=1)
+            os.rename(tmp_fname, table_fname)
+    except (IOError, OSError), e:
+        if dbg > 0:
+            print "file_checksum(): cannot store checksum table:", e
+
+    return checksum
+
+
+def save_arrays(dirname, arrays, meta=None):
+    """Stores arrays as uncompressed ``.npy`` files in the directory
+    ``dirname``. The directory is written under a temporary name
+    and renamed, such that readers never see incomplete entries.
+    An existing entry is kept.
+
+    Args:
+      dirname (str): directory of the entry
+      arrays (dict): arrays by name
+      meta (dict,optional): additional information, stored as json
+    """
+    import shutil
+
+    tmp_dirname = dirname + '.tmp{0}'.format(os.getpid())
+    if os.path.isdir(tmp_dirname):
+        shutil.rmtree(tmp_dirname)
+    os.makedirs(tmp_dirname)
+
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp_dirname, name + '.npy'),
+                np.ascontiguousarray(arr))
+    with open(os.path.join(tmp_dirname, 'meta.json'), 'w') as f:
+        json.dump(meta or {}, f)
+
+    # Another process might have stored the same entry in the meantime
+    if not os.path.isdir(dirname):
+        try:
+            os.rename(tmp_dirname, dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    if os.path.isdir(tmp_dirname):
+        shutil.rmtree(tmp_dirname)
+        return
+
+    if dbg > 1:
+        print "save_arrays(): stored {0} arrays in {1}".format(
+            len(arrays), dirname)
+
+
+def load_arrays(dirname, mmap_mode='r'):
+    """Loads the arrays of :func:`save_arrays`.
+
+    Args:
+      dirname (str): directory of the entry
+      mmap_mode (str,optional): memory-map mode of :func:`numpy.load`,
+        ``None`` to read the arrays into memory
+    Returns:
+      (tuple): dictionary of arrays and meta data, or ``None`` if the
+      entry does not exist
+    """
+    meta_fname = os.path.join(dirname, 'meta.json')
+    if not os.path.isfile(meta_fname):
+        return None
+
+    meta = json.load(open(meta_fname))
+    arrays = {}
+    for fname in os.listdir(dirname):
+        if fname.endswith('.npy'):
+            arrays[fname[:-4]] = np.load(
+                os.path.join(dirname, fname), mmap_mode=mmap_mode)
+
+    return arrays, meta
+
+
+def nbytes(obj):
+    """Estimates the memory of arrays, sparse matrices and containers
+    of those in bytes. Memory-mapped arrays and other objects are not
+    counted.
+
+    Args:
+      obj (object): array, sparse matrix, dictionary, list, tuple or
+        :class:`MCEq.data.BlendedYields`
+    Returns:
+      (int): size in bytes
+    """
+    from MCEq.data import BlendedYields
+
+    if isinstance(obj, np.memmap):
+        # The pages belong to the file and are shared between processes
+        return 0
+    elif isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, BlendedYields):
+        return nbytes(obj.blended) + nbytes(obj.assigned)
+    elif hasattr(obj, 'indptr'):
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    elif isinstance(obj, dict):
+        return sum(nbytes(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(nbytes(v) for v in obj)
+    return 0
+
+
+class LRUCache(object):
+    """Keeps objects in memory until their total size exceeds
+    ``max_bytes``. Then, the least recently used objects are evicted.
+
+    Args:
+      max_bytes (int): size limit in bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the object stored under ``key`` and marks it as the most
+        recently used, or ``None`` if there is no such entry."""
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        value, size = self.entries.pop(key)
+        self.entries[key] = (value, size)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size=None):
+        """Stores ``value`` under ``key`` and evicts the least recently used
+        entries, until the size limit is met.
+
+        Args:
+          key (object): hashable key
+          value (object): object to store
+          size (int,optional): size in bytes, estimated with :func:`nbytes`
+            if not given
+        Returns:
+          (bool): ``False`` if the object alone exceeds the limit
+        """
+        if size is None:
+            size = nbytes(value)
+        self.pop(key)
+        if size > self.max_bytes:
+            return False
+
+        self.entries[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            old_key, (_, old_size) = self.entries.popitem(last=False)
+            self.nbytes -= old_size
+            self.evictions += 1
+            if dbg > 1:
+                print "LRUCache::put(): evicted {0}".format(old_key)
+        return True
+
+    def pop(self, key):
+        """Removes the entry ``key`` without counting an eviction."""
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+
+    def clear(self):
+        """Removes all entries. The statistics are kept."""
+        self.entries.clear()
+        self.nbytes = 0
+
+    def info(self):
+        """Returns the statistics of the cache.
+
+        Returns:
+          (dict): ``keys``, ``nbytes``, ``max_bytes``, ``hits``, ``misses``
+          and ``evictions``
+        """
+        return {
+            'keys': list(self.entries.keys()),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class FileLock(object):
+    """Exclusive lock between processes, which is held while a file is
+    created. Use as context manager::
+
+        with FileLock(fname):
+            if not os.path.isfile(fname):
+                create(fname)
+
+    The lock is a POSIX record lock (:func:`fcntl.lockf`) of the file
+    ``fname + '.lock'``, which also works on NFS. The lock files are not
+    removed. On systems without :mod:`fcntl` the lock has no effect.
+
+    Args:
+      fname (str): name of the protected file
+    """
+
+    def __init__(self, fname):
+        self.fname = fname + '.lock'
+        self._f = None
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:
+            return self
+
+        dirname = os.path.dirname(self.fname)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created by another process
+                pass
+
+        self._f = open(self.fname, 'a')
+        if dbg > 1:
+            print "FileLock::__enter__(): waiting for", self.fname
+        fcntl.lockf(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self._f is None:
+            return
+        import fcntl
+        fcntl.lockf(self._f, fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
@@ -27,6 +27,8 @@ import numpy as np
 from time import time
 from mceq_config import dbg, config
 from MCEq.misc import print_in_rows, normalize_hadronic_model_name
+from MCEq.backends import integrate
+from MCEq.cache import LRUCache
 
 
 class MCEqRun(object):
@@ -60,6 +62,9 @@ class MCEqRun(object):
       adv_set (dict): advanced settings, see :mod:`mceq_config`
       obs_ids (list): list of particle name strings. Those lepton decay
         products will be scored in the special ``obs_`` categories
+      e_range (tuple, optional): energy window (E_min, E_max) in GeV, to
+        which the energy grid is restricted (see ``e_range`` in :mod:`mceq_config`)
+      target_solutions (list, optional): see :func:`set_target_solutions`
     """
 
     def __init__(self, interaction_model, density_model, primary_model,
@@ -67,6 +72,7 @@ class MCEqRun(object):
 
         from ParticleDataTool import SibyllParticleTable, PYTHIAParticleData
         from MCEq.data import DecayYields, InteractionYields, HadAirCrossSections
+        from MCEq.data_utils import prepare_data_files
 
         interaction_model = normalize_hadronic_model_name(interaction_model)
         self.cname = self.__class__.__name__
@@ -75,21 +81,30 @@ class MCEqRun(object):
         self.density_config = density_model
         self.theta_deg = theta_deg
 
+        #: (tuple) energy window (E_min, E_max) of the calculation in GeV
+        self.e_range = kwargs.get('e_range', config['e_range'])
+
+        # Decompress and convert missing data files concurrently
+        if interaction_model is not None:
+            prepare_data_files([interaction_model])
+
         # Load particle production yields
-        self.yields_params = dict(interaction_model=interaction_model)
+        self.yields_params = dict(
+            interaction_model=interaction_model, e_range=self.e_range)
         #: handler for decay yield data of type :class:`MCEq.data.InteractionYields`
         self.y = InteractionYields(**self.yields_params)
         # Interaction matrices initialization flag
         self.iam_mat_initialized = False
         # Load decay spectra
         self.ds_params = dict(
-            mother_list=self.y.particle_list, )
+            mother_list=self.y.particle_list, e_window=self.y.e_window)
 
         #: handler for decay yield data of type :class:`MCEq.data.DecayYields`
         self.ds = DecayYields(**self.ds_params)
 
         # Load cross-section handling
-        self.cs_params = dict(interaction_model=interaction_model)
+        self.cs_params = dict(
+            interaction_model=interaction_model, e_range=self.e_range)
         #: handler for cross-section data of type :class:`MCEq.data.HadAirCrossSections`
         self.cs = HadAirCrossSections(**self.cs_params)
 
@@ -110,6 +125,46 @@ class MCEqRun(object):
         # First interaction mode
         self.fa_vars = None
 
+        #: (list) names of solutions (see :func:`get_solution`) the state
+        #: vector is reduced to, see :func:`set_target_solutions`
+        self.target_solutions = None
+        # Matrices, index tables and buffers of the kernels
+        self._session = None
+        # Contexts of the kernel backends (loaded libraries, devices)
+        self._kernel_contexts = {}
+        # Session of the lepton subsystem and surface states of
+        # propagate_to_target(), valid for the session they were made with
+        self._lepton_session = (None, None)
+        self._surface_cache = (None, {})
+        # Recently used interaction models, see set_interaction_model()
+        self._model_cache = LRUCache(
+            config['model_cache']['max_memory_mb'] * 1024**2)
+        #: (dict) last checkpoint of the forward-euler integration,
+        #: see :func:`save_checkpoint`
+        self.checkpoint = None
+        #: (list) tuples (name, reducer) evaluated during the integration,
+        #: see :func:`add_reducer`
+        self.reducers = []
+        #: (dict) results of the reducers of the last integration by name
+        self.reductions = {}
+        #: (dict) depths in g/cm**2 of the :attr:`reductions`
+        self.reduction_X = {}
+        #: (object) production depth histograms of the integration, see
+        #: :func:`set_production_depth`
+        self.production_depth = None
+        #: (tuple) stored species and memory map file of :attr:`grid_sol`,
+        #: see :func:`set_grid_storage`
+        self.grid_storage = (None, None)
+        #: (tuple) species and memory map file of the dense output,
+        #: see :func:`set_dense_output`
+        self.dense_output = (None, None)
+        # States after each step and depths of the dense output
+        self.dense_sol = None
+        self.dense_X = None
+        #: (str) storage format of the matrices in the numpy kernel,
+        #: see :func:`autotune_matrix_format`
+        self.matrix_format = config['matrix_format']
+
         # Default GPU device id for CUDA
         self.cuda_device = kwargs['GPU_id'] if 'GPU_id' in kwargs else 0
 
@@ -154,6 +209,9 @@ class MCEqRun(object):
         if primary_model is not None:
             self.set_primary_model(*self.pm_params)
 
+        if kwargs.get('target_solutions'):
+            self.set_target_solutions(kwargs['target_solutions'])
+
     def _init_dimensions_and_particle_tables(self, particle_list=None):
 
         if particle_list == None:
@@ -191,10 +249,10 @@ class MCEqRun(object):
         # Further short-cuts depending on previous initializations
         self.n_tot_species = len(self.cascade_particles)
 
-        self.dim_states = self.d * self.n_tot_species
+        self.dim_states = self.cascade_particles[-1].uidx()
 
-        self.e_weight = np.array(
-            self.n_tot_species * list(self.y.e_bins[1:] - self.y.e_bins[:-1]))
+        self.e_weight = np.hstack(
+            [self.e_widths[p.e_lidx:] for p in self.cascade_particles])
 
         self.solution = np.zeros(self.dim_states)
 
@@ -211,25 +269,17 @@ class MCEqRun(object):
         # Muon energy loss
         import cPickle as pickle
         from os.path import join
+        lidx, uidx = self.y.e_window
         self.mu_dEdX = pickle.load(
             open(join(config['data_dir'], config['mu_eloss_fname']),
-                 'rb')).astype(self.fl_pr) * 1e-3  # ... to GeV
-        # Left index of first muon species and number of
-        # muon species including aliases
-        # Find first muon species in the list
-        #(muons have inices next to each other but may start from a different category)
-        min_id = 100000
-
-        min_id_pl = min([
-            self.pdg2pref[mu_id].lidx()
-            for mu_id in [13, 7013, 7113, 7213, 7313]
-        ])
-        min_id_mi = min([
-            self.pdg2pref[-mu_id].lidx()
-            for mu_id in [13, 7013, 7113, 7213, 7313]
-        ])
-
-        self.mu_lidx_nsp = (min(min_id_mi, min_id_pl), 10)
+                 'rb'))[lidx:uidx].astype(self.fl_pr) * 1e-3  # ... to GeV
+        # Index ranges of all muon species including aliases
+        # in the state vector
+        self.mu_idcs = [
+            slice(self.pdg2pref[sign * mu_id].lidx(),
+                  self.pdg2pref[sign * mu_id].uidx())
+            for mu_id in [13, 7013, 7113, 7213, 7313] for sign in [1, -1]
+        ]
 
     def _gen_list_of_particles(self, custom_list=None, max_density=1.240e-03):
         """Determines the list of particles for calculation and
@@ -290,8 +340,15 @@ class MCEqRun(object):
         cascade_particles = [p for p in particle_list if not p.is_resonance]
         resonances = [p for p in particle_list if p.is_resonance]
 
+        offset = 0
         for nceidx, h in enumerate(cascade_particles):
             h.nceidx = nceidx
+            # Mixed particles behave as resonances below E_mix, where their
+            # rows and columns in the matrices are empty
+            if config['variable_block_size'] and h.is_mixed:
+                h.e_lidx = h.mix_idx
+            h.offset = offset
+            offset = h.uidx()
 
         return cascade_particles + resonances, cascade_particles, resonances
 
@@ -343,8 +400,10 @@ class MCEqRun(object):
 
         :math:`\\boldsymbol{\\Lambda_{int}} = (1/\\lambda_{int,0},...,1/\\lambda_{int,N})`
         """
-        self.Lambda_int = np.hstack(
-            [p.inverse_interaction_length() for p in self.cascade_particles])
+        self.Lambda_int = np.hstack([
+            p.inverse_interaction_length()[p.e_lidx:]
+            for p in self.cascade_particles
+        ])
 
     def _init_Lambda_dec(self):
         """Initializes the decay length vector according to the order
@@ -354,7 +413,8 @@ class MCEqRun(object):
         :math:`\\boldsymbol{\\Lambda_{dec}} = (1/\\lambda_{dec,0},...,1/\\lambda_{dec,N})`
         """
         self.Lambda_dec = np.hstack([
-            p.inverse_decay_length(self.e_grid) for p in self.cascade_particles
+            p.inverse_decay_length(self.e_grid)[p.e_lidx:]
+            for p in self.cascade_particles
         ])
         self.max_ldec = np.max(self.Lambda_dec)
 
@@ -370,7 +430,6 @@ class MCEqRun(object):
         except UnboundLocalError:
             from scipy.sparse import csr_matrix
 
-        from MCEq.kernels import CUDASparseContext
         if dbg > 0:
             print(self.cname + "::_convert_to_sparse():" +
                   "Converting to sparse (CSR) matrix format.")
@@ -380,12 +439,126 @@ class MCEqRun(object):
         if not self.iam_mat_initialized or not skip_D_matrix:
             self.dec_m = csr_matrix(self.dec_m)
 
-        if config['kernel_config'] == 'CUDA':
-            try:
-                self.cuda_context.set_matrices(self.int_m, self.dec_m)
-            except AttributeError:
-                self.cuda_context = CUDASparseContext(
-                    self.int_m, self.dec_m, device_id=self.cuda_device)
+    def _matrix_cache_dir(self):
+        """Returns the directory of the matrix cache."""
+        from os.path import join
+        return join(config['data_dir'], config['matrix_cache']['cache_dir'])
+
+    def _matrix_settings(self):
+        """Returns the entries of :mod:`mceq_config` which affect the
+        matrices."""
+        return dict((key, config[key]) for key in [
+            'compact_mode', 'hybrid_crossover', 'first_interaction_mode',
+            'use_isospin_sym', 'low_energy_extension', 'variable_block_size',
+            'e_range', 'FP_precision', 'A_target', 'decay_fname', 'cs_fname'
+        ])
+
+    def _matrix_cache_key(self):
+        """Returns the fingerprint of all inputs of the matrices, including
+        the checksums of the data files, or ``None`` if the matrix cache
+        is not used.
+
+        Returns:
+          (str): hex digest
+        """
+        if not config['matrix_cache']['enabled'] or not config['use_sparse']:
+            return None
+        # Modified particle production is used for many variations
+        if any(self.y.mod_pprod.values()):
+            return None
+
+        from MCEq.cache import fingerprint, file_checksum
+
+        cache_dir = self._matrix_cache_dir()
+        settings = self._matrix_settings()
+        particles = [(p.name, p.lidx(), p.uidx(), p.is_mixed, p.is_resonance)
+                     for p in self.cascade_particles]
+        checksums = [
+            file_checksum(fname, cache_dir)
+            for fname in (self.y.fname, self.ds.fname, self.cs.fname)
+        ]
+
+        # The x_F band (InteractionYields.set_xf_band) modifies the yields
+        return fingerprint(self.yields_params, self.cs_params, self.ds_params,
+                           self.adv_set, self.obs_ids, settings, particles,
+                           checksums, self.y.band)
+
+    def _load_cached_matrices(self, key):
+        """Loads :attr:`int_m` and :attr:`dec_m` from the matrix cache.
+        The arrays are memory-mapped.
+
+        Args:
+          key (str): fingerprint from :func:`_matrix_cache_key`
+        Returns:
+          (bool): ``True`` if the matrices were found
+        """
+        import shutil
+        from os.path import join
+        from scipy.sparse import csr_matrix
+        from MCEq.cache import load_arrays
+
+        entry = load_arrays(join(self._matrix_cache_dir(), key))
+        if entry is None:
+            return False
+        arrays, meta = entry
+
+        # Consistency check of the particle tables and Lambda vectors
+        if (meta.get('dim_states') != self.dim_states or
+                meta.get('particles') != [[p.name, p.lidx(), p.uidx()]
+                                          for p in self.cascade_particles]
+                or not np.allclose(arrays['Lambda_int'], self.Lambda_int)
+                or not np.allclose(arrays['Lambda_dec'], self.Lambda_dec)):
+            if dbg > 0:
+                print(self.cname + "::_load_cached_matrices(): " +
+                      "inconsistent cache entry {0}, rebuilding.").format(key)
+            # Existing entries are not replaced by save_arrays
+            shutil.rmtree(join(self._matrix_cache_dir(), key),
+                          ignore_errors=True)
+            return False
+
+        shape = (self.dim_states, self.dim_states)
+        for mname in ['int_m', 'dec_m']:
+            setattr(self, mname, csr_matrix(
+                (arrays[mname + '_data'], arrays[mname + '_indices'],
+                 arrays[mname + '_indptr']),
+                shape=shape,
+                copy=False))
+
+        if dbg > 0:
+            print(self.cname + "::_load_cached_matrices(): " +
+                  "matrices loaded from cache {0}").format(key)
+        return True
+
+    def _store_cached_matrices(self, key):
+        """Stores :attr:`int_m`, :attr:`dec_m`, the particle tables and the
+        Lambda vectors in the matrix cache.
+
+        Args:
+          key (str): fingerprint from :func:`_matrix_cache_key`
+        """
+        from os.path import join
+        from MCEq.cache import save_arrays
+
+        arrays = {
+            'Lambda_int': self.Lambda_int,
+            'Lambda_dec': self.Lambda_dec
+        }
+        for mname in ['int_m', 'dec_m']:
+            mat = getattr(self, mname)
+            arrays[mname + '_data'] = mat.data
+            arrays[mname + '_indices'] = mat.indices
+            arrays[mname + '_indptr'] = mat.indptr
+        meta = {
+            'dim_states': self.dim_states,
+            'particles': [[p.name, p.lidx(), p.uidx()]
+                          for p in self.cascade_particles],
+            'interaction_model': self.yields_params['interaction_model'],
+        }
+        try:
+            save_arrays(join(self._matrix_cache_dir(), key), arrays, meta)
+        except (IOError, OSError), e:
+            print(self.cname + "::_store_cached_matrices(): " +
+                  "could not write cache: {0}").format(e)
 
     def _init_default_matrices(self, skip_D_matrix=False):
         """Constructs the matrices for calculation.
@@ -411,30 +584,38 @@ class MCEqRun(object):
             "::_init_default_matrices():Start filling matrices. Skip_D_matrix = {0}"
         ).format(skip_D_matrix if self.iam_mat_initialized else False)
 
-        self._fill_matrices(skip_D_matrix=skip_D_matrix
-                            if self.iam_mat_initialized else False)
+        # Matrices passed to the kernels have to be derived again
+        self._session = None
 
-        # interaction part
-        # -I + C
-        if not config['first_interaction_mode']:
-            self.C[np.diag_indices(self.dim_states)] -= 1.
-            self.int_m = (self.C * self.Lambda_int).astype(self.fl_pr)
+        cache_key = self._matrix_cache_key()
+        if cache_key is None or not self._load_cached_matrices(cache_key):
+            self._fill_matrices(skip_D_matrix=skip_D_matrix
+                                if self.iam_mat_initialized else False)
 
-        else:
-            self.int_m = (self.C * self.Lambda_int).astype(self.fl_pr)
+            # interaction part
+            # -I + C
+            if not config['first_interaction_mode']:
+                self.C[np.diag_indices(self.dim_states)] -= 1.
+                self.int_m = (self.C * self.Lambda_int).astype(self.fl_pr)
 
-        del self.C
+            else:
+                self.int_m = (self.C * self.Lambda_int).astype(self.fl_pr)
 
-        if not self.iam_mat_initialized or not skip_D_matrix:
-            # decay part
-            # -I + D
-            self.D[np.diag_indices(self.dim_states)] -= 1.
-            self.dec_m = (self.D * self.Lambda_dec).astype(self.fl_pr)
+            del self.C
+
+            if not self.iam_mat_initialized or not skip_D_matrix:
+                # decay part
+                # -I + D
+                self.D[np.diag_indices(self.dim_states)] -= 1.
+                self.dec_m = (self.D * self.Lambda_dec).astype(self.fl_pr)
 
-            del self.D
+                del self.D
+
+            if config['use_sparse']:
+                self._convert_to_sparse(skip_D_matrix)
 
-        if config['use_sparse']:
-            self._convert_to_sparse(skip_D_matrix)
+            if cache_key is not None:
+                self._store_cached_matrices(cache_key)
 
         if dbg > 0:
             int_m_density = (
@@ -458,6 +639,10 @@ class MCEqRun(object):
 
         print self.cname + "::_init_default_matrices():Done filling matrices."
 
+        if (config['autotune']['enabled'] and config['use_sparse'] and
+                config['kernel_config'] == 'numpy'):
+            self.autotune_matrix_format()
+
     def _init_progress_bar(self, maximum):
         """Initializes the progress bar.
 
@@ -545,7 +730,8 @@ class MCEqRun(object):
                      particle_name,
                      mag=0.,
                      grid_idx=None,
-                     integrate=False):
+                     integrate=False,
+                     X=None):
         """Retrieves solution of the calculation on the energy grid.
 
         Some special prefixes are accepted for lepton names:
@@ -572,44 +758,502 @@ class MCEqRun(object):
             not specified the flux at the surface is returned
           integrate (bool, optional): return averge particle number instead of
           flux (multiply by bin width)
+          X (float, optional): depth in g/cm**2, at which the solution is
+            interpolated, if dense output is enabled (see :func:`set_dense_output`)
 
         Returns:
           (numpy.array): flux of particles on energy grid :attr:`e_grid`
         """
-        # Account for the
-
         res = np.zeros(self.d)
         ref = self.pname2pref
         sol = None
-        if grid_idx is None:
+        if X is not None:
+            sol = self._dense_state(X)
+        elif grid_idx is None:
             sol = self.solution
         elif grid_idx >= len(self.grid_sol):
             sol = self.grid_sol[-1]
         else:
             sol = self.grid_sol[grid_idx]
 
+        for pname in self._solution_components(particle_name):
+            e_lidx = ref[pname].e_lidx
+            res[e_lidx:] += sol[ref[pname].lidx():ref[pname].uidx()] * \
+                self.e_grid[e_lidx:] ** mag
+
+        if not integrate:
+            return res
+        else:
+            return res * self.e_widths
+
+    def _solution_components(self, particle_name):
+        """Returns the names of the species which are summed up for
+        the solution ``particle_name`` in :func:`get_solution`.
+
+        Args:
+          particle_name (str): name of the solution, e.g. ``total_numu``
+        Returns:
+          (list of str): names of particle species
+        """
         if particle_name.startswith('total'):
             lep_str = particle_name.split('_')[1]
-            for prefix in ('pr_', 'pi_', 'k_', ''):
-                particle_name = prefix + lep_str
-                res += sol[ref[particle_name].lidx():
-                           ref[particle_name].uidx()] * \
-                    self.e_grid ** mag
+            return [prefix + lep_str for prefix in ('pr_', 'pi_', 'k_', '')]
         elif particle_name.startswith('conv'):
             lep_str = particle_name.split('_')[1]
-            for prefix in ('pi_', 'k_', ''):
-                particle_name = prefix + lep_str
-                res += sol[ref[particle_name].lidx():
-                           ref[particle_name].uidx()] * \
-                    self.e_grid ** mag
+            return [prefix + lep_str for prefix in ('pi_', 'k_', '')]
         else:
-            res = sol[ref[particle_name].lidx():
-                      ref[particle_name].uidx()] * \
-                self.e_grid ** mag
-        if not integrate:
-            return res
-        else:
-            return res * self.e_widths
+            return [particle_name]
+
+    def add_reducer(self, name, reducer):
+        """Registers a reducer, which is evaluated during the forward-euler
+        integration. Its results are stored in :attr:`reductions` and the
+        corresponding depths in :attr:`reduction_X`. If reducers are
+        registered, the state vectors on the ``int_grid`` are not stored
+        in :attr:`grid_sol` by default.
+
+        Args:
+          name (str): name of the result
+          reducer (object): instance of :class:`MCEq.reducers.Reducer`,
+            e.g. :class:`MCEq.reducers.SolutionReducer`
+        """
+        self.remove_reducer(name)
+        self.reducers.append((name, reducer))
+
+    def remove_reducer(self, name=None):
+        """Removes the reducer ``name``, or all reducers if ``None``."""
+        self.reducers = [(rname, reducer) for rname, reducer in self.reducers
+                         if name is not None and rname != name]
+
+    def set_production_depth(self, particle_names, X_edges=None):
+        """Enables the histograms of the production depth of the particles
+        ``particle_names``, which are filled during the integration.
+
+        The histograms contain the particles produced in interactions
+        and decays in each depth bin, and are retrieved with
+        :func:`get_production_depth`. Requires the numpy kernel.
+
+        Args:
+          particle_names (list of str): names accepted by :func:`get_solution`,
+            e.g. ``['pi_numu', 'k_numu']``, or ``None`` to disable
+          X_edges (numpy.array): edges of the depth bins in g/cm**2
+        """
+        from MCEq.reducers import ProductionDepth
+
+        if particle_names is None:
+            self.production_depth = None
+            return
+
+        for sol_name in particle_names:
+            for pname in self._solution_components(sol_name):
+                if pname not in self.pname2pref:
+                    raise Exception(
+                        self.cname + "::set_production_depth(): " +
+                        "Unknown solution {0}.".format(sol_name))
+
+        self.production_depth = ProductionDepth(particle_names, X_edges)
+
+    def get_production_depth(self, particle_name, mag=0., integrate=False):
+        """Returns the production depth histogram of the last integration.
+
+        Args:
+          particle_name (str): one of the names of :func:`set_production_depth`
+          mag (float, optional): the histogram is multiplied by :math:`E^{mag}`
+          integrate (bool, optional): multiply by the bin widths
+        Returns:
+          (tuple): edges of the depth bins in g/cm**2, histogram with
+          shape (depth bins, :attr:`d`)
+        """
+        pdepth = self.production_depth
+        if pdepth is None or particle_name not in pdepth.hist:
+            raise Exception(self.cname + "::get_production_depth(): " +
+                            "no histogram for {0}.".format(particle_name))
+
+        res = pdepth.hist[particle_name] * self.e_grid**mag
+        if integrate:
+            res = res * self.e_widths
+        return pdepth.X_edges, res
+
+    def set_target_solutions(self, target_solutions):
+        """Restricts the calculation to the species, which the requested
+        solutions depend on.
+
+        All species which can not contribute to any of the ``target_solutions``
+        via interactions or decays are removed from the state vector and
+        the matrices before the integration. The results are mapped back
+        to the full state vector, such that :func:`get_solution` works as
+        usual. Solutions of removed species are zero.
+
+        Args:
+          target_solutions (list of str): names accepted by :func:`get_solution`,
+            e.g. ``['total_numu', 'total_mu+']``, or ``None`` to solve for
+            all species
+        """
+        if target_solutions is not None:
+            for sol_name in target_solutions:
+                for pname in self._solution_components(sol_name):
+                    if pname not in self.pname2pref:
+                        raise Exception(
+                            self.cname + "::set_target_solutions(): " +
+                            "Unknown solution {0}.".format(sol_name))
+
+        self.target_solutions = target_solutions
+        self._session = None
+
+    def _target_state_indices(self):
+        """Returns the state vector indices of all species, which can
+        reach the species of :attr:`target_solutions` through the
+        interaction or decay matrix.
+
+        Returns:
+          (numpy.array): sorted indices in the state vector
+        """
+        from MCEq.kernels import _block_coupling
+
+        bounds = np.array([p.lidx() for p in self.cascade_particles] +
+                          [self.dim_states])
+        coupling = (_block_coupling(self.int_m, bounds) |
+                    _block_coupling(self.dec_m, bounds))
+
+        required = np.zeros(self.n_tot_species, dtype='bool')
+        for sol_name in self.target_solutions:
+            for pname in self._solution_components(sol_name):
+                required[self.pname2pref[pname].nceidx] = True
+
+        # Walk upwards through the chains of mothers
+        while True:
+            mothers = required | np.any(coupling[required, :], axis=0)
+            if np.all(mothers == required):
+                break
+            required = mothers
+
+        if dbg > 0:
+            print(self.cname + "::_target_state_indices(): removing " +
+                  "{0} species not contributing to {1}:").format(
+                      self.n_tot_species - np.sum(required),
+                      ', '.join(self.target_solutions))
+            print_in_rows([
+                p.name for p in self.cascade_particles
+                if not required[p.nceidx]
+            ])
+
+        return np.hstack([
+            np.arange(p.lidx(), p.uidx()) for p in self.cascade_particles
+            if required[p.nceidx]
+        ]).astype('int32')
+
+    def _get_session(self):
+        """Returns the :class:`MCEq.kernels.SolverSession`, which holds the
+        matrices, index tables, kernel contexts and work buffers for
+        the integration.
+
+        The session is created once and reused by all calls of
+        :func:`solve`, until the matrices are regenerated, or the
+        target solutions are changed.
+
+        Returns:
+          (object): instance of :class:`MCEq.kernels.SolverSession`
+        """
+        if self._session is None:
+            self._session = self._create_session()
+
+        return self._session
+
+    def _create_session(self, idcs=None):
+        """Creates a :class:`MCEq.kernels.SolverSession`.
+
+        Args:
+          idcs (numpy.array,optional): solve only these elements of the
+            state vector, see :func:`_solver_matrices`
+        Returns:
+          (object): instance of :class:`MCEq.kernels.SolverSession`
+        """
+        from MCEq.kernels import SolverSession
+
+        idcs, int_m, dec_m, mu_idcs, block_bounds = self._solver_matrices(
+            config['state_ordering'], idcs)
+
+        if config['active_set']['enabled'] and block_bounds is None:
+            raise Exception(
+                self.cname + "::_get_session(): The active set " +
+                "requires a state ordering, which keeps species contiguous.")
+
+        if config['use_sparse'] and self.matrix_format != 'csr':
+            from MCEq.kernels import convert_matrix
+            int_m = convert_matrix(int_m, self.matrix_format, block_bounds,
+                                   self.d)
+            dec_m = convert_matrix(dec_m, self.matrix_format, block_bounds,
+                                   self.d)
+
+        return SolverSession(idcs, int_m, dec_m, mu_idcs, block_bounds,
+                             self.dim_states, self._kernel_contexts)
+
+    def _solver_matrices(self, ordering=None, idcs=None):
+        """Reduces the state vector to the :attr:`target_solutions` and
+        reorders it according to ``ordering``.
+
+        Args:
+          ordering (str): state ordering, see :func:`_state_permutation`
+          idcs (numpy.array,optional): keep only these elements of the
+            state vector (in addition to the reduction)
+        Returns:
+          (tuple): (state vector indices or ``None`` if the full state
+          vector is solved in the original order, interaction matrix,
+          decay matrix, list of muon index ranges, boundaries of the
+          species blocks or ``None`` if species are not contiguous)
+        """
+        from MCEq.kernels import _submatrix
+
+        keep = idcs
+        idcs = np.arange(self.dim_states, dtype='int32')
+        if self.target_solutions:
+            idcs = self._target_state_indices()
+        if keep is not None:
+            idcs = np.intersect1d(idcs, keep).astype('int32')
+
+        if ordering:
+            idcs = idcs[self._state_permutation(idcs, ordering)]
+
+        if np.array_equal(idcs, np.arange(self.dim_states)):
+            block_bounds = np.array(
+                [p.lidx() for p in self.cascade_particles] + [self.dim_states])
+            return None, self.int_m, self.dec_m, self.mu_idcs, block_bounds
+
+        int_m = _submatrix(self.int_m, idcs)
+        dec_m = _submatrix(self.dec_m, idcs)
+
+        # Translate muon ranges to the new state vector,
+        # removed species are skipped
+        new_idx = -np.ones(self.dim_states, dtype='int32')
+        new_idx[idcs] = np.arange(idcs.size)
+        mu_idcs = []
+        for mu_idx in self.mu_idcs:
+            mu_new = new_idx[mu_idx]
+            if np.any(mu_new < 0):
+                continue
+            if np.all(np.diff(mu_new) == 1):
+                mu_idcs.append(slice(mu_new[0], mu_new[-1] + 1))
+            else:
+                mu_idcs.append(mu_new)
+
+        # Species blocks can have different lengths
+        blocks = [
+            new_idx[p.lidx():p.uidx()] for p in self.cascade_particles
+            if new_idx[p.lidx()] >= 0
+        ]
+        blocks.sort(key=lambda block: block[0])
+        block_bounds = np.array([0] + [block[-1] + 1 for block in blocks])
+        if not all(
+                np.all(np.diff(block) == 1) and block[0] == block_bounds[i]
+                for i, block in enumerate(blocks)):
+            block_bounds = None
+
+        return idcs, int_m, dec_m, mu_idcs, block_bounds
+
+    def _state_permutation(self, idcs, ordering):
+        """Returns a permutation of the state vector elements ``idcs``,
+        which improves the memory locality of the matrix-vector products.
+
+        Supported orderings are:
+
+        - ``rcm``: reverse Cuthill-McKee ordering of the elements,
+          which minimizes the bandwidth of the matrices
+        - ``energy_major``: elements are sorted by energy and then by
+          species, i.e. the species blocks are interleaved
+        - ``coupling``: species blocks are kept contiguous and sorted by
+          reverse Cuthill-McKee ordering of the species coupling graph,
+          such that strongly coupled species are close to each other
+
+        Args:
+          idcs (numpy.array): indices in the full state vector
+          ordering (str): name of the ordering
+        Returns:
+          (numpy.array): permutation of ``idcs``
+        """
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import reverse_cuthill_mckee
+        from MCEq.kernels import _block_coupling, _submatrix
+
+        if ordering == 'rcm':
+            pattern = csr_matrix(
+                abs(csr_matrix(_submatrix(self.int_m, idcs))) +
+                abs(csr_matrix(_submatrix(self.dec_m, idcs))))
+            return reverse_cuthill_mckee(pattern, symmetric_mode=False)
+
+        # Species and energy grid index of each element in the state vector
+        species = np.hstack([
+            np.repeat(p.nceidx, p.uidx() - p.lidx())
+            for p in self.cascade_particles
+        ])[idcs]
+        energy = np.hstack([
+            np.arange(p.e_lidx, self.d) for p in self.cascade_particles
+        ])[idcs]
+
+        if ordering == 'energy_major':
+            return np.lexsort((species, energy))
+
+        elif ordering == 'coupling':
+            bounds = np.array(
+                [p.lidx() for p in self.cascade_particles] + [self.dim_states])
+            coupling = (_block_coupling(self.int_m, bounds) |
+                        _block_coupling(self.dec_m, bounds))
+            species_order = reverse_cuthill_mckee(
+                csr_matrix((coupling | coupling.T).astype('double')),
+                symmetric_mode=True)
+            rank = np.empty_like(species_order)
+            rank[species_order] = np.arange(species_order.size)
+            return np.lexsort((energy, rank[species]))
+
+        raise Exception(self.cname + "::_state_permutation(): " +
+                        "Unknown state ordering '{0}'.".format(ordering))
+
+    def benchmark_state_ordering(self,
+                                 orderings=('rcm', 'energy_major',
+                                            'coupling'),
+                                 n_iter=100):
+        """Measures the speed of the matrix-vector products for
+        different orderings of the state vector.
+
+        The orderings do not change the number of operations, the
+        difference in speed results from the memory access pattern. As
+        a measure of locality, the bandwidth (maximal distance of a
+        non-zero element from the diagonal) and the mean distance are
+        reported together with the time per iteration.
+
+        Args:
+          orderings (list): names of orderings, see :func:`_state_permutation`
+          n_iter (int): number of repetitions
+        Returns:
+          (dict): ordering -> (bandwidth, mean distance, time per
+          iteration in ms, speed-up relative to the default order)
+        """
+        from scipy.sparse import coo_matrix
+
+        results = {}
+        for ordering in [None] + list(orderings):
+            int_m, dec_m = self._solver_matrices(ordering)[1:3]
+            pattern = coo_matrix(abs(coo_matrix(int_m)) +
+                                 abs(coo_matrix(dec_m)))
+            dist = np.abs(pattern.row - pattern.col)
+            phi = np.random.rand(int_m.shape[0]).astype(self.fl_pr)
+
+            start = time()
+            for _ in xrange(n_iter):
+                int_m.dot(phi) + dec_m.dot(phi)
+            t_iter = 1e3 * (time() - start) / float(n_iter)
+
+            results[ordering] = (np.max(dist), np.mean(dist), t_iter,
+                                 results[None][2] / t_iter
+                                 if ordering else 1.)
+
+        print "{0:>14s} {1:>10s} {2:>10s} {3:>10s} {4:>8s}".format(
+            'ordering', 'bandwidth', 'mean dist', 'ms/iter', 'speed-up')
+        for ordering in [None] + list(orderings):
+            print "{0:>14s} {1:10d} {2:10.1f} {3:10.3f} {4:8.2f}".format(
+                str(ordering), *results[ordering])
+
+        return results
+
+    def autotune_matrix_format(self, formats=None, n_iter=None, force=False):
+        """Selects the fastest storage format of the matrices for the
+        numpy kernel.
+
+        The matrix-vector products of the actual interaction and decay
+        matrices are timed for each of the ``formats``. The result is
+        stored in :attr:`matrix_format` and cached in the file
+        ``autotune['cache_file']`` (see :mod:`mceq_config`), using
+        the fingerprint of the matrices and the machine as key. Later
+        calls with the same matrices on the same machine skip the timing.
+
+        Args:
+          formats (list): candidates, see :func:`MCEq.kernels.convert_matrix`
+          n_iter (int): number of repetitions for each timing
+          force (bool): ignore cached results
+        Returns:
+          (dict): format -> time per iteration in ms
+        """
+        import os
+        import json
+        import platform
+        from MCEq.cache import FileLock
+        from MCEq.data_utils import derived_dir, derived_file
+        from MCEq.kernels import convert_matrix, matrix_fingerprint
+
+        formats = formats or config['autotune']['formats']
+        n_iter = n_iter or config['autotune']['n_iter']
+
+        idcs, int_m, dec_m, mu_idcs, block_bounds = self._solver_matrices(
+            config['state_ordering'])
+
+        key = '_'.join([
+            matrix_fingerprint(int_m, dec_m),
+            platform.node(),
+            platform.machine(),
+            str(config['FP_precision'])
+        ])
+
+        def read_cache(fname):
+            try:
+                return json.load(open(fname))
+            except (IOError, ValueError):
+                return {}
+
+        cache = read_cache(derived_file(config['autotune']['cache_file']))
+
+        if key in cache and not force:
+            self.matrix_format = str(cache[key]['format'])
+            self._session = None
+            if dbg > 0:
+                print(self.cname + "::autotune_matrix_format(): using " +
+                      "cached format '{0}'.").format(self.matrix_format)
+            return cache[key]['timings']
+
+        phi = np.random.rand(int_m.shape[0]).astype(self.fl_pr)
+        timings = {}
+        for fmt in formats:
+            try:
+                imc = convert_matrix(int_m, fmt, block_bounds,
+                                     self.d).astype(self.fl_pr)
+                dmc = convert_matrix(dec_m, fmt, block_bounds,
+                                     self.d).astype(self.fl_pr)
+            except Exception, e:
+                if dbg > 0:
+                    print(self.cname + "::autotune_matrix_format(): " +
+                          "skipping '{0}': {1}").format(fmt, e)
+                continue
+
+            # First call compiles the numba kernels
+            imc.dot(phi) + dmc.dot(phi)
+            start = time()
+            for _ in xrange(n_iter):
+                imc.dot(phi) + dmc.dot(phi)
+            timings[fmt] = 1e3 * (time() - start) / float(n_iter)
+
+        self.matrix_format = min(timings, key=timings.get)
+        self._session = None
+
+        if dbg > 0:
+            print(self.cname + "::autotune_matrix_format(): " + ', '.join(
+                ['{0}: {1:5.3f}ms'.format(fmt, t)
+                 for fmt, t in sorted(timings.items())]) +
+                  " -> '{0}'".format(self.matrix_format))
+
+        # The cache is shared between processes and might not be writable
+        fname = os.path.join(derived_dir(), config['autotune']['cache_file'])
+        try:
+            with FileLock(fname):
+                cache = read_cache(
+                    derived_file(config['autotune']['cache_file']))
+                cache[key] = {'format': self.matrix_format, 'timings': timings}
+                tmp_fname = fname + '.tmp{0}'.format(os.getpid())
+                with open(tmp_fname, 'w') as f:
+                    json.dump(cache, f, indent=2)
+                os.rename(tmp_fname, fname)
+        except (IOError, OSError), e:
+            if dbg > 0:
+                print(self.cname + "::autotune_matrix_format(): cannot " +
+                      "store the result in {0}: {1}").format(fname, e)
+
+        return timings
 
     def set_obs_particles(self, obs_ids):
         """Adds a list of mother particle strings which decay products
@@ -668,17 +1312,82 @@ class MCEqRun(object):
 
         self.yields_params['interaction_model'] = interaction_model
         self.yields_params['charm_model'] = charm_model
+        self.cs_params['interaction_model'] = interaction_model
 
-        self.y.set_interaction_model(interaction_model)
-        self.y._inject_custom_charm_model(charm_model)
+        model_key = self._model_cache_key(interaction_model, charm_model)
+        if force and model_key is not None:
+            self._model_cache.pop(model_key)
 
-        self.cs_params['interaction_model'] = interaction_model
-        self.cs.set_interaction_model(interaction_model)
+        if not self._restore_model(model_key):
+            self.y.set_interaction_model(interaction_model)
+            self.y._inject_custom_charm_model(charm_model)
+
+            self.cs.set_interaction_model(interaction_model)
+
+            # Initialize default run
+            self._init_Lambda_int()
+            self._init_Lambda_dec()
+            self._init_projectiles()
+
+            # initialize matrices
+            self._init_default_matrices(skip_D_matrix=True)
+
+            self._store_model(model_key)
+
+        self.iam_mat_initialized = True
+
+        if self.delay_pmod_init:
+            self.delay_pmod_init = False
+            self.set_primary_model(*self.pm_params)
 
-        # Initialize default run
-        self._init_Lambda_int()
-        self._init_Lambda_dec()
+    def set_le_transition(self, he_le_transition=None, nbins_interp=None):
+        """Changes the transition between the high and the low energy
+        interaction model and rebuilds the interaction matrix.
 
+        The settings ``he_le_transition`` and ``nbins_interp`` of
+        ``low_energy_extension`` in :mod:`mceq_config` are updated. Requires
+        ``blend_in_memory``, such that the yields of both models stay in
+        memory and no files are read or written during scans of the
+        transition.
+
+        Args:
+          he_le_transition (float,optional): transition energy in GeV
+          nbins_interp (int,optional): number of bins of the transition
+        Raises:
+          Exception: if the transition region is not within the energy grid
+        """
+        from MCEq.data import BlendedYields
+        from MCEq.data_utils import le_blend_weights
+
+        if not isinstance(self.y.yields, BlendedYields):
+            raise Exception(
+                self.cname + "::set_le_transition(): requires the " +
+                "low energy extension with blend_in_memory.")
+
+        le_ext = config['low_energy_extension']
+        if he_le_transition is None:
+            he_le_transition = le_ext['he_le_transition']
+        if nbins_interp is None:
+            nbins_interp = le_ext['nbins_interp']
+
+        # Validate the settings before they are applied
+        le_blend_weights(self.y.yields.e_grid, he_le_transition, nbins_interp)
+        le_ext['he_le_transition'] = he_le_transition
+        le_ext['nbins_interp'] = nbins_interp
+
+        if dbg:
+            print(self.cname + "::set_le_transition(): {0} GeV, {1} " +
+                  "bins").format(le_ext['he_le_transition'],
+                                 le_ext['nbins_interp'])
+
+        self._init_default_matrices(skip_D_matrix=True)
+        self._store_model(
+            self._model_cache_key(self.yields_params['interaction_model'],
+                                  self.yields_params['charm_model']))
+
+    def _init_projectiles(self):
+        """Assigns the secondaries of the interaction model to the
+        projectiles."""
         for p in self.particle_species:
             if p.pdgid in self.y.projectiles:
                 p.is_projectile = True
@@ -690,14 +1399,97 @@ class MCEqRun(object):
             else:
                 p.is_projectile = False
 
-        # initialize matrices
-        self._init_default_matrices(skip_D_matrix=True)
+    def _model_cache_key(self, interaction_model, charm_model):
+        """Returns the key of the interaction model in the model cache,
+        or ``None`` if the model cache is not used."""
+        if not config['model_cache']['enabled']:
+            return None
+        # Matrices with modified particle production are not stored
+        if any(self.y.mod_pprod.values()):
+            return None
 
-        self.iam_mat_initialized = True
+        from MCEq.cache import fingerprint
+
+        # The yields depend on the energy window and the x_F band of the
+        # InteractionYields instance, the compact mode and the low energy
+        # extension (including the transition). The layout of the matrices
+        # depends on the particle table, e.g. after set_density_model().
+        particles = [(p.name, p.lidx(), p.uidx(), p.is_mixed, p.is_resonance)
+                     for p in self.cascade_particles]
+        return (interaction_model, charm_model,
+                fingerprint(self.adv_set, self.obs_ids, self._matrix_settings(),
+                            config['use_sparse'], self.y.band, self.y.e_range,
+                            config['compact_mode'],
+                            config['low_energy_extension'], particles,
+                            self.dim_states))
+
+    def _store_model(self, key):
+        """Stores the yields, cross sections and the interaction matrix of
+        the current interaction model in the model cache."""
+        if key is None:
+            return
 
-        if self.delay_pmod_init:
-            self.delay_pmod_init = False
-            self.set_primary_model(*self.pm_params)
+        # The charm models replace entries of the yield dictionaries
+        y_state = dict(self.y.__dict__)
+        for attr in ['mod_pprod', 'band', 'xmat']:
+            del y_state[attr]
+        # Blended yields share their matrices, see BlendedYields.copy
+        y_state['yields'] = self.y.yields.copy()
+        y_state['secondary_dict'] = dict(
+            (proj, list(sec)) for proj, sec in self.y.secondary_dict.items())
+
+        entry = {
+            'y': y_state,
+            'cs': dict(self.cs.__dict__),
+            'Lambda_int': self.Lambda_int,
+            'int_m': self.int_m
+        }
+        if not self._model_cache.put(key, entry) and dbg > 0:
+            print(self.cname + "::_store_model(): model {0} exceeds the " +
+                  "memory limit of the model cache.").format(key[:2])
+
+    def _restore_model(self, key):
+        """Restores an interaction model from the model cache, without
+        loading files or rebuilding the matrices.
+
+        Returns:
+          (bool): ``True`` if the model was found
+        """
+        if key is None:
+            return False
+        entry = self._model_cache.get(key)
+        if entry is None:
+            return False
+
+        self.y.__dict__.update(entry['y'])
+        self.y.yields = entry['y']['yields'].copy()
+        self.y.secondary_dict = dict(
+            (proj, list(sec))
+            for proj, sec in entry['y']['secondary_dict'].items())
+        self.cs.__dict__.update(entry['cs'])
+
+        self.Lambda_int = entry['Lambda_int']
+        self._init_projectiles()
+        self.int_m = entry['int_m']
+        self._session = None
+
+        if dbg > 0:
+            print(self.cname + "::_restore_model(): model {0} restored " +
+                  "from the model cache.").format(key[:2])
+        return True
+
+    def model_cache_info(self):
+        """Returns the statistics of the cache of interaction models, see
+        ``model_cache`` in :mod:`mceq_config`.
+
+        Returns:
+          (dict): cached models as (interaction model, charm model), their
+          estimated memory in bytes, the memory limit, and the number of
+          hits, misses and evictions
+        """
+        info = self._model_cache.info()
+        info['keys'] = [key[:2] for key in info['keys']]
+        return info
 
     def set_primary_model(self, mclass, tag):
         """Sets primary flux model.
@@ -978,21 +1770,24 @@ class MCEqRun(object):
             dprop = self._zero_mat()
             self.ds.assign_d_idx(r[p].pdgid, idcs, r[d].pdgid, r[d].hadridx(),
                                  dprop)
+            # Blocks in the state vector can start above the lowest energy
+            # bin (see ``variable_block_size``). They always end at d.
+            dpmat = dprop.dot(pprod_mat)[:, r[p_orig].e_lidx:]
             alias = self._alias(p, d)
 
             # Check if combination of mother and daughter has a special alias
             # assigned and the index has not be replaced (i.e. pi, K, prompt)
             if not alias:
                 propmat[r[d].lidx():r[d].uidx(), r[p_orig].lidx():r[p_orig]
-                        .uidx()] += dprop.dot(pprod_mat)
+                        .uidx()] += dpmat[r[d].e_lidx:]
             else:
                 propmat[alias[0]:alias[1], r[p_orig].lidx():r[p_orig]
-                        .uidx()] += dprop.dot(pprod_mat)
+                        .uidx()] += dpmat[self.d - alias[1] + alias[0]:]
 
             alt_score = self._alternate_score(p, d)
             if alt_score:
                 propmat[alt_score[0]:alt_score[1], r[p_orig].lidx():r[p_orig]
-                        .uidx()] += dprop.dot(pprod_mat)
+                        .uidx()] += dpmat[self.d - alt_score[1] + alt_score[0]:]
 
             if dbg > 2:
                 pstr = 'res'
@@ -1076,7 +1871,8 @@ class MCEqRun(object):
                                             p.hadridx(), pref[s].pdgid,
                                             pref[s].hadridx(), cmat)
                     self.C[pref[s].lidx():pref[s].uidx(),
-                           p.lidx():p.uidx()] += cmat
+                           p.lidx():p.uidx()] += cmat[pref[s].e_lidx:,
+                                                      p.e_lidx:]
 
                 cmat = self._zero_mat()
                 self.y.assign_yield_idx(p.pdgid,
@@ -1098,6 +1894,9 @@ class MCEqRun(object):
         :func:`MCEqRun._forward_euler` or, solvers from ODEPACK
         :func:`MCEqRun._odepack`.
 
+        Interrupted forward-euler integrations can be continued with
+        ``solve(resume=True)``, see :func:`MCEqRun._forward_euler`.
+
         Args:
           kwargs (dict): Arguments are passed directly to the solver methods.
 
@@ -1116,6 +1915,128 @@ class MCEqRun(object):
                 ("MCEq::solve(): Unknown integrator selection '{0}'."
                  ).format(config['integrator']))
 
+    def surface_state(self):
+        """Returns the state vector at the end of the integration path of
+        the current atmosphere and zenith angle.
+
+        The state is computed with :func:`solve` on the first call and cached
+        per atmosphere, zenith angle and initial condition, until the
+        matrices are regenerated. The results of previous calls of
+        :func:`solve` (solution, grid, reductions, dense output and
+        checkpoint) are kept.
+
+        Returns:
+          (numpy.array): state vector at the surface
+        """
+        from hashlib import sha1
+        from MCEq.density_profiles import EarthAtmosphere
+
+        if not isinstance(self.density_model, EarthAtmosphere):
+            raise Exception(
+                self.cname + "::surface_state(): requires an atmosphere as " +
+                "density model, not {0}.".format(
+                    self.density_model.__class__.__name__))
+
+        if self._surface_cache[0] is not self._get_session():
+            self._surface_cache = (self._get_session(), {})
+        cache = self._surface_cache[1]
+
+        key = (str(self.density_config), self.density_model.theta_deg,
+               sha1(np.ascontiguousarray(self.phi0).tostring()).hexdigest())
+        if key not in cache:
+            # Solve without grid, observers and checkpoint file, and
+            # restore the state of the caller afterwards
+            saved = dict((attr, self.__dict__.get(attr)) for attr in [
+                'solution', 'grid_sol', 'int_grid', 'grid_var',
+                'integration_path', 'reducers', 'reductions', 'reduction_X',
+                'production_depth', 'dense_output', 'dense_sol', 'dense_X',
+                'checkpoint'
+            ])
+            self.reducers, self.reductions, self.reduction_X = [], {}, {}
+            self.production_depth = None
+            self.dense_output = (None, None)
+            try:
+                self.solve(write_checkpoint=False)
+                cache[key] = np.copy(self.solution)
+            finally:
+                self.__dict__.update(saved)
+        elif dbg > 0:
+            print(self.cname + "::surface_state(): using cached state " +
+                  "for {0}, theta = {1}").format(*key[:2])
+
+        return cache[key]
+
+    def propagate_to_target(self,
+                            target,
+                            int_grid=None,
+                            leptons_only=False,
+                            grid_var='X'):
+        """Propagates the particles at the surface through a target below
+        the atmosphere, e.g. rock, ice or water.
+
+        The initial condition is the state vector at the surface
+        (see :func:`surface_state`), which is computed once per
+        atmosphere and zenith angle. Only the target leg is solved
+        again if the target changes. The same matrices as for the
+        atmosphere are used, as well as the muon energy loss table
+        ``mu_eloss_fname``. The atmosphere stays the active density
+        model, but :attr:`solution` and :attr:`grid_sol` (and hence
+        :func:`get_solution`) refer to the target afterwards.
+
+        To compute the fluxes at several depths in a target use::
+
+            target = GeneralizedTarget()
+            target.set_length(2.5e5)
+            target.add_material(0., 0.917, 'ice')
+            mceq_run.propagate_to_target(target, int_grid=X_grid)
+
+        Args:
+          target (object): instance of
+            :class:`MCEq.density_profiles.GeneralizedTarget`
+          int_grid (list): depths in the target in g/cm**2 (or positions in cm
+            for ``grid_var='l'``), at which results are recorded
+          leptons_only (bool): solve only the lepton part of the system.
+            Hadrons from the surface are discarded, which is a good
+            approximation a few meters below the surface.
+          grid_var (str): grid variable, ``X`` or ``l``
+        """
+        surface = self.surface_state()
+
+        if dbg > 0:
+            print(self.cname + "::propagate_to_target(): propagating " +
+                  "through {0:5.1f} g/cm2").format(target.max_X)
+
+        # The checkpoint of the atmosphere is kept, the target leg is
+        # not checkpointed
+        atm_state = (self.density_model, self.density_config,
+                     self.integration_path, self.int_grid, self.grid_var,
+                     self.fa_vars, self.phi0, self.checkpoint, self._session)
+        try:
+            self.density_model = target
+            self.density_config = ('GeneralizedTarget', None)
+            self.integration_path = None
+            self.phi0 = surface
+            if leptons_only:
+                self._session = self._get_lepton_session(atm_state[-1])
+            self._forward_euler(int_grid=int_grid, grid_var=grid_var,
+                                write_checkpoint=False)
+        finally:
+            (self.density_model, self.density_config, self.integration_path,
+             self.int_grid, self.grid_var, self.fa_vars, self.phi0,
+             self.checkpoint, self._session) = atm_state
+
+    def _get_lepton_session(self, session):
+        """Returns the session of the lepton subsystem, which belongs to
+        the session ``session`` of the complete system."""
+        if self._lepton_session[0] is not session or session is None:
+            lep_idcs = np.concatenate([
+                np.arange(p.lidx(), p.uidx()) for p in self.cascade_particles
+                if p.is_lepton
+            ])
+            self._lepton_session = (session,
+                                    self._create_session(lep_idcs))
+        return self._lepton_session[1]
+
     def _odepack(self,
                  dXstep=1.,
                  initial_depth=0.0,
@@ -1222,20 +2143,166 @@ class MCEqRun(object):
         self.solution = r.y
         self.grid_sol = grid_sol
 
-    def _forward_euler(self, int_grid=None, grid_var='X'):
-        """Solves the transport equations with solvers from :mod:`MCEq.kernels`.
+    def get_backend(self, grid_output=False, source_terms=False):
+        """Returns the integration backend for the current settings.
+
+        The backend ``kernel_config`` from :mod:`mceq_config` is used, if it
+        is available and supports the settings. Otherwise the fastest
+        available backend is selected, see :func:`MCEq.backends.select_backend`.
+
+        Args:
+          grid_output (bool): solutions on a depth grid are requested
+          source_terms (bool): production depth histograms are requested
+        Returns:
+          (object): instance of :class:`MCEq.backends.KernelBackend`
+        """
+        from MCEq.backends import select_backend
+
+        requirements = {
+            'sparse': config['use_sparse'],
+            'precision': config['FP_precision'],
+            'matrix_format': self.matrix_format,
+            'first_interaction': config['first_interaction_mode'],
+            'energy_loss': config['enable_muon_energy_loss'],
+            'grid_output': grid_output,
+            'active_set': config['active_set']['enabled'],
+            'source_terms': source_terms,
+        }
+
+        return select_backend(
+            requirements, config['kernel_config'], device_id=self.cuda_device)
+
+    def _forward_euler(self, int_grid=None, grid_var='X', X_stop=None,
+                       resume=False, store_grid_sol=None,
+                       write_checkpoint=True):
+        """Solves the transport equations with backends from :mod:`MCEq.backends`.
+
+        The integration can be interrupted at the depth ``X_stop`` and
+        continued later with ``resume=True``. During the integration,
+        checkpoints are stored in :attr:`checkpoint` (and in a file)
+        according to the setting ``checkpoint`` in :mod:`mceq_config`.
+        The integration path (``int_grid``, zenith angle, atmosphere)
+        must not change between the runs.
 
         Args:
           int_grid (list): list of depths at which results are recorded
-          grid_var (str): Can be depth `X` or something else (currently only `X` supported)
+          grid_var (str): grid variable of ``int_grid``, depth ``X`` in
+            g/cm**2, height above surface ``h`` in cm or distance along
+            the path ``l`` in cm, see :func:`_grid_to_X`
+          X_stop (float,optional): stop the integration after the first step,
+            which reaches this depth in g/cm**2. Add ``X_stop`` to
+            ``int_grid`` to stop exactly at this depth.
+          resume (bool or str,optional): continue from :attr:`checkpoint`,
+            or from the checkpoint file with this name
+          store_grid_sol (bool,optional): keep the state vectors at the
+            ``int_grid`` in :attr:`grid_sol`. By default only if no
+            reducers are registered, see :func:`add_reducer`.
+          write_checkpoint (bool,optional): write the checkpoints to the
+            file ``checkpoint['file']`` of :mod:`mceq_config`
 
         """
 
         # Calculate integration path if not yet happened
         self._calculate_integration_path(int_grid, grid_var)
 
-        phi0 = np.copy(self.phi0)
         nsteps, dX, rho_inv, grid_idcs = self.integration_path
+        session = self._get_session()
+        idcs, mu_idcs = session.idcs, session.mu_idcs
+
+        if store_grid_sol is None:
+            store_grid_sol = not self.reducers
+
+        start_step, dXaccum, grid_snapshot = 0, 0., None
+        reductions = dict((name, ([], [])) for name, _ in self.reducers)
+        if resume:
+            if isinstance(resume, str):
+                self.load_checkpoint(resume)
+            start_step, dXaccum, phi_start, grid_snapshot, red0 = \
+                self._check_checkpoint()
+            phi0 = session.project(phi_start)
+            for name in reductions:
+                if name in red0:
+                    reductions[name] = (list(red0[name][0]),
+                                        list(red0[name][1]))
+        else:
+            phi0 = session.project(self.phi0)
+
+        grid_sol = []
+        if store_grid_sol:
+            grid_sol = self._grid_solution(len(grid_idcs), session,
+                                           grid_snapshot)
+
+        # Reducers are evaluated at the depths after the steps
+        X_path = np.cumsum(dX, dtype=np.float64)
+        observers = []
+
+        dense_sol = None
+        if self.dense_output[0] is not None:
+            dense_snapshot = (self.checkpoint.get('dense_sol')
+                              if resume else None)
+            dense_sol = self._grid_solution(nsteps + 1, session,
+                                            dense_snapshot, self.dense_output)
+            if dense_snapshot is None:
+                dense_sol.store(start_step, phi0)
+            observers.append((1, lambda step, phi: dense_sol.store(step + 1,
+                                                                   phi)))
+        for name, reducer in self.reducers:
+            reducer.bind(self, session)
+
+            def observer(step, phi, res=reductions[name], reducer=reducer):
+                res[0].append(X_path[step])
+                res[1].append(reducer(phi))
+
+            observers.append((reducer.every, observer))
+
+        pdepth = self.production_depth
+        if pdepth is not None:
+            pdepth.bind(self, session, dX)
+            if resume:
+                saved = self.checkpoint.get('production_depth', {})
+                for name, hist in saved.items():
+                    pdepth.hist[name][:] = hist
+
+        stop_step = nsteps
+        if X_stop is not None:
+            stop_step = min(nsteps, int(np.searchsorted(
+                np.cumsum(dX), X_stop * (1. - 1e-9))) + 1)
+            if stop_step < start_step:
+                raise Exception(
+                    self.cname + "::_forward_euler(): X_stop = {0} ".format(
+                        X_stop) + "is smaller than the depth of the " +
+                    "checkpoint.")
+
+        ckpt_cfg = config['checkpoint']
+
+        def checkpoint(step, phi, dXaccum, grid_list):
+            self.checkpoint = {
+                'step': step,
+                'X': float(np.sum(dX[:step], dtype=np.float64)),
+                'nsteps': nsteps,
+                'dXaccum': dXaccum,
+                'phi': session.expand(phi),
+                'grid_sol': grid_sol.snapshot() if store_grid_sol else None,
+                'dense_sol': (dense_sol.snapshot()
+                              if dense_sol is not None else None),
+                'reductions': dict((name, (list(res[0]), list(res[1])))
+                                   for name, res in reductions.items()),
+            }
+            if pdepth is not None:
+                self.checkpoint['production_depth'] = dict(
+                    (name, np.copy(hist))
+                    for name, hist in pdepth.hist.items())
+            if ckpt_cfg['file'] is not None and write_checkpoint:
+                self.save_checkpoint(ckpt_cfg['file'])
+
+        fa_vars = self.fa_vars
+        if idcs is not None:
+            if config['first_interaction_mode']:
+                fa_vars = dict(self.fa_vars)
+                fa_vars['Lambda_int'] = self.fa_vars['Lambda_int'][idcs]
+                fa_vars['fi_switch'] = [
+                    fi_switch[idcs] for fi_switch in self.fa_vars['fi_switch']
+                ]
 
         if dbg > 0:
             print("{0}::_forward_euler(): Solver will perform {1} " +
@@ -1246,51 +2313,23 @@ class MCEqRun(object):
 
         start = time()
 
-        import kernels
-        if (config['first_interaction_mode'] and
-                config['kernel_config'] != 'numpy'):
-            raise Exception(self.__class__.__name__ + "::_forward_euler(): " +
-                            + "First interaction mode only works with numpy.")
-
-        if config['kernel_config'] == 'numpy':
-            kernel = kernels.kern_numpy
-            args = (nsteps, dX, rho_inv, self.int_m, self.dec_m, phi0,
-                    grid_idcs, self.e_grid, self.mu_dEdX, self.mu_lidx_nsp,
-                    self.progress_bar, self.fa_vars)
-        elif (config['kernel_config'] == 'CUDA' and
-              config['use_sparse'] is False):
-            kernel = kernels.kern_CUDA_dense
-            args = (nsteps, dX, rho_inv, self.int_m, self.dec_m, phi0,
-                    grid_idcs, self.e_grid, self.mu_dEdX, self.mu_lidx_nsp,
-                    self.progress_bar)
-
-        elif (config['kernel_config'] == 'CUDA' and
-              config['use_sparse'] is True):
-            kernel = kernels.kern_CUDA_sparse
-            args = (nsteps, dX, rho_inv, self.cuda_context, phi0, grid_idcs,
-                    self.e_grid, self.mu_dEdX, self.mu_lidx_nsp,
-                    self.progress_bar)
-
-        elif (config['kernel_config'] == 'MKL' and
-              config['use_sparse'] is True):
-            kernel = kernels.kern_MKL_sparse
-            args = (nsteps, dX, rho_inv, self.int_m, self.dec_m, phi0,
-                    grid_idcs, self.e_grid, self.mu_dEdX, self.mu_lidx_nsp,
-                    self.progress_bar)
-        elif (config['kernel_config'] == 'MIC' and
-              config['use_sparse'] is True):
-            kernel = kernels.kern_XeonPHI_sparse
-            args = (nsteps, dX, rho_inv, self.int_m, self.dec_m, phi0,
-                    grid_idcs, self.e_grid, self.mu_dEdX, self.mu_lidx_nsp,
-                    self.progress_bar)
-        else:
-            raise Exception(self.__class__.__name__ + (
-                "::_forward_euler(): " +
-                "Unsupported integrator settings '{0}/{1}'.").format(
-                    'sparse' if config['use_sparse'] else 'dense',
-                    config['kernel_config']))
-
-        self.solution, self.grid_sol = kernel(*args)
+        backend = self.get_backend(
+            int_grid is not None or bool(observers), pdepth is not None)
+        backend.setup(session, phi0, fa_vars)
+        backend.source_hook = pdepth
+        integrate(backend, nsteps, dX, rho_inv, grid_idcs,
+                  self.e_grid.astype(session.fl_pr), self.mu_dEdX, mu_idcs,
+                  self.progress_bar, start_step, stop_step, dXaccum,
+                  checkpoint, ckpt_cfg['interval'], observers, grid_sol)
+        # The checkpoint at stop_step contains the expanded solution
+        self.solution = self.checkpoint['phi']
+        self.grid_sol = grid_sol
+        self.dense_sol = dense_sol
+        self.dense_X = np.concatenate([[0.], X_path])
+        for name, res in reductions.items():
+            self.reduction_X[name] = np.array(res[0])
+            self.reductions[name] = np.array(res[1])
+        session.n_solves += 1
 
         self.progress_bar.finish()
 
@@ -1298,6 +2337,255 @@ class MCEqRun(object):
             print("\n{0}::_forward_euler(): time elapsed during " +
                   "integration: {1} sec").format(self.cname, time() - start)
 
+    def set_dense_output(self, species, fname=None):
+        """Enables the dense output of the forward-euler integration.
+
+        The state of the selected species is stored after each integration
+        step, and :func:`get_solution` with the argument ``X`` evaluates
+        the solution at arbitrary depths by cubic Hermite interpolation.
+        The slopes are the changes of the state vector per step, which
+        the solver computes anyway. The integration path is not modified,
+        therefore depths can be added without solving again. The memory
+        is proportional to the number of steps, select few species or
+        use a memory map for long integration paths.
+
+        Args:
+          species (list of str): names accepted by :func:`get_solution`,
+            e.g. ``['total_mu+', 'total_mu-']``, or ``None`` to disable
+          fname (str,optional): file name of a memory map for the states
+        """
+        if species is not None:
+            for sol_name in species:
+                for pname in self._solution_components(sol_name):
+                    if pname not in self.pname2pref:
+                        raise Exception(
+                            self.cname + "::set_dense_output(): " +
+                            "Unknown solution {0}.".format(sol_name))
+        self.dense_output = (species, fname)
+
+    def _dense_state(self, X):
+        """Interpolates the state vector at depth ``X`` from the dense
+        output of the last integration.
+
+        Args:
+          X (float): depth in g/cm**2
+        Returns:
+          (numpy.array): state vector, zero for species without dense output
+        """
+        if self.dense_sol is None:
+            raise Exception(self.cname + "::_dense_state(): " +
+                            "dense output not enabled, see set_dense_output().")
+
+        X_nodes = self.dense_X[:len(self.dense_sol)]
+        if not X_nodes[0] <= X <= X_nodes[-1] * (1. + 1e-9):
+            raise Exception(
+                self.cname + "::_dense_state(): X = {0} outside of ".format(X)
+                + "the integrated range [{0}, {1}].".format(
+                    X_nodes[0], X_nodes[-1]))
+        if X_nodes.size == 1:
+            return self.dense_sol[0]
+
+        i = min(int(np.searchsorted(X_nodes, X, side='right')) - 1,
+                X_nodes.size - 2)
+        h = X_nodes[i + 1] - X_nodes[i]
+        t = (X - X_nodes[i]) / h
+
+        phi_0, phi_1 = self.dense_sol[i], self.dense_sol[i + 1]
+        # Slopes: forward differences of the euler steps
+        m_0 = (phi_1 - phi_0) / h
+        if i + 2 < X_nodes.size:
+            m_1 = (self.dense_sol[i + 2] - phi_1) / (
+                X_nodes[i + 2] - X_nodes[i + 1])
+        else:
+            m_1 = m_0
+
+        return ((2 * t**3 - 3 * t**2 + 1) * phi_0 +
+                (t**3 - 2 * t**2 + t) * h * m_0 +
+                (-2 * t**3 + 3 * t**2) * phi_1 + (t**3 - t**2) * h * m_1)
+
+    def set_grid_storage(self, species=None, fname=None):
+        """Configures the storage of the solutions on the ``int_grid``.
+
+        The solutions are written during the integration into a
+        preallocated :class:`MCEq.kernels.GridSolution`, which can be
+        a memory map on disk. If only some species are stored,
+        :func:`get_solution` returns zeros for the others on the grid.
+
+        Args:
+          species (list of str,optional): names accepted by
+            :func:`get_solution`, e.g. ``['total_mu+', 'total_mu-']``,
+            or ``None`` to store all species
+          fname (str,optional): file name of the memory map, or ``None`` to
+            keep the solutions in memory
+        """
+        if species is not None:
+            for sol_name in species:
+                for pname in self._solution_components(sol_name):
+                    if pname not in self.pname2pref:
+                        raise Exception(
+                            self.cname + "::set_grid_storage(): " +
+                            "Unknown solution {0}.".format(sol_name))
+        self.grid_storage = (species, fname)
+
+    def _grid_solution(self, n_grid, session, snapshot=None, storage=None):
+        """Creates the :class:`MCEq.kernels.GridSolution` for an
+        integration, see :func:`set_grid_storage`.
+
+        Args:
+          n_grid (int): number of grid points
+          session (object): :class:`MCEq.kernels.SolverSession`
+          snapshot (dict,optional): content from a checkpoint
+          storage (tuple,optional): stored species and file name, default
+            :attr:`grid_storage`
+        """
+        from MCEq.kernels import GridSolution
+
+        species, fname = storage if storage else self.grid_storage
+        idcs = None
+        if species is not None:
+            ref = self.pname2pref
+            idcs = np.unique(np.concatenate([
+                np.arange(ref[pname].lidx(), ref[pname].uidx())
+                for sol_name in species
+                for pname in self._solution_components(sol_name)
+            ]))
+
+        # Continue writing the memory map of the checkpoint
+        mode = 'w+'
+        if (snapshot is not None and fname is not None and
+                snapshot.get('fname') == fname):
+            mode = 'r+'
+
+        grid_sol = GridSolution(n_grid, self.dim_states, idcs, session.fl_pr,
+                                fname, mode)
+        grid_sol.bind(session)
+        if snapshot is not None:
+            grid_sol.restore(snapshot)
+        return grid_sol
+
+    def save_checkpoint(self, fname):
+        """Saves :attr:`checkpoint` to a file.
+
+        The file is written to a temporary file first and renamed, such
+        that an interruption while saving does not destroy the previous
+        checkpoint.
+
+        Args:
+          fname (str): file name
+        """
+        import os
+        import cPickle as pickle
+
+        if self.checkpoint is None:
+            raise Exception(self.cname + "::save_checkpoint(): " +
+                            "no checkpoint available.")
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'wb') as f:
+            pickle.dump(self.checkpoint, f, protocol=-1)
+        os.rename(tmp_fname, fname)
+
+        if dbg > 1:
+            print(self.cname + "::save_checkpoint(): step {0}, X = {1:5.2f} " +
+                  "g/cm2 saved to {2}").format(self.checkpoint['step'],
+                                              self.checkpoint['X'], fname)
+
+    def load_checkpoint(self, fname):
+        """Loads :attr:`checkpoint` from a file, created by
+        :func:`save_checkpoint`. Use ``solve(resume=True)`` to continue
+        the integration.
+
+        Args:
+          fname (str): file name
+        """
+        import cPickle as pickle
+
+        with open(fname, 'rb') as f:
+            self.checkpoint = pickle.load(f)
+
+    def _check_checkpoint(self):
+        """Validates :attr:`checkpoint` against the current integration path.
+
+        Returns:
+          tuple: step index, accumulated depth for the muon energy loss,
+          state vector, grid solutions and reductions of the checkpoint
+        """
+        ckpt = self.checkpoint
+        if ckpt is None:
+            raise Exception(self.cname + "::_forward_euler(): " +
+                            "no checkpoint to resume from.")
+        nsteps, dX = self.integration_path[:2]
+        if (ckpt['nsteps'] != nsteps or
+                ckpt['phi'].size != self.dim_states or
+                not np.allclose(ckpt['X'], np.sum(dX[:ckpt['step']]))):
+            raise Exception(self.cname + "::_forward_euler(): " +
+                            "checkpoint does not match the integration path.")
+        if dbg > 0:
+            print(self.cname + "::_forward_euler(): resuming at step " +
+                  "{0}/{1}, X = {2:5.2f} g/cm2").format(ckpt['step'], nsteps,
+                                                       ckpt['X'])
+
+        return (ckpt['step'], ckpt['dXaccum'], ckpt['phi'], ckpt['grid_sol'],
+                ckpt.get('reductions', {}))
+
+    def _grid_to_X(self, grid, grid_var):
+        """Converts an output grid to slant depths with the splines of the
+        density model.
+
+        Supported grid variables are
+
+        - ``X``: slant depth in g/cm**2
+        - ``h``: height above the surface in cm (atmospheres only)
+        - ``l``: distance along the path in cm, counted from the top of the
+          atmosphere, or position in a ``GeneralizedTarget``
+
+        Args:
+          grid (numpy.array): values of the grid variable
+          grid_var (str): name of the grid variable
+        Returns:
+          (numpy.array): slant depths in g/cm**2 in increasing order. Points
+          beyond the end of the path are replaced by a single point at the
+          end.
+        """
+        grid = np.atleast_1d(np.asarray(grid, dtype='double'))
+        is_target = self.density_config[0] == 'GeneralizedTarget'
+
+        if grid_var == 'X':
+            X_grid = grid
+        elif grid_var == 'h' and not is_target:
+            # The spline is only valid between the surface and the top of
+            # the atmosphere
+            h_top = self.density_model.geom.h_atm
+            X_grid = self.density_model.h2X(np.clip(grid, 0., h_top))
+            X_grid[grid <= 0.] = self.density_model.max_X
+            X_grid[grid >= h_top] = 0.
+        elif grid_var == 'l':
+            X_grid = self.density_model.l2X(grid)
+        else:
+            raise NotImplementedError(
+                self.cname + "::_grid_to_X(): grid variable " +
+                "'{0}' not supported for {1}.".format(
+                    grid_var, self.density_config[0]))
+
+        # Points beyond the end of the path are not reached, except for
+        # one at the end
+        max_X = self.density_model.max_X
+        beyond = X_grid >= max_X
+        if np.any((np.diff(X_grid) <= 0.) & ~(beyond[:-1] & beyond[1:])):
+            raise Exception(
+                self.cname + "::_grid_to_X(): the grid has to be ordered " +
+                "along the path (decreasing heights, increasing depths).")
+        if np.any(beyond):
+            if dbg > 0 and np.sum(beyond) > 1:
+                print(self.cname + "::_grid_to_X(): dropped {0} grid points " +
+                      "beyond X = {1:5.1f} g/cm2").format(
+                          np.sum(beyond) - 1, max_X)
+            X_grid = np.append(X_grid[~beyond], max_X)
+        if dbg > 1:
+            print(self.cname + "::_grid_to_X(): {0} = {1} -> X = {2}"
+                  ).format(grid_var, grid, X_grid)
+
+        return X_grid
+
     def _calculate_integration_path(self, int_grid, grid_var, force=False):
 
         if (self.integration_path and np.alltrue(int_grid == self.int_grid) and
@@ -1307,11 +2595,8 @@ class MCEqRun(object):
             return
 
         self.int_grid, self.grid_var = int_grid, grid_var
-        if grid_var != 'X':
-            raise NotImplementedError(
-                'MCEqRun::_calculate_integration_path():' +
-                'choice of grid variable other than the depth X are not possible, yet.'
-            )
+        if int_grid is not None:
+            int_grid = self._grid_to_X(int_grid, grid_var)
 
         max_X = self.density_model.max_X
         ri = self.density_model.r_X2rho
@@ -1425,7 +2710,7 @@ class MCEqRun(object):
             print "Particle matrix indices:"
             some_index = 0
             for p in self.cascade_particles:
-                for i in xrange(self.d):
+                for i in xrange(p.e_lidx, self.d):
                     self.part_str_vec.append(p.name + '_' + str(i))
                     if (dbg):
                         print p.name + '_' + str(i), some_index
@@ -21,7 +21,7 @@ validating data structures:
 
 import numpy as np
 from mceq_config import config, dbg
-from misc import normalize_hadronic_model_name
+from misc import normalize_hadronic_model_name, energy_window
 
 
 class MCEqParticle(object):
@@ -71,6 +71,11 @@ class MCEqParticle(object):
         self.pdgid = pdgid
         #: (int) MCEq ID
         self.nceidx = -1
+        #: (int) position of the particle range in the state vector, if
+        #: ``None`` the range is :attr:`nceidx` * :attr:`d`
+        self.offset = None
+        #: (int) lowest energy grid index, which is part of the state vector
+        self.e_lidx = 0
 
         self.particle_db = particle_db
         self.pythia_db = pythia_db
@@ -110,13 +115,24 @@ class MCEqParticle(object):
         """
         return (0, self.mix_idx)
 
+    def eidx(self):
+        """Returns index range on the energy grid, which is part of
+        the state vector.
+
+        Returns:
+          :func:`tuple` (int,int): range on energy grid
+        """
+        return (self.e_lidx, self.d)
+
     def lidx(self):
         """Returns lower index of particle range in state vector.
 
         Returns:
           (int): lower index in state vector :attr:`MCEqRun.phi`
         """
-        return self.nceidx * self.d
+        if self.offset is None:
+            return self.nceidx * self.d
+        return self.offset
 
     def uidx(self):
         """Returns upper index of particle range in state vector.
@@ -124,7 +140,7 @@ class MCEqParticle(object):
         Returns:
           (int): upper index in state vector :attr:`MCEqRun.phi`
         """
-        return (self.nceidx + 1) * self.d
+        return self.lidx() + self.d - self.e_lidx
 
     def inverse_decay_length(self, E, cut=True):
         """Returns inverse decay length (or infinity (np.inf), if
@@ -254,6 +270,105 @@ class MCEqParticle(object):
 #         i(Ei0)->j(EjN)   .....    i(EiN)->j(EjN)
 
 
+class BlendedYields(object):
+    """Yield matrices of a high energy model, which are extended by a
+    low energy model below ``he_le_transition`` (see
+    ``low_energy_extension`` in :mod:`mceq_config`).
+
+    Behaves like the dictionary of yield matrices. The blended matrices are
+    computed at the first access and cached for the current setting of the
+    transition. The transition can be changed without loading files, which
+    clears the cache. Assigned matrices, e.g. of charm models, replace the
+    blended ones.
+
+    Args:
+      he_yields (dict): yield matrices of the high energy model
+      le_yields (dict): yield matrices of the low energy model
+      e_grid (numpy.array): energy grid of the files
+      e_window (tuple): index range of the matrices on ``e_grid``
+    """
+
+    def __init__(self, he_yields, le_yields, e_grid, e_window):
+        self.he_yields = he_yields
+        self.le_yields = le_yields
+        self.e_grid = e_grid
+        self.e_window = e_window
+        #: (dict) blended matrices of the current transition settings
+        self.blended = {}
+        #: (dict) weights of the models for the current transition settings
+        self.weights = {}
+        #: (dict) matrices which replace the blended ones
+        self.assigned = {}
+
+    def _weights(self):
+        """Returns the weights of both models. The blended matrices of
+        other transition settings are removed."""
+        from MCEq.data_utils import le_blend_weights
+
+        le_ext = config['low_energy_extension']
+        settings = (le_ext['he_le_transition'], le_ext['nbins_interp'])
+        if settings not in self.weights:
+            lidx, uidx = self.e_window
+            weights = tuple(
+                w[lidx:uidx] for w in le_blend_weights(self.e_grid, *settings))
+            self.weights.clear()
+            self.blended.clear()
+            self.weights[settings] = weights
+        return self.weights[settings]
+
+    def __getitem__(self, key):
+        if key in self.assigned:
+            return self.assigned[key]
+        if type(key) is not tuple:
+            return self.he_yields[key]
+        if key not in self.le_yields:
+            # The low energy model doesn't know the process
+            if not config["low_energy_extension"]["use_unknown_cs"]:
+                raise Exception('BlendedYields::__getitem__(): low energy ' +
+                                'model does not contain {0}'.format(key))
+            return self.he_yields[key]
+
+        he_weights, le_weights = self._weights()
+        if key not in self.blended:
+            self.blended[key] = (self.he_yields[key] * he_weights +
+                                 self.le_yields[key] * le_weights)
+        return self.blended[key]
+
+    def __setitem__(self, key, value):
+        self.assigned[key] = value
+
+    def __contains__(self, key):
+        return key in self.assigned or key in self.he_yields
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(set(self.he_yields.keys()) | set(self.assigned.keys()))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def copy(self):
+        """Returns a copy, which shares the matrices and the cache."""
+        other = BlendedYields(self.he_yields, self.le_yields, self.e_grid,
+                              self.e_window)
+        other.blended = self.blended
+        other.weights = self.weights
+        other.assigned = dict(self.assigned)
+        return other
+
+
 class InteractionYields(object):
     """Class for managing the dictionary of interaction yield matrices.
 
@@ -269,10 +384,12 @@ class InteractionYields(object):
     Args:
       interaction_model (str): name of the interaction model
       charm_model (str, optional): name of the charm model
+      e_range (tuple, optional): restricts the energy grid to
+        (E_min, E_max), defaults to the ``e_range`` setting in :mod:`mceq_config`
 
     """
 
-    def __init__(self, interaction_model, charm_model=None):
+    def __init__(self, interaction_model, charm_model=None, e_range=None):
         from collections import defaultdict
 
         #: (str) InterAction Model name
@@ -295,6 +412,10 @@ class InteractionYields(object):
         self.xmat = None
         #: (list) List of particles supported by interaction model
         self.particle_list = []
+        #: (tuple) energy window (E_min, E_max) in GeV
+        self.e_range = e_range if e_range is not None else config['e_range']
+        #: (tuple) index range of the energy window on the original grid
+        self.e_window = None
 
         # If parameters are provided during object creation,
         # load the tables during object creation.
@@ -310,61 +431,50 @@ class InteractionYields(object):
             self._inject_custom_charm_model(charm_model)
 
     def _load(self, interaction_model):
-        """Un-pickles the yields dictionary using the path specified as
+        """Loads the yields dictionary using the path specified as
         ``yield_fname`` in :mod:`mceq_config`.
 
         Class attributes :attr:`e_grid`, :attr:`e_bins`, :attr:`weights`,
-        :attr:`dim` are set here.
+        :attr:`dim` are set here. The format of the uncompressed file is
+        selected by ``data_format``, see :func:`MCEq.data_utils.load_database`.
 
         Raises:
           IOError: if file not found
         """
-        import cPickle as pickle
-        from os.path import join, isfile
-        from MCEq.data_utils import convert_to_compact, extend_to_low_energies
+        from MCEq.data_utils import load_database, blends_in_memory
         if dbg > 1:
             print 'InteractionYields::_load(): entering..'
 
-        # Remove dashes and points in the name
-        iamstr = normalize_hadronic_model_name(interaction_model)
-
-        fname = join(config['data_dir'], iamstr + '_yields.bz2')
-
-        if config['compact_mode'] and config["low_energy_extension"]["enabled"] \
-                and 'DPMJET' not in iamstr:
-            fname = fname.replace('.bz2', '_compact_ledpm.bz2')
-        elif not config['compact_mode'] and config["low_energy_extension"]["enabled"] \
-                and ('DPMJET' not in iamstr):
-            fname = fname.replace('.bz2', '_ledpm.bz2')
-        elif config['compact_mode']:
-            fname = fname.replace('.bz2', '_compact.bz2')
-
-        yield_dict = None
-        if dbg > 0:
-            print 'InteractionYields::_load(): Looking for', fname
-        if not isfile(fname):
-            if config['compact_mode']:
-                convert_to_compact(fname)
-            elif 'ledpm' in fname:
-                extend_to_low_energies(fname=fname)
-            else:
-                raise Exception(
-                    'InteractionYields::_load(): no model file found for' +
-                    interaction_model)
+        #: (str) file with the yields of the current interaction model
+        self.fname, yield_dict = load_database(
+            self._prepare_file(interaction_model), self._decompress)
 
-        if not isfile(fname.replace('.bz2', '.ppd')):
-            self._decompress(fname)
+        e_grid = yield_dict['evec']
+        self.e_window = energy_window(e_grid, self.e_range)
+        lidx, uidx = self.e_window
+        if dbg > 0 and self.e_range is not None:
+            print('InteractionYields::_load(): restricting energy grid ' +
+                  'to bins {0}-{1}').format(lidx, uidx)
 
-        yield_dict = pickle.load(open(fname.replace('.bz2', '.ppd'), 'rb'))
-
-        self.e_grid = yield_dict.pop('evec')
-        self.e_bins = yield_dict.pop('ebins')
-        self.weights = yield_dict.pop('weights')
+        self.e_grid = yield_dict.pop('evec')[lidx:uidx]
+        self.e_bins = yield_dict.pop('ebins')[lidx:uidx + 1]
+        self.weights = yield_dict.pop('weights')[lidx:uidx, lidx:uidx]
         self.iam = normalize_hadronic_model_name(yield_dict.pop('mname'))
         self.projectiles = yield_dict.pop('projectiles')
         self.secondary_dict = yield_dict.pop('secondary_dict')
         self.nspec = yield_dict.pop('nspec')
 
+        self._restrict(yield_dict)
+
+        if blends_in_memory(interaction_model):
+            # The low energy model is blended on demand, see BlendedYields
+            le_model = config['low_energy_extension']['le_model']
+            _, le_dict = load_database(
+                self._prepare_file(le_model), self._decompress)
+            self._restrict(le_dict)
+            yield_dict = BlendedYields(yield_dict, le_dict, e_grid,
+                                       self.e_window)
+
         self.yields = yield_dict
 
         #  = np.diag(self.e_bins[1:] - self.e_bins[:-1])
@@ -375,6 +485,89 @@ class InteractionYields(object):
 
         self._gen_particle_list()
 
+    def _restrict(self, yield_dict):
+        """Restricts the yield matrices to the energy window :attr:`e_window`.
+
+        Args:
+          yield_dict (dict): yield matrices, modified in place
+        """
+        from MCEq.data_utils import is_mapped
+
+        if self.e_range is None:
+            return
+        lidx, uidx = self.e_window
+        for key in yield_dict:
+            if type(key) is tuple:
+                mat = yield_dict[key][lidx:uidx, lidx:uidx]
+                # Views of mapped files are not read before the access
+                yield_dict[key] = mat if is_mapped(mat) else np.copy(mat)
+
+    def _data_file(self, interaction_model):
+        """Returns the name of the compressed yield file of an interaction
+        model for the compact mode and low energy extension settings.
+
+        Args:
+          interaction_model (str): interaction model name
+        Returns:
+          (str): file name with extension ``.bz2``, see
+          :func:`MCEq.data_utils.derived_file`
+        """
+        from MCEq.data_utils import (derived_file, blends_in_memory,
+                                     ledpm_suffix)
+
+        # Remove dashes and points in the name
+        iamstr = normalize_hadronic_model_name(interaction_model)
+
+        fname = iamstr + '_yields.bz2'
+
+        if blends_in_memory(iamstr):
+            # The low energy model is blended in _load
+            if config['compact_mode']:
+                fname = fname.replace('.bz2', '_compact.bz2')
+        elif config['compact_mode'] and config["low_energy_extension"]["enabled"] \
+                and 'DPMJET' not in iamstr:
+            fname = fname.replace('.bz2',
+                                  '_compact' + ledpm_suffix() + '.bz2')
+        elif not config['compact_mode'] and config["low_energy_extension"]["enabled"] \
+                and ('DPMJET' not in iamstr):
+            fname = fname.replace('.bz2', ledpm_suffix() + '.bz2')
+        elif config['compact_mode']:
+            fname = fname.replace('.bz2', '_compact.bz2')
+
+        return derived_file(fname)
+
+    def _prepare_file(self, interaction_model):
+        """Creates the compact or low energy extended yield file, if it
+        does not exist.
+
+        Args:
+          interaction_model (str): interaction model name
+        Returns:
+          (str): name of the uncompressed file (``.ppd``)
+        """
+        from os.path import isfile
+        from MCEq.cache import FileLock
+        from MCEq.data_utils import (convert_to_compact, extend_to_low_energies,
+                                     derived_file)
+
+        fname = self._data_file(interaction_model)
+
+        if dbg > 0:
+            print 'InteractionYields::_load(): Looking for', fname
+        if not isfile(fname):
+            with FileLock(fname):
+                # The file might have been created by another process
+                if not isfile(fname) and config['compact_mode']:
+                    convert_to_compact(fname)
+                elif not isfile(fname) and 'ledpm' in fname:
+                    extend_to_low_energies(fname=fname)
+                elif not isfile(fname):
+                    raise Exception(
+                        'InteractionYields::_load(): no model file found for' +
+                        interaction_model)
+
+        return derived_file(fname.replace('.bz2', '.ppd'))
+
     def _gen_index(self, yield_dict):
         """Generates index of mother-daughter relationships.
 
@@ -469,9 +662,8 @@ class InteractionYields(object):
 
         """
         import os
-        import bz2
-        import cPickle as pickle
-        fcompr = os.path.splitext(fname)[0] + '.bz2'
+        from MCEq.data_utils import load_bz2, dump_pickle, source_file
+        fcompr = source_file(fname)
 
         if not os.path.isfile(fcompr):
             raise IOError(
@@ -484,15 +676,14 @@ class InteractionYields(object):
 
         # Generate index of primary secondary relations and
         # multiply with yields
-        new_dict = self._gen_index(pickle.load(bz2.BZ2File(fcompr)))
+        new_dict = self._gen_index(load_bz2(fcompr))
 
         # Dump the file uncompressed
         if dbg > 1:
             print(
                 self.__class__.__name__ + '::_decompress():: ' + 'Saving to ',
                 fname.replace('.bz2', '.ppd'))
-        pickle.dump(
-            new_dict, open(fname.replace('.bz2', '.ppd'), 'wb'), protocol=-1)
+        dump_pickle(new_dict, fname.replace('.bz2', '.ppd'))
 
     def _gen_mod_matrix(self, x_func, *args):
         """Creates modification matrix using an (x,E)-dependent function.
@@ -885,7 +1076,7 @@ class InteractionYields(object):
 
         if model == 'MRS':
             # Set charm production to zero
-            cs = HadAirCrossSections(self.iam)
+            cs = HadAirCrossSections(self.iam, e_range=self.e_range)
             mrs = MRS_charm(self.e_grid, cs)
             for proj in self.projectiles:
                 for chid in charm_modids:
@@ -896,8 +1087,9 @@ class InteractionYields(object):
 
         elif model == 'WHR':
 
-            cs_h_air = HadAirCrossSections('SIBYLL2.3')
-            cs_h_p = HadAirCrossSections('SIBYLL2.3_pp')
+            cs_h_air = HadAirCrossSections('SIBYLL2.3', e_range=self.e_range)
+            cs_h_p = HadAirCrossSections(
+                'SIBYLL2.3_pp', e_range=self.e_range)
             whr = WHR_charm(self.e_grid, cs_h_air)
             for proj in self.projectiles:
                 cs_scale = np.diag(
@@ -909,8 +1101,9 @@ class InteractionYields(object):
                     self.secondary_dict[proj].append(chid)
 
         elif model == 'sibyll23_pl':
-            cs_h_air = HadAirCrossSections('SIBYLL2.3')
-            cs_h_p = HadAirCrossSections('SIBYLL2.3_pp')
+            cs_h_air = HadAirCrossSections('SIBYLL2.3', e_range=self.e_range)
+            cs_h_p = HadAirCrossSections(
+                'SIBYLL2.3_pp', e_range=self.e_range)
             for proj in self.projectiles:
                 cs_scale = np.diag(cs_h_p.get_cs(proj) / cs_h_air.get_cs(proj))
                 for chid in charm_modids:
@@ -950,46 +1143,48 @@ class DecayYields(object):
     Args:
       mother_list (list, optional): list of particle mothers from
                                     interaction model
+      fname (str, optional): file name in the data directory
+      e_window (tuple, optional): index range of the energy grid,
+        see :attr:`InteractionYields.e_window`
     """
 
-    def __init__(self, mother_list=None, fname=None):
+    def __init__(self, mother_list=None, fname=None, e_window=None):
         #: (list) List of particles in the decay matrices
         self.particle_list = []
+        #: (tuple) index range of the energy window on the original grid
+        self.e_window = e_window
 
         self._load(mother_list, fname)
 
         self.particle_keys = self.mothers
 
     def _load(self, mother_list, fname):
-        """Un-pickles the yields dictionary using the path specified as
+        """Loads the decay dictionary using the path specified as
         ``decay_fname`` in :mod:`mceq_config`.
 
         Raises:
           IOError: if file not found
         """
-        import cPickle as pickle
-        from os.path import join
-
-        if fname:
-            fname = join(config['data_dir'], fname)
-        else:
-            fname = join(config['data_dir'], config['decay_fname'])
+        from MCEq.data_utils import load_database, is_mapped
 
-            # Take the compact dictionary if "enabled" and no
-            # file name forced
-            if config['compact_mode']:
-                fname = fname.replace('.ppd', '_compact.ppd')
+        fname = self._data_file(fname)
         if dbg > 0:
             print "DecayYields:_load():: Loading file", fname
-        try:
-            self.decay_dict = pickle.load(open(fname, 'rb'))
-        except IOError:
-            self._decompress(fname)
-            self.decay_dict = pickle.load(open(fname, 'rb'))
+        #: (str) file with the decay yields
+        self.fname, self.decay_dict = load_database(fname, self._decompress)
 
         self.daughter_dict = self.decay_dict.pop('daughter_dict')
         self.weights = self.decay_dict.pop('weights')
 
+        if self.e_window is not None:
+            lidx, uidx = self.e_window
+            self.weights = self.weights[lidx:uidx, lidx:uidx]
+            for key in self.decay_dict:
+                if type(key) is tuple:
+                    mat = self.decay_dict[key][lidx:uidx, lidx:uidx]
+                    self.decay_dict[key] = (mat if is_mapped(mat) else
+                                            np.copy(mat))
+
         for mother in config["adv_set"]["disable_decays"]:
             if dbg > 1:
                 print("DecayYields:_load():: switching off " +
@@ -1018,6 +1213,28 @@ class DecayYields(object):
 
         self._gen_particle_list(mother_list)
 
+    def _data_file(self, fname=None):
+        """Returns the name of the uncompressed decay file.
+
+        Args:
+          fname (str,optional): file name in the data directory, by
+            default ``decay_fname`` in :mod:`mceq_config`
+        Returns:
+          (str): file name with extension ``.ppd``
+        """
+        from MCEq.data_utils import derived_file
+
+        if fname:
+            return derived_file(fname)
+
+        fname = config['decay_fname']
+
+        # Take the compact dictionary if "enabled" and no
+        # file name forced
+        if config['compact_mode']:
+            fname = fname.replace('.ppd', '_compact.ppd')
+        return derived_file(fname)
+
     def _gen_particle_list(self, mother_list):
         """Saves a list of all particle species in the decay dictionary.
 
@@ -1112,9 +1329,8 @@ class DecayYields(object):
 
         """
         import os
-        import bz2
-        import cPickle as pickle
-        fcompr = os.path.splitext(fname)[0] + '.bz2'
+        from MCEq.data_utils import load_bz2, dump_pickle, source_file
+        fcompr = source_file(fname)
 
         if not os.path.isfile(fcompr):
             raise IOError(
@@ -1126,13 +1342,13 @@ class DecayYields(object):
 
         # Generate index of mother daughter relations and
         # multiply with bin widths
-        new_dict = self._gen_index(pickle.load(bz2.BZ2File(fcompr)))
+        new_dict = self._gen_index(load_bz2(fcompr))
 
         # Dump the file in uncompressed form
         if dbg > 1:
             print 'Saving to', fname
 
-        pickle.dump(new_dict, open(fname, 'wb'), protocol=-1)
+        dump_pickle(new_dict, fname)
 
     def get_d_matrix(self, mother, daughter):
         """Returns a ``DIM x DIM`` decay matrix.
@@ -1218,6 +1434,8 @@ class HadAirCrossSections(object):
 
     Args:
       interaction_model (str): name of the interaction model
+      e_range (tuple, optional): restricts the energy grid to
+        (E_min, E_max), defaults to the ``e_range`` setting in :mod:`mceq_config`
     """
     #: unit - :math:`\text{GeV} \cdot \text{fm}`
     GeVfm = 0.19732696312541853
@@ -1228,11 +1446,15 @@ class HadAirCrossSections(object):
     #: unit conversion - :math:`\text{mbarn} \to \text{cm}^2`
     mbarn2cm2 = GeVcm**2 / GeV2mbarn
 
-    def __init__(self, interaction_model):
+    def __init__(self, interaction_model, e_range=None):
         #: current interaction model name
         self.iam = None
         #: current energy grid
         self.egrid = None
+        #: (tuple) energy window (E_min, E_max) in GeV
+        self.e_range = e_range if e_range is not None else config['e_range']
+        #: (tuple) index range of the energy window on the original grid
+        self.e_window = None
 
         self._load()
 
@@ -1244,20 +1466,16 @@ class HadAirCrossSections(object):
             self.set_interaction_model('SIBYLL2.3')
 
     def _load(self):
-        """Un-pickles a dictionary using the path specified as
+        """Loads the cross section dictionary using the path specified as
         ``decay_fname`` in :mod:`mceq_config`.
 
         Raises:
           IOError: if file not found
         """
-        import cPickle as pickle
-        from os.path import join
-        fname = join(config['data_dir'], config['cs_fname'])
-        try:
-            self.cs_dict = pickle.load(open(fname, 'rb'))
-        except IOError:
-            self._decompress(fname)
-            self.cs_dict = pickle.load(open(fname, 'rb'))
+        from MCEq.data_utils import load_database
+        #: (str) file with the cross section tables
+        self.fname, self.cs_dict = load_database(self._data_file(),
+                                                 self._decompress)
 
         # normalise hadronic model names
         old_keys = [k for k in self.cs_dict if k != "EVEC"]
@@ -1265,7 +1483,22 @@ class HadAirCrossSections(object):
             new_key = normalize_hadronic_model_name(old_key)
             self.cs_dict[new_key] = self.cs_dict.pop(old_key)
 
-        self.egrid = self.cs_dict['EVEC']
+        self.e_window = energy_window(self.cs_dict['EVEC'], self.e_range)
+        lidx, uidx = self.e_window
+        if self.e_range is not None:
+            # Different raw names can refer to the same model
+            for model in set(
+                    normalize_hadronic_model_name(k) for k in old_keys):
+                for proj in self.cs_dict[model]:
+                    self.cs_dict[model][proj] = \
+                        self.cs_dict[model][proj][lidx:uidx]
+
+        self.egrid = self.cs_dict['EVEC'][lidx:uidx]
+
+    def _data_file(self):
+        """Returns the name of the uncompressed cross section file."""
+        from MCEq.data_utils import derived_file
+        return derived_file(config['cs_fname'])
 
     def _decompress(self, fname):
         """Decompresses and unpickles dictionaries stored in bz2
@@ -1282,9 +1515,8 @@ class HadAirCrossSections(object):
 
         """
         import os
-        import bz2
-        import cPickle as pickle
-        fcompr = os.path.splitext(fname)[0] + '.bz2'
+        from MCEq.data_utils import load_bz2, dump_pickle, source_file
+        fcompr = source_file(fname)
 
         if not os.path.isfile(fcompr):
             raise IOError(
@@ -1294,12 +1526,12 @@ class HadAirCrossSections(object):
         if dbg > 1:
             print 'Decompressing', fcompr
 
-        new_dict = pickle.load(bz2.BZ2File(fcompr))
+        new_dict = load_bz2(fcompr)
 
         # Dump the file in uncompressed form
         if dbg > 1:
             print 'Saving to', fname
-        pickle.dump(new_dict, open(fname, 'wb'), protocol=-1)
+        dump_pickle(new_dict, fname)
 
     def set_interaction_model(self, interaction_model):
         """Selects an interaction model and prepares all internal variables.
@@ -10,10 +10,19 @@ MCEq.
   into "compact" mode
 - :func:`extend_to_low_energies` extends an interaction model file
   with an low energy interaction model using interpolation
+- :class:`MatrixArchive` reads the memory-mapped ``.mca`` format of the
+  uncompressed databases, :func:`convert_to_archive` converts ``.bz2``
+  or ``.ppd`` files into this format
+- :func:`prepare_data_files` prepares the data files of the first run
+  concurrently in a process pool
+- :func:`derived_file` returns the location of files, which are created
+  from the original data files (see ``derived_data`` in :mod:`mceq_config`)
 """
 
+import os
 import numpy as np
 from mceq_config import config, dbg
+from MCEq.misc import normalize_hadronic_model_name
 
 
 def convert_to_compact(fname):
@@ -65,18 +74,15 @@ def convert_to_compact(fname):
     """
 
     import os
-    import cPickle as pickle
-    from bz2 import BZ2File
-    import ParticleDataTool
+    from multiprocessing.pool import ThreadPool
 
     dpm_di = None
-    if fname.endswith('_ledpm.bz2'):
+    if '_ledpm' in fname:
 
         if dbg > 0:
             print "convert_to_compact(): Low energy extension requested", fname
 
-        dpmpath = os.path.join(
-            config['data_dir'],
+        dpmpath = derived_file(
             config['low_energy_extension']['le_model'].translate(
                 None, "-.").upper() + '_yields_compact.bz2')
 
@@ -86,7 +92,7 @@ def convert_to_compact(fname):
         if not os.path.isfile(dpmpath):
             convert_to_compact(dpmpath)
         try:
-            dpm_di = pickle.load(BZ2File(dpmpath))
+            dpm_di = load_bz2(dpmpath)
         except IOError:
             raise Exception(
                 "convert_to_compact(): Error, low-energy model file expected but"
@@ -94,27 +100,23 @@ def convert_to_compact(fname):
 
     # If file name is supplied as ppd or with compact including, modify to
     # expected format
-    fn_he = fname.replace('.ppd', '.bz2').replace('_compact', '').replace(
-        '_ledpm', '')
+    fn_he = strip_ledpm(fname.replace('.ppd', '.bz2').replace('_compact', ''))
     if not os.path.isfile(fn_he):
-        fn_he = os.path.join(config["data_dir"], fn_he)
+        fn_he = os.path.join(config["data_dir"], os.path.basename(fn_he))
 
     if dbg > 0: 
         print "convert_to_compact(): Attempting conversion of", fn_he
 
     # Load the yield dictionary (without multiplication with bin widths)
-    mdi = pickle.load(BZ2File(fn_he))
+    mdi = load_bz2(fn_he)
 
-    # Load the decay dictionary (with bin widths and index)
-    try:
-        ddi = pickle.load(
-            open(os.path.join(config["data_dir"], 'decays_v1.ppd'), 'rb'))
-    except IOError:
-        # In case the ppd file is not yet created, use the DecayYields class to
-        # decompress, rotate and weight the yield files
-        from MCEq.data import DecayYields
-        ds = DecayYields(fname='decays_v1.ppd')
-        ddi = ds.decay_dict
+    # Load the decay dictionary (with bin widths and index). In case the
+    # file is not yet created, the DecayYields class decompresses, rotates
+    # and weights the yield files
+    from MCEq.data import DecayYields
+    _, ddi = load_database(
+        derived_file('decays_v1.ppd'),
+        DecayYields.__new__(DecayYields)._decompress)
 
     # Define a list of "stable" particles
     # Particles having an anti-partner
@@ -170,78 +172,82 @@ def convert_to_compact(fname):
 
         return secondary_dict
 
-    def follow_chained_decay(real_mother, mat, interm_mothers, reclev):
-        """Follows the chain of decays down to the list of stable particles.
-
-        The function follows the list of daughters of an unstable parrticle
-        and computes the feed-down contribution by evaluating the convolution
-        of production spectrum and decay spectrum using the formula (24)
-
-        ..math::
-            \mathbf{C}^M^p = D^\rho \cdot \ 
-        :func:`MCEq.data.InteractionYields._gen_index`."""
-
-        dbgstr = 'convert_to_compact::follow_chained_decay(): '
-        tab = 3 * reclev * '--' + '> '
-
-        if dbg > 5 and reclev == 0:
-            print dbgstr, 'start recursion with', real_mother, interm_mothers, np.sum(
-                mat)
-        elif dbg > 10:
-            print tab, 'enter with', real_mother, interm_mothers, np.sum(mat)
-
-        if np.sum(mat) < 1e-30:
-            if dbg > 10:
-                print tab, 'zero matrix for', real_mother, interm_mothers
-        if interm_mothers[-1] not in dec_di or interm_mothers[-1] in standard_particles:
-            if dbg > 10:
-                print tab, 'no further decays of', interm_mothers
-            return
-
-        for d in dec_di[interm_mothers[-1]]:
-            # Decay matrix
-            dmat = ddi[(interm_mothers[-1], d)]
-            # Matrix product D x C from the left (convolution)
-            mprod = dmat.dot(mat)
-
-            if np.sum(mprod) < 1e-40:
-                if dbg > 10:
-                    print tab, 'cancel recursion in', real_mother, interm_mothers, d, \
-                    'since matrix is zero', np.sum(mat), np.sum(dmat), np.sum(mprod)
-                continue
-
-            if d not in standard_particles:
-                if dbg > 5:
-                    print tab, 'Recurse', real_mother, interm_mothers, d, np.sum(
-                        mat)
-
-                follow_chained_decay(real_mother, mprod, interm_mothers + [d],
-                                     reclev + 1)
+    def prompt_id(d):
+        """Returns the ID of the prompt category of the lepton ``d``."""
+        return int(np.sign(d) * (7000 + abs(d)))
+
+    feed_down = {}
+
+    def feed_down_operator(mother, chain=()):
+        """Returns the operators, which map the production spectrum of the
+        unstable particle ``mother`` to the spectra of the standard
+        particles, which are produced in its decay chains.
+
+        The operator of a mother is the sum of its decay matrices to
+        standard particles and of the products of the operators of unstable
+        daughters with the decay matrices,
+        :math:`\mathbf{F}^{M} = \sum_d \mathbf{F}^{d} \cdot \mathbf{D}^{M \to d}`.
+        The operators are computed once for each particle, in topological
+        order of the decay chains, and shared between all projectiles.
+        Leptons are assigned to the prompt category, if any particle of the
+        chain has :math:`c\tau` below the one of :math:`K^0_S`.
+
+        Returns:
+          (dict): operators by ID of the standard particle
+        """
+        if mother in feed_down:
+            return feed_down[mother]
+        if mother in chain:
+            raise Exception(
+                'convert_to_compact(): cyclic decay chain {0}.'.format(
+                    chain + (mother, )))
+
+        ops = {}
+        if mother in dec_di and mother not in standard_particles:
+            is_prompt = part_d.ctau(mother) <= ctau_pr
+            for d in dec_di[mother]:
+                dmat = ddi[(mother, d)]
+                if d in standard_particles:
+                    contrib = {d: dmat}
+                else:
+                    contrib = dict(
+                        (dtr, op.dot(dmat))
+                        for dtr, op in feed_down_operator(
+                            d, chain + (mother, )).iteritems())
+                for dtr, op in contrib.iteritems():
+                    # Track prompt leptons in prompt category
+                    if is_prompt and abs(dtr) in [12, 13, 14, 16]:
+                        dtr = prompt_id(dtr)
+                    if dtr in ops:
+                        ops[dtr] = ops[dtr] + op
+                    else:
+                        ops[dtr] = op
+
+        # Drop vanishing operators, such as in the recursive version
+        feed_down[mother] = dict(
+            (dtr, op) for dtr, op in ops.iteritems() if np.sum(op) > 1e-40)
+        return feed_down[mother]
+
+    def compact_projectile(proj):
+        """Returns the compact yields of projectile ``proj``."""
+        proj_di = {}
+        for sec in pprod_di[proj]:
+            mat = mdi[(proj, sec)]
+            # Copy all direct production
+            if sec in standard_particles:
+                contrib = {sec: np.copy(mat)}
+            # Convolution with the decays of all other secondaries
             else:
-                # Track prompt leptons in prompt category
-                if abs(d) in [12, 13, 14, 16]:
-                    # is_prompt = bool(np.sum([(part_d.ctau(mo) <= ctau_pr or
-                    #     4000 < abs(mo) < 7000 or 400 < abs(mo) < 500)
-                    #     for mo in interm_mothers]))
-                    is_prompt = sum(
-                        [part_d.ctau(mo) <= ctau_pr
-                         for mo in interm_mothers]) > 0
-                    if is_prompt:
-                        d = np.sign(d) * (7000 + abs(d))
-
-                if dbg > 5:
-                    print tab, 'contribute to', real_mother, interm_mothers, d
-
-                if (real_mother, d) in compact_di.keys():
-                    if dbg > 10:
-                        print tab, '+=', (real_mother, d), np.sum(mprod)
-                    compact_di[(real_mother, d)] += mprod
+                contrib = dict((dtr, op.dot(mat)) for dtr, op in
+                               feed_down_operator(sec).iteritems())
+            for dtr, mprod in contrib.iteritems():
+                if np.sum(mprod) < 1e-40:
+                    continue
+                if (proj, dtr) in proj_di:
+                    proj_di[(proj, dtr)] += mprod
                 else:
-                    if dbg > 10:
-                        print tab, 'new', (real_mother, d), interm_mothers
-                    compact_di[(real_mother, d)] = mprod
-
-        return
+                    proj_di[(proj, dtr)] = mprod
+        return proj_di
 
     # Create index of entries
     pprod_di = create_secondary_dict(mdi)
@@ -251,26 +257,24 @@ def convert_to_compact(fname):
         print 'Int   dict:\n', sorted(pprod_di)
         print 'Decay dict:\n', sorted(dec_di)
 
-    for proj, lsecs in sorted(pprod_di.iteritems()):
-
-        if abs(proj) not in allowed_projectiles:
-            continue
-
-        for sec in lsecs:
-            # Copy all direct production in first iteration
-            if sec in standard_particles:
-                compact_di[(proj, sec)] = np.copy(mdi[(proj, sec)])
-
-                if dbg > 2: print 'copied', proj, '->', sec
+    projectiles = [
+        proj for proj in sorted(pprod_di) if abs(proj) in allowed_projectiles
+    ]
 
-        for sec in lsecs:
-            #Iterate over all remaining secondaries
-            if sec in standard_particles:
-                continue
+    # Operators of all secondaries, before the projectiles are distributed
+    # to the threads (numpy releases the GIL in the matrix products)
+    for proj in projectiles:
+        for sec in pprod_di[proj]:
+            if sec not in standard_particles:
+                feed_down_operator(sec)
 
-            if dbg > 3: proj, '->', sec, '->', dec_di[sec]
-            #Enter recursion and calculate contribution from decay
-            follow_chained_decay(proj, mdi[(proj, sec)], [sec], 0)
+    pool = ThreadPool(config['data_preparation']['processes'])
+    try:
+        for proj_di in pool.map(compact_projectile, projectiles):
+            compact_di.update(proj_di)
+    finally:
+        pool.close()
+        pool.join()
 
     # Copy metadata
     compact_di['ebins'] = np.copy(mdi['ebins'])
@@ -280,11 +284,12 @@ def convert_to_compact(fname):
     if dpm_di:
         compact_di = extend_to_low_energies(compact_di, dpm_di)
 
-    pickle.dump(compact_di, BZ2File(fname, 'wb'), protocol=-1)
+    dump_bz2(compact_di, fname)
 
-    # Delete cached version if it exists
-    if os.path.isfile(fname.replace('.bz2', '.ppd')):
-        os.unlink(fname.replace('.bz2', '.ppd'))
+    # Delete cached versions if they exist
+    for ext in ['.ppd', '.mca']:
+        if os.path.isfile(fname.replace('.bz2', ext)):
+            os.unlink(fname.replace('.bz2', ext))
 
 
 def extend_to_low_energies(he_di=None, le_di=None, fname=None):
@@ -307,8 +312,6 @@ def extend_to_low_energies(he_di=None, le_di=None, fname=None):
       fname (str,optional): file name of high-energy model yields
     """
 
-    import cPickle as pickle
-    from bz2 import BZ2File
     import os
 
     if (he_di and le_di) and fname:
@@ -321,40 +324,20 @@ def extend_to_low_energies(he_di=None, le_di=None, fname=None):
             print "extend_to_low_energies(): Low energy extension requested:", fname
 
         # Load the yield dictionary (without multiplication with bin widths ".bz2")
-        he_di = pickle.load(
-            BZ2File(fname.replace('_ledpm', '').replace('.ppd', '.bz2')))
+        he_di = load_bz2(
+            derived_file(
+                strip_ledpm(os.path.basename(fname)).replace(
+                    '.ppd', '.bz2')))
 
         # Load low energy model yields
-        le_di = pickle.load(
-            BZ2File(
-                os.path.join(config['data_dir'], config['low_energy_extension']
-                             ['le_model'].translate(
-                                 None, "-.").upper() + '_yields.bz2')))
-
-    he_le_trasition = config['low_energy_extension']['he_le_transition']
-    nbins_interp = config['low_energy_extension']['nbins_interp']
+        le_di = load_bz2(
+            os.path.join(config['data_dir'], config['low_energy_extension']
+                         ['le_model'].translate(None, "-.").upper() +
+                         '_yields.bz2'))
 
     egr = he_di['evec']  # will throw error
 
-    # Find the index of transition in the energy grid
-    transition_idx = np.count_nonzero(egr < he_le_trasition)
-    if dbg > 1:
-        print "extend_to_low_energies(): transition_idx={0}, transition_energy={1}".format(
-            transition_idx, egr[transition_idx])
-
-    # Indices of the transition region (+2 because 0 and 1 are included)
-    intp_indices = np.arange(
-        transition_idx - nbins_interp / 2 - 1,
-        transition_idx + nbins_interp / 2 + 1.1,
-        1,
-        dtype='int32')
-    intp_scales = np.linspace(0, 1, len(intp_indices))
-    intp_array = np.ones((len(egr), len(intp_scales)))
-    he_int_array = intp_scales * intp_array
-    le_int_array = intp_scales[::-1] * intp_array
-    if dbg > 2:
-        print "extend_to_low_energies(): int. arrays", intp_scales, \
-            intp_indices, egr[intp_indices]
+    he_weights, le_weights = le_blend_weights(egr)
 
     ext_di = {}
 
@@ -363,44 +346,643 @@ def extend_to_low_energies(he_di=None, le_di=None, fname=None):
             ext_di[k] = he_di[k]
             continue
 
-        he_mat = np.copy(he_di[k])
-
-        new_mat = he_mat
-
         if k not in le_di:
             # Use only he model cross sections if le model doesn't
             # know the process
             if config["low_energy_extension"]["use_unknown_cs"]:
                 if dbg > 3:
                     print "extend_to_low_energies(): skipping particle", k
-                ext_di[k] = new_mat
+                ext_di[k] = np.copy(he_di[k])
                 continue
             else:
                 raise Exception('extend_to_low_energies(): High energy model' +
                                 ' contains ')
-        else:
-            le_mat = np.copy(le_di[k])
-            try:
-                new_mat[:, :intp_indices[0]] *= 0.
-                new_mat[:, intp_indices] *= he_int_array
-                le_mat[:, intp_indices[-1]:] *= 0
-                le_mat[:, intp_indices] *= le_int_array
-
-            except IndexError:
-                print "extend_to_low_energies(): problems indexing model transition"
-                print k, intp_indices,
-                print he_mat
-                print le_mat
 
-            new_mat += le_mat
-
-            ext_di[k] = new_mat
+        ext_di[k] = he_di[k] * he_weights + le_di[k] * le_weights
 
     ext_di['le_ext'] = config["low_energy_extension"]
 
     if fname:
         if dbg > 0: 
             print "extend_to_low_energies(): Saving", fname
-        pickle.dump(ext_di, BZ2File(fname, 'wb'), protocol=-1)
+        dump_bz2(ext_di, fname)
+
+    return ext_di
+
+
+def le_blend_weights(e_grid, he_le_transition=None, nbins_interp=None):
+    """Returns the weights of the energy grid columns for blending a
+    high-energy with a low-energy model.
+
+    The weights change linearly in energy grid index over ``nbins_interp``
+    bins around ``he_le_transition``. A blended yield matrix is
+    ``he_mat * he_weights + le_mat * le_weights``.
+
+    Args:
+      e_grid (numpy.array): energy grid of the yield matrices
+      he_le_transition (float,optional): transition energy in GeV, by
+        default from ``low_energy_extension`` in :mod:`mceq_config`
+      nbins_interp (int,optional): number of bins of the transition, by
+        default from ``low_energy_extension`` in :mod:`mceq_config`
+    Returns:
+      (tuple): weights of the high- and low-energy model
+    Raises:
+      Exception: if the transition region is not within the grid
+    """
+    if he_le_transition is None:
+        he_le_transition = config['low_energy_extension']['he_le_transition']
+    if nbins_interp is None:
+        nbins_interp = config['low_energy_extension']['nbins_interp']
+
+    # Find the index of transition in the energy grid
+    transition_idx = np.count_nonzero(e_grid < he_le_transition)
+    if dbg > 1:
+        print "le_blend_weights(): transition_idx={0}, transition_energy={1}".format(
+            transition_idx, e_grid[min(transition_idx, e_grid.size - 1)])
+
+    # Indices of the transition region (+2 because 0 and 1 are included)
+    intp_indices = np.arange(
+        transition_idx - nbins_interp // 2 - 1,
+        transition_idx + nbins_interp // 2 + 1.1,
+        1,
+        dtype='int32')
+    if intp_indices[0] < 0 or intp_indices[-1] >= e_grid.size:
+        raise Exception(
+            "le_blend_weights(): the transition region at {0} GeV with "
+            .format(he_le_transition) + "{0} bins exceeds the energy grid "
+            .format(nbins_interp) + "({0:g}-{1:g} GeV).".format(
+                e_grid[0], e_grid[-1]))
+    intp_scales = np.linspace(0, 1, len(intp_indices))
+    if dbg > 2:
+        print "le_blend_weights(): int. arrays", intp_scales, \
+            intp_indices, e_grid[intp_indices]
+
+    he_weights = np.ones_like(e_grid, dtype='float64')
+    he_weights[:intp_indices[0]] = 0.
+    he_weights[intp_indices] = intp_scales
+    le_weights = np.zeros_like(e_grid, dtype='float64')
+    le_weights[:intp_indices[-1]] = 1.
+    le_weights[intp_indices] = intp_scales[::-1]
+
+    return he_weights, le_weights
+
+
+def blends_in_memory(interaction_model):
+    """Returns ``True`` if the low energy model is blended with the yields
+    of ``interaction_model`` in memory (see ``blend_in_memory`` in
+    :mod:`mceq_config`), instead of reading a merged ``_ledpm`` file."""
+    le_ext = config['low_energy_extension']
+    return (le_ext['enabled'] and le_ext.get('blend_in_memory', False) and
+            'DPMJET' not in normalize_hadronic_model_name(interaction_model))
+
+
+def ledpm_suffix():
+    """Returns the suffix of the names of yield files, which are extended to
+    low energies. It contains a fingerprint of the settings of the low
+    energy extension, such that files of different settings can coexist."""
+    from MCEq.cache import fingerprint
+
+    settings = dict(
+        (key, value)
+        for key, value in config['low_energy_extension'].items()
+        if key not in ['enabled', 'blend_in_memory'])
+    return '_ledpm' + fingerprint(settings)[:8]
+
+
+def strip_ledpm(fname):
+    """Returns the file name without the suffix of :func:`ledpm_suffix`."""
+    import re
+    return re.sub(r'_ledpm[0-9a-f]*', '', fname)
+
+
+#: Directories of the derived files by settings
+_derived_dirs = {}
+
+
+def derived_dir():
+    """Returns the directory of the derived data files.
+
+    If ``cache_dir`` of ``derived_data`` in :mod:`mceq_config` is set,
+    the files are stored in a subdirectory, which is named after the
+    checksums of the original ``.bz2`` files. Processes with the same data
+    files share the derived files, independent of the location of
+    ``data_dir`` and of the settings. Otherwise, ``data_dir`` is returned.
+
+    Returns:
+      (str): directory name
+    """
+    from MCEq.cache import fingerprint, file_checksum
+
+    cache_dir = config['derived_data']['cache_dir']
+    if cache_dir is None:
+        return config['data_dir']
+    cache_dir = os.path.expanduser(os.path.expandvars(cache_dir))
+
+    key = (config['data_dir'], cache_dir)
+    if key not in _derived_dirs:
+        checksums = [
+            (fname, file_checksum(
+                os.path.join(config['data_dir'], fname), cache_dir))
+            for fname in sorted(os.listdir(config['data_dir']))
+            if fname.endswith('.bz2') and '_compact' not in fname and
+            '_ledpm' not in fname
+        ]
+        _derived_dirs[key] = os.path.join(
+            cache_dir,
+            fingerprint(checksums)[:16])
+
+    return _derived_dirs[key]
+
+
+def derived_file(fname):
+    """Returns the path of a derived data file.
+
+    Files which exist only in ``data_dir``, e.g. prepared with
+    :mod:`MCEq.prepare` or original files, are used from there.
+    Otherwise, the file belongs to :func:`derived_dir`.
+
+    Args:
+      fname (str): file name without directory
+    Returns:
+      (str): path of the file
+    """
+    fname = os.path.basename(fname)
+    path = os.path.join(derived_dir(), fname)
+    if not os.path.isfile(path) and os.path.isfile(
+            os.path.join(config['data_dir'], fname)):
+        return os.path.join(config['data_dir'], fname)
+    return path
+
+
+def source_file(fname):
+    """Returns the path of the ``.bz2`` file of an uncompressed data file,
+    see :func:`derived_file`."""
+    return derived_file(os.path.splitext(os.path.basename(fname))[0] + '.bz2')
+
+
+def _bz2_tool():
+    """Returns the path of the first parallel bzip2 program of
+    ``data_preparation`` in :mod:`mceq_config` found in the ``PATH``,
+    or ``None``."""
+    from distutils.spawn import find_executable
+
+    for tool in config['data_preparation']['bz2_tools']:
+        path = find_executable(tool)
+        if path:
+            return path
+    return None
+
+
+def load_bz2(fname):
+    """Unpickles a ``.bz2`` file.
+
+    The file is decompressed by a parallel bzip2 program (e.g. lbzip2,
+    pbzip2), which decompresses the blocks of large files on all cores,
+    or by the :mod:`bz2` module if none is installed.
+
+    Args:
+      fname (str): file name
+    Returns:
+      content of the file
+    """
+    import subprocess
+    import cPickle as pickle
+    from bz2 import BZ2File
 
-    return ext_di
\ No newline at end of file
+    if not os.path.isfile(fname):
+        raise IOError("load_bz2(): File {0} not found.".format(fname))
+
+    tool = _bz2_tool()
+    if tool is None:
+        return pickle.load(BZ2File(fname))
+
+    if dbg > 1:
+        print "load_bz2(): decompressing {0} with {1}".format(fname, tool)
+    proc = subprocess.Popen([tool, '-dc', fname], stdout=subprocess.PIPE)
+    content = pickle.load(proc.stdout)
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise IOError(
+            "load_bz2(): {0} failed to decompress {1}.".format(tool, fname))
+    return content
+
+
+def dump_bz2(content, fname):
+    """Pickles ``content`` into a ``.bz2`` file, with a parallel bzip2
+    program if available (see :func:`load_bz2`). The file is written
+    atomically as in :func:`dump_pickle`.
+
+    Args:
+      content (object): object to store
+      fname (str): file name
+    """
+    import subprocess
+    import cPickle as pickle
+    from bz2 import BZ2File
+
+    tool = _bz2_tool()
+    tmp_fname = fname + '.tmp{0}'.format(os.getpid())
+    if tool is None:
+        f = BZ2File(tmp_fname, 'wb')
+        pickle.dump(content, f, protocol=-1)
+        f.close()
+    else:
+        with open(tmp_fname, 'wb') as f:
+            proc = subprocess.Popen(
+                [tool, '-c'], stdin=subprocess.PIPE, stdout=f)
+            pickle.dump(content, proc.stdin, protocol=-1)
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise IOError("dump_bz2(): {0} failed to compress {1}.".format(
+                    tool, fname))
+    os.rename(tmp_fname, fname)
+
+
+def dump_pickle(content, fname):
+    """Pickles ``content`` into a file. The file is written under a
+    temporary name and renamed, such that concurrent readers never see
+    incomplete files.
+
+    Args:
+      content (object): object to store
+      fname (str): file name
+    """
+    import cPickle as pickle
+
+    tmp_fname = fname + '.tmp{0}'.format(os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        pickle.dump(content, f, protocol=-1)
+    os.rename(tmp_fname, fname)
+
+
+#: First bytes of the ``.mca`` files
+_ARCHIVE_MAGIC = 'MCEQMCA1'
+#: Alignment of the arrays in the ``.mca`` files in bytes
+_ARCHIVE_ALIGN = 64
+
+
+def _align(pos):
+    return (pos + _ARCHIVE_ALIGN - 1) // _ARCHIVE_ALIGN * _ARCHIVE_ALIGN
+
+
+def _encode_key(key):
+    """Converts dictionary keys into json values (tuples to lists)."""
+    if isinstance(key, tuple):
+        return [_encode_key(k) for k in key]
+    elif isinstance(key, (np.integer, int, long)):
+        return int(key)
+    return key
+
+
+def _decode_key(key):
+    """Inverse of :func:`_encode_key`."""
+    if isinstance(key, list):
+        return tuple(_decode_key(k) for k in key)
+    elif isinstance(key, unicode):
+        return str(key)
+    return key
+
+
+def write_archive(fname, content):
+    """Writes a database dictionary in the ``.mca`` format.
+
+    The file starts with a json header, which contains the index of the
+    arrays, followed by the arrays with 64-byte alignment. Arrays in the
+    dictionary, or in dictionaries of arrays (such as the cross section
+    tables of each model), are stored in the index. All other entries are
+    pickled into one block at the end of the file.
+
+    Args:
+      fname (str): file name
+      content (dict): yield, decay or cross section dictionary
+    """
+    import os
+    import json
+    import struct
+    import cPickle as pickle
+
+    arrays = []
+    objects = {}
+    for key, value in content.iteritems():
+        if isinstance(value, np.ndarray):
+            arrays.append(([key], value))
+        elif (isinstance(value, dict) and value and all(
+                isinstance(v, np.ndarray) for v in value.itervalues())):
+            arrays += [([key, k], v) for k, v in value.iteritems()]
+        else:
+            objects[key] = value
+    blob = pickle.dumps(objects, protocol=-1)
+
+    index = []
+    pos = 0
+    for path, arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        index.append([[_encode_key(k) for k in path], arr.dtype.str,
+                      list(arr.shape), pos])
+        pos = _align(pos + arr.nbytes)
+    header = json.dumps({
+        'version': 1,
+        'arrays': index,
+        'objects': [pos, len(blob)]
+    })
+    data_start = _align(16 + len(header))
+
+    tmp_fname = fname + '.tmp{0}'.format(os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        f.write(_ARCHIVE_MAGIC + struct.pack('<Q', len(header)) + header)
+        for (path, arr), entry in zip(arrays, index):
+            f.seek(data_start + entry[3])
+            f.write(np.ascontiguousarray(arr).tostring())
+        f.seek(data_start + pos)
+        f.write(blob)
+    os.rename(tmp_fname, fname)
+
+    if dbg > 1:
+        print("write_archive(): stored {0} arrays in {1}").format(
+            len(arrays), fname)
+
+
+class MatrixArchive(object):
+    """Read access to the ``.mca`` files of :func:`write_archive`.
+
+    The file is memory-mapped read-only. The arrays are views into the
+    mapping, such that a matrix is read from disk at the first access to
+    its elements, and the pages are shared by all processes which use
+    the same file.
+
+    Args:
+      fname (str): file name
+    """
+
+    def __init__(self, fname):
+        import json
+        import struct
+
+        with open(fname, 'rb') as f:
+            if f.read(8) != _ARCHIVE_MAGIC:
+                raise Exception(
+                    "MatrixArchive(): {0} is not an .mca file.".format(fname))
+            header_len = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(header_len))
+
+        self.fname = fname
+        self._data_start = _align(16 + header_len)
+        self._mmap = np.memmap(fname, dtype=np.uint8, mode='r')
+        #: (dict) dtype, shape and offset by key path
+        self.index = dict(
+            (tuple(_decode_key(k) for k in path), (dtype, tuple(shape), pos))
+            for path, dtype, shape, pos in header['arrays'])
+        self._objects = header['objects']
+
+    def keys(self):
+        """Returns the key paths of the arrays, e.g. ``((2212, 211),)``
+        for a yield matrix or ``('SIBYLL2.3', 2212)`` for a cross section
+        table."""
+        return self.index.keys()
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __getitem__(self, path):
+        dtype, shape, pos = self.index[path]
+        dtype = np.dtype(dtype)
+        start = self._data_start + pos
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return self._mmap[start:start + nbytes].view(dtype).reshape(shape)
+
+    def objects(self):
+        """Returns the entries of the database which are not arrays."""
+        import cPickle as pickle
+
+        pos, size = self._objects
+        start = self._data_start + pos
+        return pickle.loads(self._mmap[start:start + size].tostring())
+
+    def to_dict(self):
+        """Returns the database dictionary. The arrays are memory-mapped
+        views, no matrix is read by this call."""
+        content = self.objects()
+        for path in self.index:
+            if len(path) == 1:
+                content[path[0]] = self[path]
+            else:
+                content.setdefault(path[0], {})[path[1]] = self[path]
+        return content
+
+
+def is_mapped(arr):
+    """Returns ``True`` if ``arr`` is a view into a memory-mapped file,
+    e.g. of :class:`MatrixArchive`."""
+    return isinstance(arr, np.memmap)
+
+
+def database_file(fname):
+    """Returns the name of the uncompressed database file in the format
+    selected by ``data_format`` in :mod:`mceq_config`.
+
+    Args:
+      fname (str): name of the ``.ppd`` file
+    """
+    if config['data_format'] == 'mca':
+        return derived_file(
+            os.path.splitext(os.path.basename(fname))[0] + '.mca')
+    return fname
+
+
+def prepare_database(fname, decompress):
+    """Creates the uncompressed database file, if it does not exist.
+
+    For ``'mca'``, the ``.mca`` file is created from the ``.ppd``
+    file, which is removed afterwards. Missing ``.ppd`` files are created
+    with the ``_decompress`` method of the database class. Processes which need the same file
+    wait until the first one has created it.
+
+    Args:
+      fname (str): name of the ``.ppd`` file
+      decompress (callable): creates ``fname`` from the ``.bz2`` file
+    Returns:
+      (str): name of the database file, see :func:`database_file`
+    """
+    import cPickle as pickle
+    from MCEq.cache import FileLock
+
+    db_fname = database_file(fname)
+    if os.path.isfile(db_fname):
+        return db_fname
+
+    with FileLock(db_fname):
+        # Created by another process in the meantime
+        if os.path.isfile(db_fname):
+            return db_fname
+        if not os.path.isfile(fname):
+            decompress(fname)
+        if db_fname != fname:
+            if dbg > 0:
+                print "prepare_database(): converting", fname
+            write_archive(db_fname, pickle.load(open(fname, 'rb')))
+            # The intermediate file is not needed any more
+            os.unlink(fname)
+
+    return db_fname
+
+
+def load_database(fname, decompress):
+    """Loads an uncompressed database in the format selected by
+    ``data_format`` in :mod:`mceq_config`, see :func:`prepare_database`.
+
+    Args:
+      fname (str): name of the ``.ppd`` file
+      decompress (callable): creates ``fname`` from the ``.bz2`` file
+    Returns:
+      (tuple): name of the loaded file and the database dictionary
+    """
+    import cPickle as pickle
+
+    db_fname = prepare_database(fname, decompress)
+    if db_fname.endswith('.mca'):
+        return db_fname, MatrixArchive(db_fname).to_dict()
+    return db_fname, pickle.load(open(db_fname, 'rb'))
+
+
+def _prepare_task(task):
+    """Prepares one database file in a worker of
+    :func:`prepare_data_files`.
+
+    Args:
+      task (tuple): kind (``'yields'``, ``'decays'``, ``'cs'``) and
+        interaction model or file name
+    Returns:
+      (str): name of the database file
+    """
+    from MCEq.data import InteractionYields, DecayYields, HadAirCrossSections
+
+    kind, name = task
+    if kind == 'yields':
+        db = InteractionYields.__new__(InteractionYields)
+        fname = db._prepare_file(name)
+    elif kind == 'decays':
+        db = DecayYields.__new__(DecayYields)
+        fname = db._data_file(name)
+    else:
+        db = HadAirCrossSections.__new__(HadAirCrossSections)
+        fname = db._data_file()
+
+    return prepare_database(fname, db._decompress)
+
+
+def prepare_data_files(interaction_models, processes=None):
+    """Creates the missing data files of the interaction models, decays
+    and cross sections concurrently in a process pool.
+
+    At the first run, the ``.bz2`` files have to be decompressed and
+    possibly converted to the compact mode or extended to low energies.
+    Files which are needed for the conversion of other files (the
+    decays and the low energy model) are prepared first.
+
+    Args:
+      interaction_models (list of str): interaction model names
+      processes (int,optional): number of processes, by default
+        ``processes`` of ``data_preparation`` in :mod:`mceq_config`. In
+        workers of a :class:`multiprocessing.Pool`, the files are
+        prepared serially.
+    Returns:
+      (list): names of the created files
+    """
+    from multiprocessing import Pool, current_process
+    from MCEq.data import InteractionYields, DecayYields, HadAirCrossSections
+
+    if processes is None:
+        processes = config['data_preparation']['processes']
+    # Workers of a pool (daemonic processes) can not start a pool
+    if current_process().daemon:
+        processes = 1
+
+    y = InteractionYields.__new__(InteractionYields)
+    missing = lambda fname: not os.path.isfile(database_file(fname))
+
+    # The decays are needed for the compact mode and the low energy
+    # model for the extension of other models, such that the files are
+    # prepared in three stages
+    decays, le_model, models = [], [], []
+    if missing(DecayYields.__new__(DecayYields)._data_file()):
+        decays.append(('decays', None))
+    if missing(HadAirCrossSections.__new__(HadAirCrossSections)._data_file()):
+        decays.append(('cs', None))
+
+    le_name = normalize_hadronic_model_name(
+        config['low_energy_extension']['le_model'])
+    for model in interaction_models:
+        model = normalize_hadronic_model_name(model)
+        if blends_in_memory(model):
+            if missing(y._data_file(le_name).replace('.bz2', '.ppd')):
+                le_model.append(('yields', le_name))
+        bz2_fname = y._data_file(model)
+        if not missing(bz2_fname.replace('.bz2', '.ppd')):
+            continue
+        models.append(('yields', model))
+        if os.path.isfile(bz2_fname):
+            continue
+        if config['compact_mode'] and missing(derived_file('decays_v1.ppd')):
+            decays.append(('decays', 'decays_v1.ppd'))
+        if 'ledpm' in bz2_fname:
+            le_model.append(('yields', le_name))
+
+    created = []
+    for tasks in [decays, le_model, models]:
+        tasks = sorted(set(tasks))
+        if not tasks:
+            continue
+        if dbg > 0:
+            print("prepare_data_files(): preparing {0}").format(
+                ', '.join(str(name or kind) for kind, name in tasks))
+        if processes > 1 and len(tasks) > 1:
+            pool = Pool(min(processes, len(tasks)))
+            try:
+                created += pool.map(_prepare_task, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            created += map(_prepare_task, tasks)
+
+    return created
+
+
+def convert_to_archive(fname, archive_fname=None):
+    """Converts a compressed (``.bz2``) or pickled (``.ppd``) database
+    into the ``.mca`` format.
+
+    The ``.bz2`` files of the interaction and decay yields are indexed
+    and multiplied by the bin widths, as when the classes in
+    :mod:`MCEq.data` decompress them.
+
+    Args:
+      fname (str): input file name
+      archive_fname (str,optional): output file name, by default the
+        input file name with the extension ``.mca``
+    Returns:
+      (str): name of the output file
+    """
+    import os
+    import cPickle as pickle
+    from MCEq.data import InteractionYields, DecayYields
+
+    if not os.path.isfile(fname):
+        fname = os.path.join(config["data_dir"], fname)
+    if archive_fname is None:
+        archive_fname = os.path.splitext(fname)[0] + '.mca'
+
+    if fname.endswith('.bz2'):
+        content = load_bz2(fname)
+        base = os.path.basename(fname)
+        if '_yields' in base:
+            content = InteractionYields.__new__(InteractionYields)._gen_index(
+                content)
+        elif base.startswith('decays'):
+            content = DecayYields.__new__(DecayYields)._gen_index(content)
+    else:
+        content = pickle.load(open(fname, 'rb'))
+
+    write_archive(archive_fname, content)
+
+    return archive_fname
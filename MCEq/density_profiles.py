@@ -52,10 +52,10 @@ def _load_cache():
 
     """
     import cPickle as pickle
+    from MCEq.data_utils import derived_file
     if dbg > 0:
         print "atmospheres::_load_cache(): loading cache."
-    fname = join(config['data_dir'],
-                 config['atm_cache_file'])
+    fname = derived_file(config['atm_cache_file'])
 
     try:
         return pickle.load(open(fname, 'rb'))
@@ -72,16 +72,25 @@ def _dump_cache(cache):
     Raises:
         IOError:
     """
+    import os
     import cPickle as pickle
+    from MCEq.cache import FileLock
+    from MCEq.data_utils import derived_dir, dump_pickle
 
     if dbg > 0:
         print "density_profiles::_dump_cache() dumping cache."
-    fname = join(config['data_dir'],
-                 config['atm_cache_file'])
+    fname = os.path.join(derived_dir(), config['atm_cache_file'])
     print fname
     try:
-        pickle.dump(cache, open(fname, 'wb'), protocol=-1)
-    except IOError:
+        with FileLock(fname):
+            # Keep the entries stored by other processes meanwhile
+            if os.path.isfile(fname):
+                stored = pickle.load(open(fname, 'rb'))
+                for key, splines in stored.items():
+                    for theta, spl in splines.items():
+                        cache.setdefault(key, {}).setdefault(theta, spl)
+            dump_pickle(cache, fname)
+    except (IOError, OSError):
         raise IOError("density_profiles::_dump_cache(): " +
                       'could not (re-)create cache. Wrong working directory?')
 
@@ -187,6 +196,17 @@ class GeneralizedTarget(object):
         self.s_h2X = UnivariateSpline(self.knots, self.X_int, k=1, s=0.)
         self.max_X = self.X_int[-1]
 
+    def l2X(self, l_cm):
+        """Returns the depth X in g/cm**2 as a function of position l in cm.
+
+        Args:
+           l_cm (float):  position in target in cm
+
+        Returns:
+           float: depth in g/cm**2
+        """
+        return self.s_h2X(l_cm)
+
     def get_density_X(self, X):
         """Returns the density in g/cm**3 as a function of depth X.
 
@@ -497,6 +517,19 @@ class EarthAtmosphere():
         """
         return np.exp(self.s_h2X(h))
 
+    def l2X(self, dl):
+        """Returns the depth along path as function of the distance
+        from the top of the atmosphere along the path.
+
+        Args:
+           dl (float):  distance along path :math:`l(\\theta)` in cm
+
+        Returns:
+           float: X  slant depth in g/cm**2
+
+        """
+        return self.h2X(self.geom.h(dl, self.thrad))
+
     def X2rho(self, X):
         """Returns the density :math:`\\rho(X)`.
 
@@ -43,15 +43,17 @@ The functions use different libraries for sparse and dense linear algebra (BLAS)
 
 """
 import numpy as np
-from mceq_config import config
+from mceq_config import config, dbg
 
 
 def kern_numpy(nsteps, dX, rho_inv, int_m, dec_m,
                phi, grid_idcs,
-               mu_egrid=None, mu_dEdX=None, mu_lidx_nsp=None,
-               prog_bar=None, fa_vars=None):
+               mu_egrid=None, mu_dEdX=None, mu_idcs=None,
+               prog_bar=None, fa_vars=None, block_bounds=None):
     """:mod;`numpy` implementation of forward-euler integration.
 
+    Wrapper of :class:`MCEq.backends.NumpyBackend`.
+
     Args:
       nsteps (int): number of integration steps
       dX (numpy.array[nsteps]): vector of step-sizes :math:`\\Delta X_i` in g/cm**2
@@ -59,91 +61,666 @@ def kern_numpy(nsteps, dX, rho_inv, int_m, dec_m,
       int_m (numpy.array): interaction matrix :eq:`int_matrix` in dense or sparse representation
       dec_m (numpy.array): decay  matrix :eq:`dec_matrix` in dense or sparse representation
       phi (numpy.array): initial state vector :math:`\\Phi(X_0)`
+      mu_egrid (numpy.array): energy grid of the muon species
+      mu_dEdX (numpy.array): muon energy loss on ``mu_egrid`` in GeV cm**2/g
+      mu_idcs (list): slices or index arrays of the muon species in ``phi``
       prog_bar (object,optional): handle to :class:`ProgressBar` object
       fa_vars (dict,optional): contains variables for first interaction mode
+      block_bounds (numpy.array,optional): boundaries of the species blocks
+        in ``phi``, by default blocks of the size of ``mu_egrid``
     Returns:
       numpy.array: state vector :math:`\\Phi(X_{nsteps})` after integration
     """
+    from MCEq.backends import NumpyBackend, integrate
+
+    if block_bounds is None:
+        block_bounds = np.arange(0, phi.size + 1, mu_egrid.size)
+    session = SolverSession(None, int_m, dec_m, mu_idcs, block_bounds,
+                            phi.size)
+    backend = NumpyBackend()
+    backend.setup(session, session.project(phi), fa_vars)
+
+    return integrate(backend, nsteps, dX, rho_inv, grid_idcs, mu_egrid,
+                     mu_dEdX, mu_idcs, prog_bar)
+
+
+def _block_coupling(mat, bounds):
+    """Returns the coupling pattern between blocks of the state vector.
+
+    Args:
+      mat (numpy.array): matrix in dense or sparse representation
+      bounds (numpy.array): boundaries of the blocks in the state vector
+    Returns:
+      numpy.array: boolean matrix, where element (i, j) is ``True`` if
+      block ``j`` feeds block ``i``
+    """
+    from scipy.sparse import csr_matrix
+
+    nblocks = bounds.size - 1
+    # Projector from state vector indices to block indices
+    proj = csr_matrix(
+        (np.ones(bounds[-1]), np.repeat(np.arange(nblocks), np.diff(bounds)),
+         np.arange(bounds[-1] + 1)),
+        shape=(bounds[-1], nblocks))
+    abs_mat = csr_matrix(np.abs(mat) if not hasattr(mat, 'tocsr')
+                         else abs(mat.tocsr()))
+
+    return (proj.T.dot(abs_mat).dot(proj)).toarray() > 0.
+
+
+def _active_set(phi, bounds, coupling, threshold):
+    """Determines the indices of the state vector, which have to be
+    integrated.
+
+    A block (species) is active, if its maximal flux is larger than
+    ``threshold`` times the maximal flux in the state vector. All blocks
+    which can be fed by active blocks (directly or through chains) are
+    active as well, because their flux might grow in the following steps.
+
+    Args:
+      phi (numpy.array): current state vector
+      bounds (numpy.array): boundaries of the blocks in the state vector
+      coupling (numpy.array): block coupling from :func:`_block_coupling`
+      threshold (float): relative flux threshold
+    Returns:
+      numpy.array: sorted indices of the active elements of ``phi``
+    """
+
+    phi_max = np.maximum.reduceat(np.abs(phi), bounds[:-1])
+    active = phi_max > threshold * np.max(phi_max)
+
+    # Add all blocks which are reachable from the active set
+    while True:
+        reach = active | np.any(coupling[:, active], axis=1)
+        if np.all(reach == active):
+            break
+        active = reach
+
+    return np.hstack([np.arange(bounds[i], bounds[i + 1])
+                      for i in np.flatnonzero(active)]).astype('int32')
+
+
+def _submatrix(mat, idcs):
+    """Returns the rows and columns ``idcs`` of a dense or sparse matrix.
+    """
+    if hasattr(mat, 'tocsr'):
+        return mat.tocsr()[idcs][:, idcs]
+    return mat[np.ix_(idcs, idcs)]
+
+
+class BlockTriangularMatrix(object):
+    """Packed storage of a matrix composed of species blocks.
+
+    Only the non-zero (daughter, mother) blocks are stored, in a
+    block-CSR layout. Since secondaries can not be more energetic than
+    their mother, most blocks are upper-triangular in energy. Those are
+    stored as packed triangles of size ``d * (d + 1) / 2``, the other
+    blocks are stored as dense rectangles. The product with a vector
+    runs over rows of fixed length without any index indirection within
+    a block.
+
+    Blocks are allowed to be shorter than the energy grid (see
+    ``variable_block_size`` in :mod:`mceq_config`). They always end at
+    the highest energy bin.
+
+    Args:
+      mat (numpy.array): matrix in dense or sparse representation
+      bounds (numpy.array): boundaries of the species blocks
+      d (int): dimension of the energy grid
+    """
+
+    def __init__(self, mat, bounds, d):
+        from scipy.sparse import coo_matrix
+
+        self.d = d
+        self.bounds = np.asarray(bounds)
+        self.shape = mat.shape
+        nblocks = self.bounds.size - 1
+        #: lowest energy index of each block
+        self.e_lidx = d - np.diff(self.bounds)
+        #: offsets of the rows of a packed triangle
+        self.tri_off = np.array(
+            [r * d - r * (r - 1) // 2 for r in xrange(d)], dtype='int64')
+
+        coo = coo_matrix(mat)
+        coo.sum_duplicates()
+        coo.eliminate_zeros()
+        bi = np.searchsorted(self.bounds, coo.row, side='right') - 1
+        bj = np.searchsorted(self.bounds, coo.col, side='right') - 1
+        # energy indices of the elements
+        er = coo.row - self.bounds[bi] + self.e_lidx[bi]
+        ec = coo.col - self.bounds[bj] + self.e_lidx[bj]
+
+        keys, inv = np.unique(bi * nblocks + bj, return_inverse=True)
+        blk_row = keys // nblocks
+        #: block column index of each stored block
+        self.blk_col = (keys % nblocks).astype('int64')
+        #: pointer to the first block of each block row
+        self.blk_ptr = np.hstack(
+            [[0], np.cumsum(np.bincount(blk_row, minlength=nblocks))
+             ]).astype('int64')
+        #: ``True`` for blocks stored as dense rectangles
+        self.blk_dense = np.bincount(
+            inv, weights=(er > ec), minlength=keys.size) > 0
+
+        sizes = np.where(self.blk_dense,
+                         (d - self.e_lidx[blk_row]) *
+                         (d - self.e_lidx[self.blk_col]), d * (d + 1) // 2)
+        #: offset of each block in :attr:`data`
+        self.blk_off = np.hstack([[0], np.cumsum(sizes)]).astype('int64')
+
+        ncols = d - self.e_lidx[bj]
+        pos = np.where(self.blk_dense[inv],
+                       (er - self.e_lidx[bi]) * ncols + ec - self.e_lidx[bj],
+                       self.tri_off[er] + ec - er) + self.blk_off[inv]
+        self.data = np.zeros(self.blk_off[-1], dtype=coo.dtype)
+        self.data[pos] = coo.data
+
+        if dbg > 1:
+            print("BlockTriangularMatrix(): {0} blocks, {1} dense, {2:3.1f} " +
+                  "MB (CSR {3:3.1f} MB)").format(
+                      keys.size, np.sum(self.blk_dense), self.nbytes / 1e6,
+                      coo.nnz * (coo.dtype.itemsize + 4) / 1e6)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        """Memory used by the packed data and the block index."""
+        return (self.data.nbytes + self.blk_col.nbytes + self.blk_ptr.nbytes +
+                self.blk_off.nbytes + self.blk_dense.nbytes)
+
+    def astype(self, dtype):
+        """Returns a copy with the data converted to ``dtype``."""
+        from copy import copy
+        new = copy(self)
+        new.data = self.data.astype(dtype)
+        return new
+
+    def tocsr(self):
+        """Converts the matrix to :class:`scipy.sparse.csr_matrix`."""
+        from scipy.sparse import coo_matrix
+
+        d = self.d
+        rows, cols, vals = [], [], []
+        for i in xrange(self.bounds.size - 1):
+            for b in xrange(self.blk_ptr[i], self.blk_ptr[i + 1]):
+                j = self.blk_col[b]
+                ei, ej = self.e_lidx[i], self.e_lidx[j]
+                if self.blk_dense[b]:
+                    er, ec = np.meshgrid(
+                        np.arange(ei, d), np.arange(ej, d), indexing='ij')
+                    er, ec = er.ravel(), ec.ravel()
+                    pos = (er - ei) * (d - ej) + ec - ej
+                else:
+                    er, ec = np.triu_indices(d)
+                    pos = self.tri_off[er] + ec - er
+                    sel = (er >= ei) & (ec >= ej)
+                    er, ec, pos = er[sel], ec[sel], pos[sel]
+                rows.append(er - ei + self.bounds[i])
+                cols.append(ec - ej + self.bounds[j])
+                vals.append(self.data[self.blk_off[b] + pos])
+
+        return coo_matrix(
+            (np.hstack(vals), (np.hstack(rows), np.hstack(cols))),
+            shape=self.shape).tocsr()
+
+    def dot(self, x):
+        """Returns the matrix-vector product with ``x``."""
+        kernel = _btr_dot_kernel()
+        if kernel is None:
+            return self.tocsr().dot(x)
+        y = np.zeros(self.shape[0], dtype=np.result_type(self.data, x))
+        kernel(self.blk_ptr, self.blk_col, self.blk_off, self.blk_dense,
+               self.bounds, self.e_lidx, self.tri_off, self.data, self.d, x,
+               y)
+        return y
+
+
+_btr_dot = []
+
+
+def _btr_dot_kernel():
+    """Returns the :mod:`numba` compiled product of a
+    :class:`BlockTriangularMatrix` with a vector, or ``None`` if
+    :mod:`numba` is not available.
+    """
+    if _btr_dot:
+        return _btr_dot[0]
+    try:
+        from numba import jit
+    except ImportError:
+        print("Warning! Numba not in PYTHONPATH. BlockTriangularMatrix " +
+              "will use the slow CSR product.")
+        _btr_dot.append(None)
+        return None
+
+    # The elements of x are addressed with explicit offsets, since a block
+    # may start above the lowest energy bin (bounds[j] < e_lidx[j])
+    @jit(nopython=True, nogil=True, fastmath=True)
+    def btr_dot(blk_ptr, blk_col, blk_off, blk_dense, bounds, e_lidx,
+                tri_off, data, d, x, y):
+        for i in range(blk_ptr.size - 1):
+            ei = e_lidx[i]
+            yl = bounds[i] - ei
+            for b in range(blk_ptr[i], blk_ptr[i + 1]):
+                j = blk_col[b]
+                ej = e_lidx[j]
+                # x[xl + k] is the element of energy bin k >= ej
+                xl = bounds[j] - ej
+                if blk_dense[b]:
+                    ncols = d - ej
+                    for r in range(ei, d):
+                        base = blk_off[b] + (r - ei) * ncols - ej
+                        acc = 0.
+                        for k in range(ej, d):
+                            acc += data[base + k] * x[xl + k]
+                        y[yl + r] += acc
+                else:
+                    for r in range(ei, d):
+                        lo = max(r, ej)
+                        base = blk_off[b] + tri_off[r] - r
+                        acc = 0.
+                        for k in range(lo, d):
+                            acc += data[base + k] * x[xl + k]
+                        y[yl + r] += acc
+
+    _btr_dot.append(btr_dot)
+    return btr_dot
+
+
+class SELLMatrix(object):
+    """Sparse matrix in the SELL-C-:math:`\\sigma` format.
+
+    Rows are sorted by their number of non-zero elements within windows
+    of ``sigma`` rows and grouped into chunks of ``chunk`` rows. Each
+    chunk is padded to its longest row and stored column-major, such
+    that the rows of a chunk are processed simultaneously.
+
+    Args:
+      mat (numpy.array): matrix in dense or sparse representation
+      chunk (int): number of rows per chunk (C)
+      sigma (int): size of the sorting window
+    """
+
+    def __init__(self, mat, chunk=8, sigma=256):
+        from scipy.sparse import csr_matrix
+
+        csr = csr_matrix(mat)
+        csr.sort_indices()
+        n = csr.shape[0]
+        self.shape = csr.shape
+        self.chunk = chunk
+        lengths = np.diff(csr.indptr)
+
+        perm = np.hstack([
+            w0 + np.argsort(-lengths[w0:w0 + sigma], kind='mergesort')
+            for w0 in xrange(0, n, sigma)
+        ])
+        nchunks = (n + chunk - 1) // chunk
+        #: row index of each chunk lane, -1 for padding
+        self.rows = -np.ones(nchunks * chunk, dtype='int64')
+        self.rows[:n] = perm
+        #: length of each chunk
+        self.chunk_len = np.zeros(nchunks, dtype='int64')
+        np.maximum.at(self.chunk_len, np.arange(n) // chunk, lengths[perm])
+        #: offset of each chunk in :attr:`data`
+        self.chunk_ptr = np.hstack(
+            [[0], np.cumsum(self.chunk_len * chunk)]).astype('int64')
+
+        pos = np.empty(n, dtype='int64')
+        pos[perm] = np.arange(n)
+        row_nz = np.repeat(np.arange(n), lengths)
+        k = np.arange(csr.nnz) - csr.indptr[row_nz]
+        idx = (self.chunk_ptr[pos[row_nz] // chunk] + k * chunk +
+               pos[row_nz] % chunk)
+        self.data = np.zeros(self.chunk_ptr[-1], dtype=csr.dtype)
+        self.cols = np.zeros(self.chunk_ptr[-1], dtype='int64')
+        self.data[idx] = csr.data
+        self.cols[idx] = csr.indices
+        self._csr = None
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        """Memory used by the padded data and the index arrays."""
+        return (self.data.nbytes + self.cols.nbytes + self.rows.nbytes +
+                self.chunk_ptr.nbytes)
+
+    def astype(self, dtype):
+        """Returns a copy with the data converted to ``dtype``."""
+        from copy import copy
+        new = copy(self)
+        new.data = self.data.astype(dtype)
+        new._csr = None
+        return new
+
+    def tocsr(self):
+        """Converts the matrix to :class:`scipy.sparse.csr_matrix`."""
+        from scipy.sparse import coo_matrix
+
+        if self._csr is None:
+            lane = np.hstack([
+                np.tile(np.arange(self.chunk), self.chunk_len[c])
+                for c in xrange(self.chunk_len.size)
+            ] + [np.zeros(0, dtype='int64')])
+            chunk_idx = np.repeat(
+                np.arange(self.chunk_len.size), self.chunk_len * self.chunk)
+            rows = self.rows[chunk_idx * self.chunk + lane]
+            sel = (rows >= 0) & (self.data != 0)
+            self._csr = coo_matrix(
+                (self.data[sel], (rows[sel], self.cols[sel])),
+                shape=self.shape).tocsr()
+        return self._csr
+
+    def dot(self, x):
+        """Returns the matrix-vector product with ``x``."""
+        kernel = _sell_dot_kernel()
+        if kernel is None:
+            return self.tocsr().dot(x)
+        y = np.zeros(self.shape[0], dtype=np.result_type(self.data, x))
+        kernel(self.chunk_ptr, self.chunk_len, self.rows, self.cols,
+               self.data, self.chunk, x, y)
+        return y
+
+
+_sell_dot = []
+
+
+def _sell_dot_kernel():
+    """Returns the :mod:`numba` compiled product of a
+    :class:`SELLMatrix` with a vector, or ``None`` if :mod:`numba`
+    is not available.
+    """
+    if _sell_dot:
+        return _sell_dot[0]
+    try:
+        from numba import jit
+    except ImportError:
+        print("Warning! Numba not in PYTHONPATH. SELLMatrix " +
+              "will use the slow CSR product.")
+        _sell_dot.append(None)
+        return None
+
+    @jit(nopython=True, nogil=True, fastmath=True)
+    def sell_dot(chunk_ptr, chunk_len, rows, cols, data, chunk, x, y):
+        acc = np.zeros(chunk, dtype=y.dtype)
+        for c in range(chunk_len.size):
+            acc[:] = 0.
+            base = chunk_ptr[c]
+            for k in range(chunk_len[c]):
+                off = base + k * chunk
+                for lane in range(chunk):
+                    acc[lane] += data[off + lane] * x[cols[off + lane]]
+            for lane in range(chunk):
+                r = rows[c * chunk + lane]
+                if r >= 0:
+                    y[r] = acc[lane]
+
+    _sell_dot.append(sell_dot)
+    return sell_dot
+
+
+def convert_matrix(mat, fmt, bounds=None, d=None):
+    """Converts a matrix into one of the formats supported by
+    :func:`kern_numpy`.
+
+    Args:
+      mat (numpy.array): matrix in dense or sparse representation
+      fmt (str): 'csr', 'bsr', 'sell', 'packed' or 'dense'
+      bounds (numpy.array): boundaries of the species blocks (only 'packed')
+      d (int): dimension of the energy grid (only 'packed')
+    Returns:
+      matrix object with a ``dot`` method
+    """
+    from scipy.sparse import csr_matrix, bsr_matrix
+
+    if fmt == 'csr':
+        return csr_matrix(mat)
+    elif fmt == 'bsr':
+        for bsize in [8, 4, 2]:
+            if mat.shape[0] % bsize == 0:
+                return bsr_matrix(mat, blocksize=(bsize, bsize))
+        raise Exception("convert_matrix(): no BSR block size found " +
+                        "for dimension {0}.".format(mat.shape[0]))
+    elif fmt == 'sell':
+        return SELLMatrix(mat)
+    elif fmt == 'packed':
+        if bounds is None:
+            raise Exception("convert_matrix(): the packed format requires " +
+                            "contiguous species blocks.")
+        return BlockTriangularMatrix(mat, bounds, d)
+    elif fmt == 'dense':
+        return mat.toarray() if hasattr(mat, 'toarray') else np.asarray(mat)
+
+    raise Exception(
+        "convert_matrix(): unknown matrix format '{0}'.".format(fmt))
+
+
+def matrix_fingerprint(*mats):
+    """Returns a hash of the sparsity pattern and the values of
+    the matrices.
+    """
+    from hashlib import sha1
+    from scipy.sparse import csr_matrix
+
+    h = sha1()
+    for mat in mats:
+        csr = csr_matrix(mat)
+        csr.sort_indices()
+        h.update(str(csr.shape) + str(csr.dtype))
+        for arr in (csr.indptr, csr.indices, csr.data):
+            h.update(np.ascontiguousarray(arr).tostring())
+    return h.hexdigest()
+
+
+class SolverSession(object):
+    """Bundles the state, which is shared by all integrations with the
+    same set of matrices.
+
+    The session holds the matrices in the format and precision of the
+    kernels, the index tables of the kernel state vector, the kernel
+    contexts with the loaded libraries and handles (e.g.
+    :class:`MKLSparseContext`) and a work buffer for the state vector.
+    It is created by :class:`MCEq.core.MCEqRun` and discarded when the
+    matrices are regenerated.
+
+    Args:
+      idcs (numpy.array): indices of the kernel state vector in the full
+        state vector, or ``None`` if the full state vector is solved
+      int_m (numpy.array): interaction matrix :eq:`int_matrix`
+      dec_m (numpy.array): decay  matrix :eq:`dec_matrix`
+      mu_idcs (list): slices or index arrays of the muon species
+      block_bounds (numpy.array): boundaries of the species blocks or ``None``
+      dim_states (int): dimension of the full state vector
+      contexts (dict,optional): kernel contexts by backend, which are
+        kept across sessions to avoid loading the libraries again
+    """
+
+    def __init__(self, idcs, int_m, dec_m, mu_idcs, block_bounds,
+                 dim_states, contexts=None):
+
+        if config['FP_precision'] == 32:
+            self.fl_pr = np.float32
+        elif config['FP_precision'] == 64:
+            self.fl_pr = np.float64
+        else:
+            raise Exception("SolverSession(): Unknown precision specified.")
+
+        self.idcs = idcs
+        self.mu_idcs = mu_idcs
+        self.block_bounds = block_bounds
+        self.dim_states = dim_states
+        self.contexts = contexts if contexts is not None else {}
+
+        # Matrices are converted once
+        self.int_m, self.dec_m = int_m, dec_m
+        if int_m.dtype != self.fl_pr:
+            self.int_m = int_m.astype(self.fl_pr)
+            self.dec_m = dec_m.astype(self.fl_pr)
+
+        #: work buffer for the state vector of the kernels
+        self.phi = np.zeros(int_m.shape[0], dtype=self.fl_pr)
+        #: number of integrations performed in this session
+        self.n_solves = 0
+
+    def project(self, phi):
+        """Copies the full state vector ``phi`` to the work buffer.
+
+        Args:
+          phi (numpy.array): full state vector
+        Returns:
+          numpy.array: work buffer with the kernel state vector
+        """
+        if self.idcs is None:
+            self.phi[:] = phi
+        else:
+            self.phi[:] = phi[self.idcs]
+        return self.phi
+
+    def kernel_indices(self, full_idcs):
+        """Returns the positions of elements of the full state vector
+        in the kernel state vector.
+
+        Args:
+          full_idcs (numpy.array): indices in the full state vector
+        Returns:
+          numpy.array: indices in the kernel state vector, -1 for
+          elements which are not solved
+        """
+        if self.idcs is None:
+            return np.asarray(full_idcs)
+        kernel_map = -np.ones(self.dim_states, dtype='int32')
+        kernel_map[self.idcs] = np.arange(self.idcs.size)
+        return kernel_map[full_idcs]
+
+    def expand(self, phi):
+        """Returns a copy of the kernel state vector ``phi`` mapped to
+        the full state vector.
+
+        Args:
+          phi (numpy.array): kernel state vector
+        Returns:
+          numpy.array: full state vector
+        """
+        full_phi = np.zeros(self.dim_states, dtype=phi.dtype)
+        if self.idcs is None:
+            full_phi[:] = phi
+        else:
+            full_phi[self.idcs] = phi
+        return full_phi
+
+
+class GridSolution(object):
+    """Preallocated storage of the state vectors on the depth grid.
+
+    Only the elements ``idcs`` of the full state vector are stored, in a
+    ``(n_grid, idcs.size)`` array, which is optionally a :class:`numpy.memmap`
+    on disk. The kernels write into the rows in place. Indexing returns
+    full state vectors, where elements which are not stored are zero, such
+    that the object can replace the list of state vectors in
+    :attr:`MCEq.core.MCEqRun.grid_sol`.
+
+    Args:
+      n_grid (int): number of grid points
+      dim_states (int): dimension of the full state vector
+      idcs (numpy.array,optional): stored elements of the full state
+        vector, ``None`` for all
+      dtype (numpy.dtype,optional): precision
+      fname (str,optional): file of the memory map, ``None`` to keep
+        the solutions in memory
+      mode (str,optional): mode of the memory map, ``r+`` to continue
+        writing an existing file. With ``w+``, a new file replaces
+        ``fname``, while earlier memory maps of ``fname`` stay valid.
+    """
 
-    grid_sol = []
-    grid_step = 0
-
-    imc = int_m
-    dmc = dec_m
-    dxc = dX
-    ric = rho_inv
-    phc = phi
-
-    enmuloss = config['enable_muon_energy_loss']
-    de = mu_egrid.size
-    muloss_min_step = config['muon_energy_loss_min_step']
-    lidx, nmuspec = mu_lidx_nsp
-    # Accumulate at least a few g/cm2 for energy loss steps
-    # to avoid numerical errors
-    dXaccum = 0.
-
-    if config['FP_precision'] == 32:
-        imc = int_m.astype(np.float32)
-        dmc = dec_m.astype(np.float32)
-        dxc = dX.astype(np.float32)
-        ric = rho_inv.astype(np.float32)
-        phc = phi.astype(np.float32)
-
-    from time import time
-    start = time()
-    stepper = None
-
-    # Implmentation of first interaction mode
-    if config['first_interaction_mode']:
-        def stepper(step):
-            if step <= fa_vars['max_step']:
-                return (- fa_vars['Lambda_int'] * phc
-                        + imc.dot(fa_vars['fi_switch'][step] * phc)
-                        + dmc.dot(ric[step] * phc)) * dxc[step]
-            else:
-                # Equivalent of setting interaction matrix to 0
-                return (- fa_vars['Lambda_int'] * phc
-                        + dmc.dot(ric[step] * phc)) * dxc[step]
-    else:
-        def stepper(step):
-            return (imc.dot(phc)
-                    + dmc.dot(ric[step] * phc)) * dxc[step]
-
-    for step in xrange(nsteps):
-        if prog_bar and (step % 200 == 0):
-            prog_bar.update(step)
-        phc += stepper(step)
-
-        dXaccum += dxc[step]
-
-        if (enmuloss and
-                (dXaccum > muloss_min_step or step == nsteps - 1)):
-            for nsp in xrange(nmuspec):
-                phc[lidx + de * nsp: lidx + de * (nsp + 1)] = np.interp(
-                    mu_egrid, mu_egrid + mu_dEdX * dXaccum,
-                    phc[lidx + de * nsp:lidx + de * (nsp + 1)])
-
-            dXaccum = 0.
-
-        if (grid_idcs and grid_step < len(grid_idcs)
-                and grid_idcs[grid_step] == step):
-            grid_sol.append(np.copy(phc))
-            grid_step += 1
-
-    print "Performance: {0:6.2f}ms/iteration".format(1e3 * (time() - start) / float(nsteps))
-
-    return phc, grid_sol
+    def __init__(self, n_grid, dim_states, idcs=None, dtype=np.float64,
+                 fname=None, mode='w+'):
+        self.dim_states = dim_states
+        self.idcs = idcs
+        self.fname = fname
+        shape = (n_grid, dim_states if idcs is None else idcs.size)
+        if fname is not None and n_grid > 0 and mode == 'w+':
+            # A new file replaces fname, such that memory maps of earlier
+            # solutions with the same file name keep their content
+            import os
+            tmp_fname = fname + '.tmp{0}'.format(os.getpid())
+            self.data = np.memmap(tmp_fname, dtype=dtype, mode=mode,
+                                  shape=shape)
+            os.rename(tmp_fname, fname)
+        elif fname is not None and n_grid > 0:
+            self.data = np.memmap(fname, dtype=dtype, mode=mode, shape=shape)
+        else:
+            self.data = np.zeros(shape, dtype=dtype)
+        #: number of stored grid points
+        self.n_filled = 0
+        self.src, self.dst = slice(None), slice(None)
+
+    def bind(self, session):
+        """Maps the kernel state vector of ``session`` to the columns."""
+        full_idcs = (np.arange(self.dim_states)
+                     if self.idcs is None else self.idcs)
+        if session.idcs is None and self.idcs is None:
+            self.src, self.dst = slice(None), slice(None)
+            return
+        kidx = session.kernel_indices(full_idcs)
+        self.dst = np.nonzero(kidx >= 0)[0]
+        self.src = kidx[self.dst]
+
+    def store(self, i, phi):
+        """Stores the kernel state vector ``phi`` at grid point ``i``."""
+        self.data[i, self.dst] = phi[self.src]
+        self.n_filled = max(self.n_filled, i + 1)
+
+    def __len__(self):
+        return self.n_filled
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.n_filled
+        if not 0 <= i < self.n_filled:
+            raise IndexError('GridSolution: index out of range')
+        if self.idcs is None:
+            return np.array(self.data[i])
+        phi = np.zeros(self.dim_states, dtype=self.data.dtype)
+        phi[self.idcs] = self.data[i]
+        return phi
+
+    def snapshot(self):
+        """Returns the content for a checkpoint. Memory maps are flushed
+        and only referenced. Stored rows are not modified later, therefore
+        rows in memory are returned without copy."""
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+            return {'fname': self.fname, 'n_filled': self.n_filled}
+        return {'data': self.data[:self.n_filled], 'n_filled': self.n_filled}
+
+    def restore(self, snapshot):
+        """Restores the content of a :func:`snapshot`."""
+        n = snapshot['n_filled']
+        if 'data' in snapshot:
+            self.data[:n] = snapshot['data']
+        elif snapshot['fname'] != self.fname:
+            self.data[:n] = np.memmap(snapshot['fname'], dtype=self.data.dtype,
+                                      mode='r', shape=self.data.shape)[:n]
+        self.n_filled = n
 
 
 def kern_CUDA_dense(nsteps, dX, rho_inv, int_m, dec_m,
                     phi, grid_idcs,
-                    mu_egrid=None, mu_dEdX=None, mu_lidx_nsp=None,
+                    mu_egrid=None, mu_dEdX=None, mu_idcs=None,
                     prog_bar=None):
     """`NVIDIA CUDA cuBLAS <https://developer.nvidia.com/cublas>`_ implementation
     of forward-euler integration.
 
     Function requires a working :mod:`numbapro` installation. It is typically slower
     compared to :func:`kern_MKL_sparse` but it depends on your hardware.
+    Wrapper of :class:`MCEq.backends.CUDADenseBackend`.
 
     Args:
       nsteps (int): number of integration steps
@@ -156,55 +733,18 @@ def kern_CUDA_dense(nsteps, dX, rho_inv, int_m, dec_m,
     Returns:
       numpy.array: state vector :math:`\\Phi(X_{nsteps})` after integration
     """
-
-    fl_pr = None
-    if config['FP_precision'] == 32:
-        fl_pr = np.float32
-    elif config['FP_precision'] == 64:
-        fl_pr = np.float64
-    else:
-        raise Exception("kern_CUDA_dense(): Unknown precision specified.")
-
-    # if config['enable_muon_energyloss']:
-    #     raise NotImplementedError('kern_CUDA_dense(): ' +
-    #         'Energy loss not imlemented for this solver.')
+    from MCEq.backends import CUDADenseBackend, integrate
 
     if config['enable_muon_energy_loss']:
         raise NotImplementedError('kern_CUDA_dense(): ' +
                                   'Energy loss not imlemented for this solver.')
 
-    #=======================================================================
-    # Setup GPU stuff and upload data to it
-    #=======================================================================
-    try:
-        from accelerate.cuda.blas import Blas
-        from accelerate.cuda import cuda
-    except ImportError:
-        raise Exception("kern_CUDA_dense(): Numbapro CUDA libaries not " +
-                        "installed.\nCan not use GPU.")
-    cubl = Blas()
-    m, n = int_m.shape
-    stream = cuda.stream()
-    cu_int_m = cuda.to_device(int_m.astype(fl_pr), stream)
-    cu_dec_m = cuda.to_device(dec_m.astype(fl_pr), stream)
-    cu_curr_phi = cuda.to_device(phi.astype(fl_pr), stream)
-    cu_delta_phi = cuda.device_array(phi.shape, dtype=fl_pr)
-
-    from time import time
-    start = time()
-
-    for step in xrange(nsteps):
-        if prog_bar:
-            prog_bar.update(step)
-        cubl.gemv(trans='N', m=m, n=n, alpha=fl_pr(1.0), A=cu_int_m,
-                  x=cu_curr_phi, beta=fl_pr(0.0), y=cu_delta_phi)
-        cubl.gemv(trans='N', m=m, n=n, alpha=fl_pr(rho_inv[step]),
-                  A=cu_dec_m, x=cu_curr_phi, beta=fl_pr(1.0), y=cu_delta_phi)
-        cubl.axpy(alpha=fl_pr(dX[step]), x=cu_delta_phi, y=cu_curr_phi)
-
-    print "Performance: {0:6.2f}ms/iteration".format(1e3 * (time() - start) / float(nsteps))
+    session = SolverSession(None, int_m, dec_m, mu_idcs, None, phi.size)
+    backend = CUDADenseBackend()
+    backend.setup(session, session.project(phi))
 
-    return cu_curr_phi.copy_to_host(), []
+    return integrate(backend, nsteps, dX, rho_inv, grid_idcs, mu_egrid,
+                     mu_dEdX, mu_idcs, prog_bar)
 
 
 class CUDASparseContext(object):
@@ -367,268 +907,229 @@ class CUDASparseContext(object):
 
 
 def kern_CUDA_sparse(nsteps, dX, rho_inv, context, phi, grid_idcs,
-                     mu_egrid=None, mu_dEdX=None, mu_lidx_nsp=None,
+                     mu_egrid=None, mu_dEdX=None, mu_idcs=None,
                      prog_bar=None):
     """`NVIDIA CUDA cuSPARSE <https://developer.nvidia.com/cusparse>`_ implementation
     of forward-euler integration.
 
     Function requires a working :mod:`accelerate` installation.
+    Wrapper of :class:`MCEq.backends.CUDASparseBackend`.
 
     Args:
       nsteps (int): number of integration steps
       dX (numpy.array[nsteps]): vector of step-sizes :math:`\\Delta X_i` in g/cm**2
       rho_inv (numpy.array[nsteps]): vector of density values :math:`\\frac{1}{\\rho(X_i)}`
-      int_m (numpy.array): interaction matrix :eq:`int_matrix` in dense or sparse representation
-      dec_m (numpy.array): decay  matrix :eq:`dec_matrix` in dense or sparse representation
+      context (object): instance of :class:`CUDASparseContext`
       phi (numpy.array): initial state vector :math:`\\Phi(X_0)`
       prog_bar (object,optional): handle to :class:`ProgressBar` object
     Returns:
       numpy.array: state vector :math:`\\Phi(X_{nsteps})` after integration
     """
+    from MCEq.backends import CUDASparseBackend, integrate
 
-    c = context
-    c.set_phi(phi)
+    backend = CUDASparseBackend()
+    backend.ctx = context
+    context.set_phi(phi)
 
-    enmuloss = config['enable_muon_energy_loss']
-    de = mu_egrid.size
-    mu_egrid = mu_egrid.astype(c.fl_pr)
-    muloss_min_step = config['muon_energy_loss_min_step']
-    lidx, nmuspec = mu_lidx_nsp
+    return integrate(backend, nsteps, dX, rho_inv, grid_idcs,
+                     mu_egrid.astype(context.fl_pr), mu_dEdX, mu_idcs,
+                     prog_bar)
 
-    # Accumulate at least a few g/cm2 for energy loss steps
-    # to avoid numerical errors
-    dXaccum = 0.
 
-    grid_step = 0
-    grid_sol = []
+class MKLSparseContext(object):
+    """Handles of the `Intel MKL inspector-executor sparse BLAS
+    <https://software.intel.com/en-us/mkl-developer-reference-c-inspector-executor-sparse-blas-routines>`_
+    for the interaction and decay matrices.
 
-    from time import time
-    start = time()
+    The matrices are analyzed and optimized once by MKL for repeated
+    matrix-vector products. The handles are reused by all following calls
+    of :func:`kern_MKL_sparse`, until new matrices are set with
+    :func:`set_matrices`.
 
-    for step in xrange(nsteps):
-        if prog_bar and (step % 5 == 0):
-            prog_bar.update(step)
+    Function requires that the path to the MKL runtime library
+    ``libmkl_rt.[so/dylib]`` is defined in the config file.
 
-        c.do_step(rho_inv[step], dX[step])
+    Args:
+      int_m (scipy.sparse.csr_matrix): interaction matrix :eq:`int_matrix`
+      dec_m (scipy.sparse.csr_matrix): decay  matrix :eq:`dec_matrix`
+      expected_calls (int): number of expected products, hint for MKL
+    """
 
-        dXaccum += dX[step]
+    # Constants from mkl_spblas.h
+    SPARSE_STATUS_SUCCESS = 0
+    SPARSE_INDEX_BASE_ZERO = 0
+    SPARSE_OPERATION_NON_TRANSPOSE = 10
+    SPARSE_MATRIX_TYPE_GENERAL = 20
+    SPARSE_FILL_MODE_FULL = 42
+    SPARSE_DIAG_NON_UNIT = 50
 
-        if enmuloss and (dXaccum > muloss_min_step or step == nsteps - 1):
-            # Download current solution vector to host
-            phc = c.get_phi()
-            for nsp in xrange(nmuspec):
-                phc[lidx + de * nsp: lidx + de * (nsp + 1)] = np.interp(
-                    mu_egrid, mu_egrid + mu_dEdX * dXaccum,
-                    phc[lidx + de * nsp:lidx + de * (nsp + 1)])
-            # Upload changed vector back..
-            c.set_phi(phc)
-            dXaccum = 0.
+    def __init__(self, int_m, dec_m, expected_calls=100000):
+        from ctypes import cdll, c_int, byref, Structure
 
-        if (grid_idcs and grid_step < len(grid_idcs)
-                and grid_idcs[grid_step] == step):
-            grid_sol.append(c.get_phi())
-            grid_step += 1
+        try:
+            self.mkl = cdll.LoadLibrary(config['MKL_path'])
+        except OSError:
+            raise Exception("MKLSparseContext(): MKL runtime library not " +
+                            "found. Please check path.")
 
-    print "Performance: {0:6.2f}ms/iteration".format(1e3 * (time() - start) / float(nsteps))
+        if config['FP_precision'] == 32:
+            from ctypes import c_float as c_fl
+            self.fl_pr = np.float32
+            self.create_csr = self.mkl.mkl_sparse_s_create_csr
+            self.mv = self.mkl.mkl_sparse_s_mv
+            self.axpy = self.mkl.cblas_saxpy
+        elif config['FP_precision'] == 64:
+            from ctypes import c_double as c_fl
+            self.fl_pr = np.float64
+            self.create_csr = self.mkl.mkl_sparse_d_create_csr
+            self.mv = self.mkl.mkl_sparse_d_mv
+            self.axpy = self.mkl.cblas_daxpy
+        else:
+            raise Exception("MKLSparseContext(): Unknown precision specified.")
+        self.c_fl = c_fl
 
-    return c.get_phi(), grid_sol
+        class matrix_descr(Structure):
+            _fields_ = [('type', c_int), ('mode', c_int), ('diag', c_int)]
 
+        self.descr = matrix_descr(self.SPARSE_MATRIX_TYPE_GENERAL,
+                                  self.SPARSE_FILL_MODE_FULL,
+                                  self.SPARSE_DIAG_NON_UNIT)
+        self.expected_calls = expected_calls
 
-def kern_MKL_sparse(nsteps, dX, rho_inv, int_m, dec_m,
-                    phi, grid_idcs,
-                    mu_egrid=None, mu_dEdX=None, mu_lidx_nsp=None,
+        # Set number of threads
+        self.mkl.mkl_set_num_threads(byref(c_int(config['MKL_threads'])))
+
+        self.handles = []
+        self.set_matrices(int_m, dec_m)
+
+    def _check(self, status, func):
+        if status != self.SPARSE_STATUS_SUCCESS:
+            raise Exception("MKLSparseContext(): {0} returned status {1}."
+                            .format(func, status))
+
+    def _create_handle(self, mat):
+        """Creates and optimizes the MKL handle of a CSR matrix."""
+        from ctypes import c_int, c_void_p, POINTER, byref
+
+        m, n = mat.shape
+        # MKL only references the arrays, they have to be kept alive
+        arrays = (mat.data.astype(self.fl_pr, copy=False),
+                  mat.indices.astype(np.int32, copy=False),
+                  mat.indptr.astype(np.int32, copy=False))
+        data, indices, indptr = arrays
+        handle = c_void_p()
+        self._check(
+            self.create_csr(
+                byref(handle), self.SPARSE_INDEX_BASE_ZERO, c_int(m), c_int(n),
+                indptr[:-1].ctypes.data_as(POINTER(c_int)),
+                indptr[1:].ctypes.data_as(POINTER(c_int)),
+                indices.ctypes.data_as(POINTER(c_int)),
+                data.ctypes.data_as(POINTER(self.c_fl))),
+            'mkl_sparse_?_create_csr')
+        self._check(
+            self.mkl.mkl_sparse_set_mv_hint(
+                handle, self.SPARSE_OPERATION_NON_TRANSPOSE, self.descr,
+                c_int(self.expected_calls)), 'mkl_sparse_set_mv_hint')
+        self._check(self.mkl.mkl_sparse_optimize(handle), 'mkl_sparse_optimize')
+        self.handles.append((handle, arrays))
+        return handle
+
+    def _destroy_handles(self):
+        for handle, _ in self.handles:
+            self.mkl.mkl_sparse_destroy(handle)
+        self.handles = []
+
+    def set_matrices(self, int_m, dec_m):
+        from ctypes import c_int, POINTER
+
+        # Skip the analysis if the handles belong to the same matrices
+        if (self.handles and self.matrices[0] is int_m and
+                self.matrices[1] is dec_m):
+            return
+        self.matrices = (int_m, dec_m)
+
+        self._destroy_handles()
+        self.m = int_m.shape[0]
+        self.int_m = self._create_handle(int_m)
+        self.dec_m = self._create_handle(dec_m)
+
+        self.phi = np.zeros(self.m, dtype=self.fl_pr)
+        self.delta_phi = np.zeros(self.m, dtype=self.fl_pr)
+        self.phi_p = self.phi.ctypes.data_as(POINTER(self.c_fl))
+        self.delta_phi_p = self.delta_phi.ctypes.data_as(POINTER(self.c_fl))
+        self.c_m = c_int(self.m)
+        self.cione = c_int(1)
+
+    def set_phi(self, phi):
+        self.phi[:] = phi
+
+    def get_phi(self):
+        return np.copy(self.phi)
+
+    def do_step(self, rho_inv, dX):
+        c_fl = self.c_fl
+        # delta_phi = int_m.dot(phi)
+        self.mv(self.SPARSE_OPERATION_NON_TRANSPOSE, c_fl(1.), self.int_m,
+                self.descr, self.phi_p, c_fl(0.), self.delta_phi_p)
+        # delta_phi = rho_inv * dec_m.dot(phi) + delta_phi
+        self.mv(self.SPARSE_OPERATION_NON_TRANSPOSE, c_fl(rho_inv),
+                self.dec_m, self.descr, self.phi_p, c_fl(1.),
+                self.delta_phi_p)
+        # phi = delta_phi * dX + phi
+        self.axpy(self.c_m, c_fl(dX), self.delta_phi_p, self.cione,
+                  self.phi_p, self.cione)
+
+    def __del__(self):
+        try:
+            self._destroy_handles()
+        except AttributeError:
+            pass
+
+
+def kern_MKL_sparse(nsteps, dX, rho_inv, context, phi, grid_idcs,
+                    mu_egrid=None, mu_dEdX=None, mu_idcs=None,
                     prog_bar=None):
     """`Intel MKL sparse BLAS
     <https://software.intel.com/en-us/articles/intel-mkl-sparse-blas-overview?language=en>`_
     implementation of forward-euler integration.
 
-    Function requires that the path to the MKL runtime library ``libmkl_rt.[so/dylib]``
-    defined in the config file.
+    The matrices are passed as handles of the inspector-executor API
+    in :class:`MKLSparseContext`. Wrapper of :class:`MCEq.backends.MKLBackend`.
 
     Args:
       nsteps (int): number of integration steps
       dX (numpy.array[nsteps]): vector of step-sizes :math:`\\Delta X_i` in g/cm**2
       rho_inv (numpy.array[nsteps]): vector of density values :math:`\\frac{1}{\\rho(X_i)}`
-      int_m (numpy.array): interaction matrix :eq:`int_matrix` in dense or sparse representation
-      dec_m (numpy.array): decay  matrix :eq:`dec_matrix` in dense or sparse representation
+      context (object): instance of :class:`MKLSparseContext`
       phi (numpy.array): initial state vector :math:`\\Phi(X_0)`
       grid_idcs (list): indices at which longitudinal solutions have to be saved.
       prog_bar (object,optional): handle to :class:`ProgressBar` object
     Returns:
       numpy.array: state vector :math:`\\Phi(X_{nsteps})` after integration
     """
+    from MCEq.backends import MKLBackend, integrate
 
-    from ctypes import cdll, c_int, c_char, POINTER, byref
-
-    try:
-        mkl = cdll.LoadLibrary(config['MKL_path'])
-    except OSError:
-        raise Exception("kern_MKL_sparse(): MKL runtime library not " +
-                        "found. Please check path.")
-
-    gemv = None
-    axpy = None
-    np_fl = None
-    if config['FP_precision'] == 32:
-        from ctypes import c_float as fl_pr
-        # sparse CSR-matrix x dense vector
-        gemv = mkl.mkl_scsrmv
-        # dense vector + dense vector
-        axpy = mkl.cblas_saxpy
-        np_fl = np.float32
-    elif config['FP_precision'] == 64:
-        from ctypes import c_double as fl_pr
-        # sparse CSR-matrix x dense vector
-        gemv = mkl.mkl_dcsrmv
-        # dense vector + dense vector
-        axpy = mkl.cblas_daxpy
-        np_fl = np.float64
-    else:
-        raise Exception("kern_MKL_sparse(): Unknown precision specified.")
-
-    # Set number of threads
-    mkl.mkl_set_num_threads(byref(c_int(config['MKL_threads'])))
-
-    # Prepare CTYPES pointers for MKL sparse CSR BLAS
-    int_m_data = int_m.data.ctypes.data_as(POINTER(fl_pr))
-    int_m_ci = int_m.indices.ctypes.data_as(POINTER(c_int))
-    int_m_pb = int_m.indptr[:-1].ctypes.data_as(POINTER(c_int))
-    int_m_pe = int_m.indptr[1:].ctypes.data_as(POINTER(c_int))
-
-    dec_m_data = dec_m.data.ctypes.data_as(POINTER(fl_pr))
-    dec_m_ci = dec_m.indices.ctypes.data_as(POINTER(c_int))
-    dec_m_pb = dec_m.indptr[:-1].ctypes.data_as(POINTER(c_int))
-    dec_m_pe = dec_m.indptr[1:].ctypes.data_as(POINTER(c_int))
-
-    npphi = np.copy(phi).astype(np_fl)
-    phi = npphi.ctypes.data_as(POINTER(fl_pr))
-    npdelta_phi = np.zeros_like(npphi)
-    delta_phi = npdelta_phi.ctypes.data_as(POINTER(fl_pr))
-
-    trans = c_char('n')
-    npmatd = np.chararray(6)
-    npmatd[0] = 'G'
-    npmatd[3] = 'C'
-    matdsc = npmatd.ctypes.data_as(POINTER(c_char))
-    m = c_int(int_m.shape[0])
-    cdzero = fl_pr(0.)
-    cdone = fl_pr(1.)
-    cione = c_int(1)
-
-    enmuloss = config['enable_muon_energy_loss']
-    de = mu_egrid.size
-    mu_egrid = mu_egrid.astype(np_fl)
-    mu_dEdX = mu_dEdX.astype(np_fl)
-    muloss_min_step = config['muon_energy_loss_min_step']
-    lidx, nmuspec = mu_lidx_nsp
-    # Accumulate at least a few g/cm2 for energy loss steps
-    # to avoid numerical errors
-    dXaccum = 0.
-
-    grid_step = 0
-    grid_sol = []
-
-    from time import time
-    start = time()
-
-    for step in xrange(nsteps):
-        if prog_bar:
-            prog_bar.update(step)
-
-        # delta_phi = int_m.dot(phi)
-        gemv(byref(trans), byref(m), byref(m),
-             byref(cdone), matdsc,
-             int_m_data, int_m_ci, int_m_pb, int_m_pe,
-             phi, byref(cdzero), delta_phi)
-        # delta_phi = rho_inv * dec_m.dot(phi) + delta_phi
-        gemv(byref(trans), byref(m), byref(m),
-             byref(fl_pr(rho_inv[step])), matdsc,
-             dec_m_data, dec_m_ci, dec_m_pb, dec_m_pe,
-             phi, byref(cdone), delta_phi)
-        # phi = delta_phi * dX + phi
-        axpy(m, fl_pr(dX[step]),
-             delta_phi, cione, phi, cione)
-
-        dXaccum += dX[step]
-
-        if (enmuloss and
-                (dXaccum > muloss_min_step or step == nsteps - 1)):
-            for nsp in xrange(nmuspec):
-                npphi[lidx + de * nsp: lidx + de * (nsp + 1)] = np.interp(
-                    mu_egrid, mu_egrid + mu_dEdX * dXaccum,
-                    npphi[lidx + de * nsp:lidx + de * (nsp + 1)])
-
-            dXaccum = 0.
+    backend = MKLBackend()
+    backend.ctx = context
+    context.set_phi(phi)
 
-        if (grid_idcs and grid_step < len(grid_idcs)
-                and grid_idcs[grid_step] == step):
-            grid_sol.append(np.copy(npphi))
-            grid_step += 1
-
-    print "Performance: {0:6.2f}ms/iteration".format(1e3 * (time() - start) / float(nsteps))
-
-    return npphi, grid_sol
+    return integrate(backend, nsteps, dX, rho_inv, grid_idcs,
+                     mu_egrid.astype(context.fl_pr),
+                     mu_dEdX.astype(context.fl_pr), mu_idcs, prog_bar)
 
 
 def kern_XeonPHI_sparse(nsteps, dX, rho_inv, int_m, dec_m,
                         phi, grid_idcs,
-                        mu_egrid=None, mu_dEdX=None, mu_lidx_nsp=None,
+                        mu_egrid=None, mu_dEdX=None, mu_idcs=None,
                         prog_bar=None):
     """Experimental Xeon Phi support using pyMIC library.
-    """
-
-    import sys
-    import os
-    sys.path.append(os.path.join(os.path.expanduser("~"), 'work/git/pymic'))
-    import pymic as mic
-
-    # load the library with the kernel function (on the target)
-
-    device = mic.devices[1]
-    base = os.path.dirname(os.path.abspath(__file__))
-    library = device.load_library(os.path.join(base, "../Xeon_Phi/libmceq.so"))
-
-    # use the default stream
-
-    stream = device.get_default_stream()
 
-    # Prepare CTYPES pointers for MKL sparse CSR BLAS
-    mic_int_m_data = stream.bind(int_m.data)
-    mic_int_m_ci = stream.bind(int_m.indices)
-    mic_int_m_pb = stream.bind(int_m.indptr[:-1])
-    mic_int_m_pe = stream.bind(int_m.indptr[1:])
-
-    mic_dec_m_data = stream.bind(dec_m.data)
-    mic_dec_m_ci = stream.bind(dec_m.indices)
-    mic_dec_m_pb = stream.bind(dec_m.indptr[:-1])
-    mic_dec_m_pe = stream.bind(dec_m.indptr[1:])
-
-    npphi = np.copy(phi)
-    mic_phi = stream.bind(npphi)
-    npdelta_phi = np.zeros_like(npphi)
-    mic_delta_phi = stream.bind(npdelta_phi)
-    mic_dX = stream.bind(dX)
-    mic_rho_inv = stream.bind(rho_inv)
-
-    m = int_m.shape[0]
-
-    from time import time
-    start = time()
-
-    stream.invoke(library.mceq_kernel,
-                  m, nsteps,
-                  mic_phi, mic_delta_phi,
-                  mic_rho_inv, mic_dX,
-                  mic_int_m_data, mic_int_m_ci,
-                  mic_int_m_pb, mic_int_m_pe,
-                  mic_dec_m_data, mic_dec_m_ci,
-                  mic_dec_m_pb, mic_dec_m_pe)
-
-    stream.sync()
-
-    print "Performance: {0:6.2f}ms/iteration".format(1e3 * (time() - start) / float(nsteps))
+    Wrapper of :class:`MCEq.backends.XeonPhiBackend`.
+    """
+    from MCEq.backends import XeonPhiBackend, integrate
 
-    mic_phi.update_host()
-    stream.sync()
+    session = SolverSession(None, int_m, dec_m, mu_idcs, None, phi.size)
+    backend = XeonPhiBackend()
+    backend.setup(session, phi)
 
-    return mic_phi.array, []
+    return integrate(backend, nsteps, dX, rho_inv, grid_idcs)
@@ -16,6 +16,36 @@ def normalize_hadronic_model_name(name):
     return name.translate(None, ".-").upper()
 
 
+def energy_window(e_grid, e_range):
+    """Returns the index range of the energy grid, which is selected
+    by the energy window ``e_range``.
+
+    A bin is contained in the window if its center lies inside.
+
+    Args:
+      e_grid (numpy.array): energy grid (bin centers) in GeV
+      e_range (tuple): (E_min, E_max) in GeV, where each of the values
+                       can be ``None`` for an open boundary, or ``None``
+                       to select the full grid
+    Returns:
+      (tuple): lower and upper index (exclusive) of the window
+    """
+    if e_range is None:
+        return 0, e_grid.size
+
+    e_min, e_max = e_range
+    lidx = 0 if e_min is None else np.count_nonzero(e_grid < e_min)
+    uidx = e_grid.size if e_max is None else np.count_nonzero(
+        e_grid <= e_max)
+
+    if uidx - lidx < 2:
+        raise Exception(
+            'energy_window(): energy range {0} selects less than '.format(
+                e_range) + 'two bins of the grid.')
+
+    return lidx, uidx
+
+
 def theta_deg(cos_theta):
     """Converts :math:`\\cos{\\theta}` to :math:`\\theta` in degrees.
     """
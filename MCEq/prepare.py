@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`MCEq.prepare` --- ahead-of-time preparation of the data files
+===================================================================
+
+At the first run, :class:`MCEq.core.MCEqRun` creates derived data files
+(compact and low-energy extended yields, uncompressed databases) in the
+directory of the derived files (``data_dir``, or a subdirectory of
+``cache_dir`` of ``derived_data`` in :mod:`mceq_config`). This module
+builds all of them in advance, such that later runs only read them,
+e.g. on nodes of a cluster::
+
+    $ python -m MCEq.prepare SIBYLL2.3c EPOS-LHC --variants compact_ledpm
+    $ python -m MCEq.prepare --atmosphere CORSIKA,BK_USStd --angles 0 30 60
+    $ python -m MCEq.prepare --verify
+
+The files of each variant are prepared concurrently, see
+:func:`MCEq.data_utils.prepare_data_files`. The checksums of the files
+are stored in ``manifest.json`` in the directory of the derived files.
+Derived files which do not match their checksum, e.g. after an
+interrupted preparation, are rebuilt.
+"""
+
+import os
+import sys
+import json
+from contextlib import contextmanager
+from mceq_config import config, dbg
+from MCEq.misc import normalize_hadronic_model_name
+from MCEq.data_utils import derived_dir
+
+#: Settings (compact_mode, low energy extension) of the variants
+VARIANTS = {
+    'compact': (True, False),
+    'compact_ledpm': (True, True),
+    'full': (False, False),
+    'ledpm': (False, True)
+}
+
+#: File name of the checksums in the directory of the derived files
+MANIFEST = 'manifest.json'
+
+
+def _is_derived(fname):
+    """Returns ``True`` for files which are created from other files."""
+    return (fname.endswith('.ppd') or fname.endswith('.mca') or
+            '_compact' in fname or '_ledpm' in fname or
+            fname == config['atm_cache_file'])
+
+
+def current_variant():
+    """Returns the variant of the settings in :mod:`mceq_config`."""
+    settings = (config['compact_mode'],
+                config['low_energy_extension']['enabled'])
+    for name, value in VARIANTS.items():
+        if value == settings:
+            return name
+
+
+@contextmanager
+def _variant(variant):
+    """Applies the settings of a variant (see :data:`VARIANTS`) to
+    :mod:`mceq_config` and restores them afterwards."""
+    if variant not in VARIANTS:
+        raise Exception("prepare(): unknown variant {0}, ".format(variant) +
+                        "use one of " + ', '.join(sorted(VARIANTS)))
+    le_ext = config['low_energy_extension']
+    settings = config['compact_mode'], le_ext['enabled']
+    config['compact_mode'], le_ext['enabled'] = VARIANTS[variant]
+    try:
+        yield
+    finally:
+        config['compact_mode'], le_ext['enabled'] = settings
+
+
+def available_models():
+    """Returns the interaction models with yield files in ``data_dir``."""
+    models = []
+    for fname in sorted(os.listdir(config['data_dir'])):
+        if fname.endswith('_yields.bz2') and not _is_derived(fname):
+            models.append(fname[:-len('_yields.bz2')])
+    return models
+
+
+def read_manifest():
+    """Returns the checksums of the manifest by file name."""
+    fname = os.path.join(derived_dir(), MANIFEST)
+    if not os.path.isfile(fname):
+        return {}
+    return json.load(open(fname))
+
+
+def write_manifest(dirname=None):
+    """Stores the checksums of the derived files in their directory
+    (``data_dir`` by default, see :func:`MCEq.data_utils.derived_dir`).
+    The original data files are covered by ``checksums.json``.
+
+    Args:
+      dirname (str,optional): directory, by default the one of the current
+        settings
+    Returns:
+      (dict): checksums by file name
+    """
+    from MCEq.cache import sha1_file, FileLock
+
+    dirname = dirname or derived_dir()
+    fname = os.path.join(dirname, MANIFEST)
+    with FileLock(fname):
+        manifest = {}
+        for name in sorted(os.listdir(dirname)):
+            path = os.path.join(dirname, name)
+            if (not os.path.isfile(path) or not _is_derived(name) or
+                    '.tmp' in name or name.endswith('.lock')):
+                continue
+            manifest[name] = sha1_file(path)
+
+        tmp_fname = fname + '.tmp{0}'.format(os.getpid())
+        with open(tmp_fname, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(tmp_fname, fname)
+
+    return manifest
+
+
+def verify_manifest(remove=False):
+    """Compares the files to the checksums of the manifest.
+
+    Args:
+      remove (bool): delete derived files with wrong checksums, such that
+        they are rebuilt
+    Returns:
+      (list): names of the files with wrong checksums or missing files
+    """
+    from MCEq.cache import sha1_file
+
+    invalid = []
+    for fname, checksum in sorted(read_manifest().items()):
+        path = os.path.join(derived_dir(), fname)
+        if os.path.isfile(path) and sha1_file(path) == checksum:
+            continue
+        invalid.append(fname)
+        if remove and _is_derived(fname) and os.path.isfile(path):
+            if dbg > 0:
+                print "verify_manifest(): removing", fname
+            os.unlink(path)
+
+    return invalid
+
+
+def prepare_atmospheres(atmospheres, angles):
+    """Calculates the density splines of the atmospheres at the zenith
+    angles and stores them in the atmosphere cache.
+
+    Args:
+      atmospheres (list): tuples (model, location, season) as in
+        ``density_model`` in :mod:`mceq_config`, e.g.
+        ``('CORSIKA', 'BK_USStd', None)``
+      angles (list of float): zenith angles in degrees
+    """
+    import MCEq.density_profiles as dprof
+
+    classes = {
+        'CORSIKA': dprof.CorsikaAtmosphere,
+        'MSIS00': dprof.MSIS00Atmosphere,
+        'MSIS00_IC': dprof.MSIS00IceCubeCentered,
+        'AIRS': dprof.AIRSAtmosphere,
+        'Isothermal': dprof.IsothermalAtmosphere
+    }
+
+    use_atm_cache = config['use_atm_cache']
+    config['use_atm_cache'] = True
+    try:
+        for model, location, season in atmospheres:
+            if model not in classes:
+                raise Exception("prepare_atmospheres(): unknown model " +
+                                "{0}.".format(model))
+            atm = classes[model](location, season)
+            for theta in angles:
+                atm.set_theta(theta)
+    finally:
+        config['use_atm_cache'] = use_atm_cache
+
+
+def prepare(models=None, variants=None, processes=None, atmospheres=(),
+            angles=(0., )):
+    """Builds the derived data files of the interaction models for each
+    variant of the settings and updates the manifest.
+
+    Args:
+      models (list of str,optional): interaction models, by default all
+        models in ``data_dir``
+      variants (list of str,optional): keys of :data:`VARIANTS`, by default
+        the variant of :mod:`mceq_config`
+      processes (int,optional): number of processes, see
+        :func:`MCEq.data_utils.prepare_data_files`
+      atmospheres (list,optional): see :func:`prepare_atmospheres`
+      angles (list of float,optional): see :func:`prepare_atmospheres`
+    Returns:
+      (list): names of the prepared database files
+    """
+    from MCEq.data_utils import prepare_data_files
+
+    if models is None:
+        models = available_models()
+    if variants is None:
+        variants = [current_variant()]
+
+    # The variants can have different directories of derived files, each
+    # with its own manifest, which is written once after all variants
+    prepared = []
+    dirnames = []
+    for variant in variants:
+        with _variant(variant):
+            if dbg > 0:
+                print "prepare(): variant", variant, "in", derived_dir()
+            if derived_dir() not in dirnames:
+                # Rebuild files of interrupted or corrupted preparations
+                verify_manifest(remove=True)
+                dirnames.append(derived_dir())
+            prepared += prepare_data_files(models, processes)
+
+    if atmospheres:
+        prepare_atmospheres(atmospheres, angles)
+        if derived_dir() not in dirnames:
+            dirnames.append(derived_dir())
+
+    for dirname in dirnames:
+        write_manifest(dirname)
+
+    return prepared
+
+
+def verify_variants(variants=None):
+    """Compares the files of the variants to the checksums of their
+    manifests, see :func:`verify_manifest`.
+
+    Args:
+      variants (list of str,optional): keys of :data:`VARIANTS`, by default
+        all variants
+    Returns:
+      (dict): names of the files with wrong checksums or missing files,
+      by directory of the derived files, for the directories with a manifest
+    """
+    invalid = {}
+    for variant in variants or sorted(VARIANTS):
+        with _variant(variant):
+            if derived_dir() not in invalid and read_manifest():
+                invalid[derived_dir()] = verify_manifest()
+    return invalid
+
+
+def main(argv=None):
+    """Command line interface, see ``python -m MCEq.prepare --help``."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m MCEq.prepare',
+        description='Builds the derived data files of MCEq in advance.')
+    parser.add_argument(
+        'models', nargs='*',
+        help='interaction models (default: all models in data_dir)')
+    parser.add_argument(
+        '--variants', nargs='+', choices=sorted(VARIANTS),
+        help='compact mode and low energy extension settings ' +
+        '(default: the settings in mceq_config)')
+    parser.add_argument(
+        '--processes', type=int,
+        help='number of processes (default: data_preparation in mceq_config)')
+    parser.add_argument(
+        '--atmosphere', action='append', default=[],
+        metavar='MODEL,LOCATION[,SEASON]',
+        help='store the density splines in the atmosphere cache')
+    parser.add_argument(
+        '--angles', nargs='+', type=float, default=[0.],
+        help='zenith angles of the atmosphere cache in degrees')
+    parser.add_argument(
+        '--data-dir', help='data directory (default: data_dir in mceq_config)')
+    parser.add_argument(
+        '--cache-dir',
+        help='directory of the derived files (default: derived_data in ' +
+        'mceq_config)')
+    parser.add_argument(
+        '--verify', action='store_true',
+        help='only compare the files of the variants (default: all) to ' +
+        'the checksums of their manifests')
+    args = parser.parse_args(argv)
+
+    if args.data_dir:
+        config['data_dir'] = os.path.abspath(args.data_dir)
+    if args.cache_dir:
+        config['derived_data']['cache_dir'] = os.path.abspath(args.cache_dir)
+
+    if args.verify:
+        invalid = verify_variants(args.variants)
+        if not invalid:
+            print "no manifest in", derived_dir()
+            return 1
+        for dirname, fnames in sorted(invalid.items()):
+            for fname in fnames:
+                print "invalid or missing:", os.path.join(dirname, fname)
+        return 1 if any(invalid.values()) else 0
+
+    atmospheres = []
+    for atm in args.atmosphere:
+        fields = (atm.split(',') + [None, None])[:3]
+        atmospheres.append(tuple(fields))
+
+    models = [normalize_hadronic_model_name(m) for m in args.models] or None
+    prepare(models, args.variants, args.processes, atmospheres, args.angles)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+:mod:`MCEq.reducers` --- reductions of the state vector during the integration
+==============================================================================
+
+Longitudinal profiles often need only a few numbers per depth, e.g.
+the number of muons above some energy, instead of the complete state
+vector at each point of the ``int_grid``. Reducers are evaluated by the
+forward-euler integrator at the depths of the ``int_grid`` or every
+few integration steps, and only their results are kept::
+
+    from MCEq.reducers import SolutionReducer
+
+    mceq_run.add_reducer('mu_1TeV', SolutionReducer(
+        'total_mu+', integrate=True, e_min=1e3))
+    mceq_run.solve(int_grid=X_grid, store_grid_sol=False)
+    X, n_mu = mceq_run.reduction_X['mu_1TeV'], mceq_run.reductions['mu_1TeV']
+
+Reducers act on the state vector of the kernels, which can be reduced
+or reordered (see :class:`MCEq.kernels.SolverSession`).
+"""
+
+import numpy as np
+from mceq_config import config
+
+
+class Reducer(object):
+    """Base class of the reducers.
+
+    Args:
+      every (int): evaluate the reducer every ``every`` integration steps,
+        or at the depths of ``int_grid`` if 0
+    """
+
+    def __init__(self, every=0):
+        self.every = every
+        self.session = None
+
+    def bind(self, mceq_run, session):
+        """Prepares the reducer for the state vector of the kernels.
+        Called before each integration.
+
+        Args:
+          mceq_run (object): instance of :class:`MCEq.core.MCEqRun`
+          session (object): instance of :class:`MCEq.kernels.SolverSession`
+        """
+        self.session = session
+
+    def __call__(self, phi):
+        """Returns the reduction of the state vector.
+
+        Args:
+          phi (numpy.array): state vector of the kernels (read only)
+        """
+        raise NotImplementedError()
+
+
+class FunctionReducer(Reducer):
+    """Applies a function to the full state vector. The state vector is
+    expanded for each call, for frequent evaluations prefer
+    :class:`SolutionReducer`.
+
+    Args:
+      func (callable): ``func(phi)`` returns the reduction of the full
+        state vector ``phi``
+      every (int): see :class:`Reducer`
+    """
+
+    def __init__(self, func, every=0):
+        Reducer.__init__(self, every)
+        self.func = func
+
+    def __call__(self, phi):
+        return self.func(self.session.expand(phi))
+
+
+class SolutionReducer(Reducer):
+    """Computes a solution as :func:`MCEq.core.MCEqRun.get_solution`,
+    including the ``total_`` and ``conv_`` sums of the lepton species.
+
+    Args:
+      particle_name (str): name of the solution, e.g. ``total_mu+``
+      mag (float): the solution is multiplied by :math:`E^{mag}`
+      integrate (bool): multiply by the bin widths (particle number)
+      e_min (float,optional): return the sum over the bins above
+        ``e_min`` in GeV instead of the spectrum, e.g. the number of
+        particles above ``e_min`` if ``integrate`` is set
+      every (int): see :class:`Reducer`
+    """
+
+    def __init__(self, particle_name, mag=0., integrate=False, e_min=None,
+                 every=0):
+        Reducer.__init__(self, every)
+        self.particle_name = particle_name
+        self.mag = mag
+        self.integrate = integrate
+        self.e_min = e_min
+
+    def bind(self, mceq_run, session):
+        Reducer.bind(self, mceq_run, session)
+
+        ref = mceq_run.pname2pref
+        self.d = mceq_run.d
+        self.weights = mceq_run.e_grid**self.mag
+        if self.integrate:
+            self.weights = self.weights * mceq_run.e_widths
+        if self.e_min is not None:
+            self.e_sel = mceq_run.e_grid >= self.e_min
+
+        # Kernel indices of the components, removed species are zero
+        self.components = []
+        for pname in mceq_run._solution_components(self.particle_name):
+            p = ref[pname]
+            kidx = session.kernel_indices(np.arange(p.lidx(), p.uidx()))
+            if np.any(kidx < 0):
+                continue
+            if np.all(np.diff(kidx) == 1):
+                kidx = slice(kidx[0], kidx[-1] + 1)
+            self.components.append((p.e_lidx, kidx))
+
+    def __call__(self, phi):
+        res = np.zeros(self.d)
+        for e_lidx, kidx in self.components:
+            res[e_lidx:] += phi[kidx]
+        res *= self.weights
+
+        if self.e_min is None:
+            return res
+        return np.sum(res[self.e_sel])
+
+
+class ProductionDepth(object):
+    """Histograms of the production depth of particles, accumulated from
+    the source terms of the integration steps.
+
+    The source term of a species is the part of the change of its flux
+    :math:`\\Delta\\Phi = (\\boldsymbol{M}_{int} + \\frac{1}{\\rho}
+    \\boldsymbol{M}_{dec}) \\Phi \\Delta X`, which comes from other species,
+    i.e. from interactions and decays. It is obtained from
+    :math:`\\Delta\\Phi` of the kernel by subtracting the (small) diagonal
+    block of the species, without an additional product with the full
+    matrices. In the first interaction mode, the interaction losses and the
+    switched interactions of the species are subtracted instead. Each step
+    is assigned to the depth bin of its center.
+
+    Args:
+      particle_names (list of str): names of solutions as in
+        :func:`MCEq.core.MCEqRun.get_solution`, e.g. ``pi_numu`` or
+        ``total_mu+``
+      X_edges (numpy.array): edges of the depth bins in g/cm**2
+    """
+
+    def __init__(self, particle_names, X_edges):
+        self.particle_names = list(particle_names)
+        self.X_edges = np.asarray(X_edges, dtype='double')
+        #: (dict) histograms with shape (depth bins, energy bins) by name
+        self.hist = {}
+
+    def bind(self, mceq_run, session, dX):
+        """Prepares the histograms for the kernel state vector of ``session``
+        and the step sizes ``dX`` of the integration path."""
+        from MCEq.kernels import _submatrix
+
+        ref = mceq_run.pname2pref
+        n_bins = self.X_edges.size - 1
+        self.hist = dict((name, np.zeros((n_bins, mceq_run.d)))
+                         for name in self.particle_names)
+
+        X = np.cumsum(dX, dtype='double')
+        self.step_bin = np.digitize(X - 0.5 * dX, self.X_edges) - 1
+        self.step_bin[self.step_bin >= n_bins] = -1
+
+        # In the first interaction mode, the interaction losses are not part
+        # of int_m and the interactions are switched off after max_step
+        self.fa_vars = (mceq_run.fa_vars
+                        if config['first_interaction_mode'] else None)
+
+        # Kernel indices, indices of the complete state vector and diagonal
+        # blocks of the species
+        self.blocks = []
+        for name in self.particle_names:
+            for pname in mceq_run._solution_components(name):
+                p = ref[pname]
+                fidx = np.arange(p.lidx(), p.uidx())
+                kidx = session.kernel_indices(fidx)
+                if np.any(kidx < 0):
+                    continue
+                self.blocks.append(
+                    (self.hist[name][:, p.e_lidx:], kidx, fidx,
+                     _submatrix(session.int_m, kidx),
+                     _submatrix(session.dec_m, kidx)))
+
+    def __call__(self, step, phi, delta, idcs, rho_inv, dX):
+        """Adds the source terms of integration step ``step``.
+
+        Args:
+          step (int): index of the step
+          phi (numpy.array): kernel state vector before the step
+          delta (numpy.array): :math:`d\\Phi/dX` of the elements ``idcs``
+          idcs (slice or numpy.array): active elements of the state vector
+          rho_inv (float): :math:`\\frac{1}{\\rho(X_i)}`
+          dX (float): step size in g/cm**2
+        """
+        ibin = self.step_bin[step]
+        if ibin < 0:
+            return
+        fa_vars = self.fa_vars
+        for hist, kidx, fidx, int_diag, dec_diag in self.blocks:
+            if isinstance(idcs, slice):
+                pos = kidx
+            else:
+                # Inactive species are not fed by any active species
+                pos = np.searchsorted(idcs, kidx)
+                if (pos[-1] >= idcs.size or
+                        not np.array_equal(idcs[pos], kidx)):
+                    continue
+            phi_b = phi[kidx]
+            if fa_vars is None:
+                source = delta[pos] - int_diag.dot(phi_b)
+            else:
+                source = delta[pos] + fa_vars['Lambda_int'][fidx] * phi_b
+                if step <= fa_vars['max_step']:
+                    source -= int_diag.dot(
+                        fa_vars['fi_switch'][step][fidx] * phi_b)
+            hist[ibin] += (source - rho_inv * dec_diag.dot(phi_b)) * dX
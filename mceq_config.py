@@ -44,6 +44,37 @@ config = {
     # File name of the cross-sections tables
     "cs_fname": "crosssections.ppd",
 
+    # Format of the uncompressed data files, which are created from the
+    # .bz2 files at the first use:
+    # 'ppd' - pickled dictionaries, loaded completely into memory
+    # 'mca' - index and arrays in one file, which is memory-mapped. The
+    # matrices are read at their first use and the memory is shared
+    # between processes (see MCEq.data_utils.MatrixArchive).
+    "data_format": "mca",
+
+    # Preparation of the data files at the first run. Missing files of the
+    # interaction model, decays and cross sections are decompressed and
+    # converted concurrently by 'processes' processes, which is also the
+    # number of threads of the conversion to compact mode. The .bz2 files are
+    # (de-)compressed with the first of 'bz2_tools' found in the PATH,
+    # which use all cores for large files, or with the python bz2 module.
+    "data_preparation": {
+        "processes": 4,
+        "bz2_tools": ['lbzip2', 'pbzip2'],
+    },
+
+    # Location of the files which are created from the original data files
+    # (compact and low energy extended yields, uncompressed databases,
+    # atmosphere cache). If 'cache_dir' is None, they are stored in data_dir.
+    # Otherwise, e.g. for a read-only data_dir or a node-local disk, they
+    # are stored in a subdirectory of 'cache_dir', which is named after
+    # the checksums of the original files. Files which already exist in
+    # data_dir are used from there. Files are created under locks and
+    # renamed when complete, so concurrent processes can share the cache.
+    "derived_data": {
+        "cache_dir": None,
+    },
+
     # File name of for energy losses
     "mu_eloss_fname": "dEdX_mu_air.ppl",
 
@@ -94,20 +125,112 @@ config = {
     # Parameters of numerical integration
     #===========================================================================
 
+    # Restrict the energy grid to a window (E_min, E_max) in GeV, e.g.
+    # (1e2, 1e8), or None to use the full grid of the interaction model.
+    # Either of the boundaries can be None. All matrices, the muon energy
+    # loss and the initial condition are built on the window only, which
+    # reduces the dimension of the system.
+    # Bins below E_min are removed without any error, since they can not
+    # feed higher energies. Bins above E_max are removed together with the
+    # particle production of projectiles above E_max. For a primary flux
+    # ~E^-gamma and scaling yields, the relative error of a secondary flux
+    # at energy E is of the order (E/E_max)^(gamma - 1), i.e. ~2% one decade
+    # and <0.1% two decades below E_max for gamma = 2.7. Therefore, E_max
+    # should be one or two decades above the highest energy of interest.
+    "e_range": None,
+
     # Selection of integrator (euler/odepack)
     "integrator": "euler",
 
-    # euler kernel implementation (numpy/MKL/CUDA).
-    # With serious nVidia GPUs CUDA a few times faster than MKL
+    # euler kernel implementation (numpy/MKL/CUDA/MIC), see MCEq.backends.
+    # With serious nVidia GPUs CUDA a few times faster than MKL.
+    # If the kernel is not available or does not support the settings
+    # (e.g. the matrix format), the fastest available one is used instead.
     "kernel_config": "MKL",
 
     # Use sparse linear algebra (recommended!)
     "use_sparse": True,
 
+    # Storage format of the sparse matrices in the numpy kernel:
+    # 'csr' - scipy.sparse.csr_matrix
+    # 'bsr' - scipy.sparse.bsr_matrix with small square blocks
+    # 'sell' - SELL-C-sigma format (MCEq.kernels.SELLMatrix)
+    # 'packed' - species blocks, where the upper-triangular blocks are
+    # stored as packed triangles (MCEq.kernels.BlockTriangularMatrix).
+    # Needs less memory than CSR and is faster if numba is installed.
+    # 'dense' - numpy.array
+    "matrix_format": "csr",
+
+    # Time the matrix formats on the actual matrices after their
+    # initialization and select the fastest one for the numpy kernel.
+    # Results are cached in 'cache_file' (in the directory of the derived
+    # data files, see 'derived_data') for each set of matrices and machine,
+    # such that later runs skip the timing.
+    "autotune": {
+        "enabled": False,
+        "formats": ['csr', 'bsr', 'sell', 'packed', 'dense'],
+        "n_iter": 50,
+        "cache_file": "matrix_format_cache.json",
+    },
+
+    # Cache of the assembled matrices on disk. The cache entries are keyed
+    # by a fingerprint of the interaction model, the settings which affect
+    # the matrices and the checksums of the data files. The matrices are
+    # stored uncompressed and memory-mapped when loading, which makes the
+    # initialization of later runs fast. 'cache_dir' is relative to
+    # data_dir (or an absolute path).
+    "matrix_cache": {
+        "enabled": False,
+        "cache_dir": "matrix_cache",
+    },
+
+    # Keep the yields, cross sections and interaction matrices of recently
+    # used interaction models in memory, such that switching back to such
+    # a model with MCEqRun.set_interaction_model() does not read files or
+    # rebuild matrices. The least recently used models are evicted if the
+    # estimated memory exceeds 'max_memory_mb'. Statistics are returned by
+    # MCEqRun.model_cache_info(). Disabled by default, since several
+    # models can occupy up to 'max_memory_mb'.
+    "model_cache": {
+        "enabled": False,
+        "max_memory_mb": 2000,
+    },
+
     #Number of MKL threads (for sparse matrix multiplication the performance
     #advantage from using more than 1 thread is limited by memory bandwidth)
     "MKL_threads": 24,
 
+    # Skip species with vanishing flux in the numpy kernel. A species is
+    # inactive if its maximal flux is below 'threshold' times the maximal
+    # flux in the state vector and if it can not be fed by any active
+    # species. The rows and columns of inactive species are removed from the
+    # matrix-vector products. The active set is re-evaluated every
+    # 'recheck_steps' integration steps. Speeds up calculations in deep
+    # targets, or in the first interaction mode.
+    "active_set": {
+        "enabled": False,
+        "threshold": 1e-25,
+        "recheck_steps": 50,
+    },
+
+    # Reorder the state vector before the integration to improve the memory
+    # locality of the sparse matrix-vector products (None, 'rcm',
+    # 'energy_major', 'coupling'). The results are mapped back to the
+    # original order. Use MCEqRun.benchmark_state_ordering() to find the
+    # fastest ordering for your machine. Only 'coupling' can be combined
+    # with the active set, since it keeps species blocks contiguous.
+    "state_ordering": None,
+
+    # Checkpoints of the forward-euler integration, which allow to resume
+    # interrupted calculations with MCEqRun.solve(resume=...). A checkpoint
+    # is stored every 'interval' integration steps (0 = only at the end or
+    # at X_stop) in MCEqRun.checkpoint and, if 'file' is not None, in
+    # this file.
+    "checkpoint": {
+        "interval": 0,
+        "file": None,
+    },
+
     # Floating point precision: 32-bit results in speed-up with CUDA.
     # Do not use with MKL, it can result in false results and slow down.
     "FP_precision": 64,
@@ -146,6 +269,14 @@ config = {
     # values around 0.1 or 0.05
     "hybrid_crossover": 0.5,
 
+    # Store only the hadron range E > E_mix of mixed particles in the state
+    # vector. Below E_mix these particles are treated as resonances and the
+    # corresponding rows and columns of the matrices are empty. This reduces
+    # the dimension of the system, without changing the results. Note that
+    # the particle ranges in the state vector have different lengths, if
+    # enabled, use MCEqParticle.lidx()/uidx() and .e_lidx for indexing.
+    "variable_block_size": False,
+
     # Muon energy loss according to Kokoulin et al.
     "enable_muon_energy_loss": True,
 
@@ -183,6 +314,15 @@ config = {
         # difference. In particular in combination with the compact
         # mode, this case doesn't even occur and output is identical.
         "use_unknown_cs": True,
+        # If True, the yields of the high and low energy models are kept
+        # in memory and blended on demand, instead of writing a merged
+        # (_ledpm) file. Changing "he_le_transition" or "nbins_interp"
+        # then only requires the matrices to be rebuilt, see
+        # MCEqRun.set_le_transition(). The secondaries are those of the
+        # high energy model. Channels, which the high energy model does
+        # not produce, are not taken from the low energy model, unlike
+        # in the merged files.
+        "blend_in_memory": False,
     },
 
     # Advanced settings (some options might be obsolete/not working)
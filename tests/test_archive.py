@@ -0,0 +1,66 @@
+"""Round-trip checks of the ``.mca`` files in :mod:`MCEq.data_utils`."""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from MCEq.data_utils import MatrixArchive, is_mapped, write_archive
+
+
+def _database():
+    """Returns a dictionary with the kinds of entries found in the yield,
+    decay and cross section databases."""
+    rng = np.random.RandomState(2)
+    return {
+        (2212, 211): rng.rand(6, 6),
+        (211, (13, 0)): np.arange(12, dtype=np.int32).reshape(3, 4),
+        'evec': np.logspace(0, 5, 6),
+        'SIBYLL2.3': {
+            2212: rng.rand(6),
+            211: rng.rand(6)
+        },
+        'mothers_daughters': {
+            2212: [211, -211],
+            211: [13]
+        },
+        'ebins': [1., 10., 100.],
+        'description': 'round-trip test',
+    }
+
+
+def _assert_equal(result, expected):
+    assert sorted(result.keys()) == sorted(expected.keys())
+    for key, value in expected.iteritems():
+        if isinstance(value, np.ndarray):
+            assert result[key].dtype == value.dtype
+            assert np.array_equal(result[key], value)
+        elif isinstance(value, dict):
+            _assert_equal(result[key], value)
+        else:
+            assert result[key] == value
+
+
+def test_archive_round_trip():
+    content = _database()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp_dir, 'test.mca')
+        write_archive(fname, content)
+        arc = MatrixArchive(fname)
+
+        assert sorted(arc.keys()) == sorted([
+            ((2212, 211), ), ((211, (13, 0)), ), ('evec', ),
+            ('SIBYLL2.3', 2212), ('SIBYLL2.3', 211)
+        ])
+        _assert_equal(arc.to_dict(), content)
+
+        # A window of a matrix, as in InteractionYields._restrict, is still
+        # a view into the mapping
+        window = arc[((2212, 211), )][1:4, 1:4]
+        assert is_mapped(window)
+        assert np.array_equal(window, content[(2212, 211)][1:4, 1:4])
+        del arc, window
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,36 @@
+"""Regression checks of the matrix formats in :mod:`MCEq.kernels`."""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from MCEq.kernels import BlockTriangularMatrix, _btr_dot_kernel
+
+
+def _leading_short_block_matrix():
+    """Returns a matrix, the block bounds and the grid dimension, where the
+    first block starts above energy bin 0 (e_lidx = [3, 0, 1])."""
+    d = 5
+    bounds = np.array([0, 2, 7, 11])
+    rng = np.random.RandomState(1)
+    mat = rng.rand(11, 11)
+    mat[mat < 0.5] = 0.
+    return csr_matrix(mat), bounds, d
+
+
+def test_btr_dot_leading_short_block():
+    mat, bounds, d = _leading_short_block_matrix()
+    btr = BlockTriangularMatrix(mat, bounds, d)
+    assert np.all(btr.e_lidx == [3, 0, 1])
+
+    x = np.arange(1., 12.)
+    assert np.allclose(btr.tocsr().toarray(), mat.toarray())
+    assert np.allclose(btr.dot(x), mat.dot(x))
+
+    kernel = _btr_dot_kernel()
+    if kernel is not None:
+        # The interpreted kernel must agree with the compiled one
+        y = np.zeros(btr.shape[0])
+        kernel.py_func(btr.blk_ptr, btr.blk_col, btr.blk_off, btr.blk_dense,
+                       btr.bounds, btr.e_lidx, btr.tri_off, btr.data, btr.d,
+                       x, y)
+        assert np.allclose(y, mat.dot(x))